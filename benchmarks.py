@@ -0,0 +1,327 @@
+'''
+Micro-benchmarks for the purepyindi hot paths
+
+Run ``python benchmarks.py`` for all of them, or name the ones you
+want (e.g. ``python benchmarks.py parser``).
+'''
+import concurrent.futures
+import gc
+import json
+import multiprocessing
+import os
+import queue
+import xml.etree.ElementTree as ET
+import socket
+import sys
+import threading
+import time
+from purepyindi import log
+from purepyindi.client import INDIClient
+from purepyindi.constants import ConnectionStatus, INDIActions, MAX_ELEMENT_HISTORY
+from purepyindi.parser import (
+    INDIStreamParser,
+    parse_iso_to_datetime,
+    parse_iso_to_epoch,
+    parse_subscriptions,
+    _strptime_iso,
+)
+from purepyindi.generator import (
+    format_datetime_as_iso,
+    format_epoch_as_iso,
+    construct_property_new,
+    mutation_to_xml_message,
+)
+from purepyindi.history import ElementHistory, NumberElementHistory
+from purepyindi.test_fixtures import make_message_corpus, make_def_corpus
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+def loaded_client(def_corpus, **kwargs):
+    '''An unconnected `INDIClient` with the definitions in `def_corpus` applied'''
+    client = INDIClient(None, None, **kwargs)
+    client._parser.parse(def_corpus)
+    while not client._inbound_queue.empty():
+        client.apply_update(client._inbound_queue.get_nowait())
+    return client
+
+def rss_bytes():
+    '''Resident set size of this process, or its peak where /proc isn't available'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def loaded_rss(def_corpus, eager_history=False, **kwargs):
+    '''
+    How much RSS grows loading `def_corpus` into a client, and how many
+    elements that makes. With `eager_history`, every element's history
+    is created up front, as it was before they were made lazy.
+    '''
+    gc.collect()
+    before = rss_bytes()
+    client = loaded_client(def_corpus, **kwargs)
+    if eager_history:
+        for element in client._element_index.values():
+            element.history
+    gc.collect()
+    return rss_bytes() - before, len(client._element_index)
+
+def timed(func, repeats=3):
+    '''Best wall-clock time of `repeats` calls to `func`'''
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+@benchmark
+def bench_parser(n_messages=100000, chunk_size=1024):
+    corpus = make_message_corpus(n_messages)
+    chunks = [corpus[idx:idx + chunk_size] for idx in range(0, len(corpus), chunk_size)]
+    print(f"parser: {n_messages} messages, {len(corpus) / 1e6:.1f} MB in {chunk_size} byte chunks")
+    for label, fast_path, epoch_timestamps, subscriptions in (
+        ('generic', False, False, None),
+        ('fast path', True, False, None),
+        ('fast + epoch', True, True, None),
+        ('1/28 subscribed', True, True, parse_subscriptions(['dev0.prop0'])),
+    ):
+        def run():
+            q = queue.SimpleQueue()
+            parser = INDIStreamParser(
+                q,
+                fast_path=fast_path,
+                epoch_timestamps=epoch_timestamps,
+                subscriptions=subscriptions
+            )
+            for chunk in chunks:
+                parser.parse(chunk)
+        elapsed = timed(run)
+        print(f"  {label:>16}: {n_messages / elapsed:12.0f} messages/sec")
+
+@benchmark
+def bench_timestamps(n_timestamps=100000):
+    timestamps = [f'2019-08-12T20:{idx // 60 % 60:02d}:{idx % 60:02d}.{idx:06d}Z' for idx in range(n_timestamps)]
+    print(f"timestamps: {n_timestamps} ISO timestamps")
+    for label, func in (
+        ('strptime', _strptime_iso),
+        ('datetime', parse_iso_to_datetime),
+        ('epoch', parse_iso_to_epoch),
+    ):
+        elapsed = timed(lambda: list(map(func, timestamps)))
+        print(f"  {'parse ' + label:>18}: {n_timestamps / elapsed:12.0f} timestamps/sec")
+    datetimes = list(map(parse_iso_to_datetime, timestamps))
+    epochs = list(map(parse_iso_to_epoch, timestamps))
+    for label, func, values in (
+        ('strftime', format_datetime_as_iso, datetimes),
+        ('epoch', format_epoch_as_iso, epochs),
+    ):
+        elapsed = timed(lambda: list(map(func, values)))
+        print(f"  {'format ' + label:>18}: {n_timestamps / elapsed:12.0f} timestamps/sec")
+
+@benchmark
+def bench_history(n_samples=200000):
+    print(f"history: {n_samples} samples")
+    for max_history in (100, 10000):
+        for label, history_class in (('list', ElementHistory), ('ring buffer', NumberElementHistory)):
+            def run():
+                history = history_class(None, max_history=max_history)
+                for idx in range(n_samples):
+                    history.add(idx * 0.001, 1.0)
+            elapsed = timed(run)
+            print(f"  {label:>12} (max_history={max_history:>5}): {n_samples / elapsed:12.0f} samples/sec")
+
+@benchmark
+def bench_lookup(n_lookups=100000):
+    client = loaded_client(make_def_corpus(20, 50, 10))
+    keys = [f'dev{idx % 20}.prop{idx % 50}.elem{idx % 10}' for idx in range(n_lookups)]
+    misses = [f'dev{idx % 20}.prop{idx % 50}.nope' for idx in range(n_lookups)]
+    print(f"lookup: {n_lookups} lookups among {len(client._element_index)} elements")
+    for label, func in (
+        ('__getitem__', lambda: [client[key] for key in keys]),
+        ('__contains__ miss', lambda: [key in client for key in misses]),
+        ('select glob', lambda: client.select('dev1*.prop*.elem1')),
+    ):
+        elapsed = timed(func)
+        print(f"  {label:>18}: {elapsed * 1e3:10.2f} ms")
+
+@benchmark
+def bench_inbound(n_devices=20, n_properties=100, n_elements=10):
+    corpus = make_def_corpus(n_devices, n_properties, n_elements)
+    n_elements_total = n_devices * n_properties * n_elements
+    print(f"inbound: def flood of {len(corpus) / 1e6:.1f} MB ({n_elements_total} elements) over a socketpair")
+    for collect_stats in (False, True):
+        def run():
+            client = INDIClient(None, None, collect_stats=collect_stats)
+            server_socket, client_socket = socket.socketpair()
+            client_socket.settimeout(0.1)
+            client.status = ConnectionStatus.CONNECTED
+            receiver = threading.Thread(target=client._handle_inbound, args=(client_socket,))
+            receiver.start()
+            server_socket.sendall(corpus)
+            while len(client._element_index) < n_elements_total:
+                time.sleep(0.001)
+            client.status = ConnectionStatus.STOPPED
+            receiver.join()
+            server_socket.close()
+            client_socket.close()
+        elapsed = timed(run)
+        label = 'with stats' if collect_stats else 'loaded in'
+        print(f"  {label:>12}: {elapsed * 1e3:10.1f} ms ({len(corpus) / elapsed / 1e6:.1f} MB/s)")
+
+@benchmark
+def bench_serialization(n_updates=200):
+    print(f"serialization: to_json after each of {n_updates} updates")
+    for n_devices, n_properties in ((5, 50), (20, 50)):
+        client = loaded_client(make_def_corpus(n_devices, n_properties, 10))
+        elements = [client.lookup_element(f'dev0.prop{idx % 3}.elem0') for idx in range(n_updates)]
+        def run():
+            for idx, element in enumerate(elements):
+                client.apply_update({
+                    'action': INDIActions.PROPERTY_SET,
+                    'device': 'dev0',
+                    'property': {
+                        'name': element.property.name,
+                        'elements': {'elem0': {'name': 'elem0', 'value': float(idx)}},
+                    },
+                })
+                client.to_json()
+        def uncached():
+            for _ in elements:
+                for device in client.devices.values():
+                    for prop in device.properties.values():
+                        prop._invalidate_json()
+                json.dumps(client.to_jsonable(), sort_keys=True)
+        n_total = n_devices * n_properties
+        elapsed = timed(run)
+        print(f"  {n_total:>5} properties, {'cached':>12}: {elapsed / n_updates * 1e3:8.3f} ms per update")
+        elapsed = timed(uncached, repeats=1)
+        print(f"  {n_total:>5} properties, {'full rebuild':>12}: {elapsed / n_updates * 1e3:8.3f} ms per update")
+
+
+@benchmark
+def bench_sync(n_devices=20, n_properties=100, n_elements=10):
+    corpus = make_def_corpus(n_devices, n_properties, n_elements)
+    n_elements_total = n_devices * n_properties * n_elements
+    print(f"sync: def flood of {n_elements_total} elements with a client watcher serializing what changed")
+    for initial_sync in (False, True):
+        def run():
+            client = INDIClient(None, None)
+            def watcher(update, did_anything_change):
+                client.devices[update['device']].properties[update['property']['name']].to_json()
+            client.add_watcher(watcher)
+            server_socket, client_socket = socket.socketpair()
+            client_socket.settimeout(0.1)
+            client.status = ConnectionStatus.CONNECTED
+            if initial_sync:
+                client._begin_sync()
+            receiver = threading.Thread(target=client._handle_inbound, args=(client_socket,))
+            started = time.perf_counter()
+            receiver.start()
+            server_socket.sendall(corpus)
+            while len(client._element_index) < n_elements_total:
+                time.sleep(0.001)
+            loaded = time.perf_counter() - started
+            if initial_sync:
+                client.synced.result()
+            client.status = ConnectionStatus.STOPPED
+            receiver.join()
+            server_socket.close()
+            client_socket.close()
+            return loaded
+        elapsed = min(run() for _ in range(3))
+        label = 'initial sync' if initial_sync else 'watched'
+        print(f"  {label:>14}: {elapsed * 1e3:10.1f} ms to load")
+
+@benchmark
+def bench_logging(n_calls=20000):
+    from pprint import pformat
+    from purepyindi.log import debug, debug_enabled
+    q = queue.SimpleQueue()
+    INDIStreamParser(q).parse(make_message_corpus(1))
+    update = q.get_nowait()
+    print(f"logging: per-call cost of a debug message with DEBUG disabled")
+    def eager():
+        for _ in range(n_calls):
+            debug(f"Got update:\n{pformat(update)}")
+    def guarded():
+        for _ in range(n_calls):
+            if debug_enabled():
+                debug("Got update:\n%s", pformat(update))
+    def deferred():
+        for _ in range(n_calls):
+            debug("Got update: %s", update)
+    for label, func in (('eager pformat', eager), ('guarded', guarded), ('deferred args', deferred)):
+        elapsed = timed(func)
+        print(f"  {label:>14}: {elapsed / n_calls * 1e9:10.0f} ns per call")
+
+@benchmark
+def bench_encoder(n_messages=20000):
+    client = loaded_client(make_def_corpus(1, 4, 10))
+    mutations = [
+        client.devices['dev0'].properties[f'prop{idx % 3}']._new_mutation({'elem0': float(idx), 'elem1': float(idx)})
+        for idx in range(n_messages)
+    ]
+    timestamp = format_epoch_as_iso(time.time())
+    print(f"encoder: {n_messages} newNumberVector messages with 10 elements")
+    def elementtree():
+        for mutation in mutations:
+            ET.tostring(construct_property_new(mutation, timestamp), encoding='unicode').encode('utf8') + b'\n'
+    for label, func in (
+        ('ElementTree', elementtree),
+        ('template', lambda: [mutation_to_xml_message(mutation) for mutation in mutations]),
+    ):
+        elapsed = timed(func)
+        print(f"  {label:>12}: {n_messages / elapsed:12.0f} messages/sec")
+
+@benchmark
+def bench_memory(n_devices=20, n_properties=100, n_elements=10):
+    corpus = make_def_corpus(n_devices, n_properties, n_elements)
+    print(f"memory: RSS growth loading a def flood of {len(corpus) / 1e6:.1f} MB in a fresh process")
+    # a new interpreter per measurement, so earlier benchmarks' garbage doesn't skew it
+    context = multiprocessing.get_context('spawn')
+    for label, kwargs in (
+        ('eager histories', {'eager_history': True}),
+        ('datetime timestamps', {}),
+        ('epoch timestamps', {'epoch_timestamps': True}),
+        ('no history', {'epoch_timestamps': True, 'history_policies': {'*': 0}}),
+    ):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+            growth, n_loaded = pool.submit(loaded_rss, corpus, **kwargs).result()
+        print(f"  {label:>20}: {growth / 1e6:8.1f} MB, {growth / n_loaded:6.0f} bytes per element ({n_loaded} elements)")
+
+@benchmark
+def bench_setter(n_sets=20000):
+    print(f"setter: {n_sets} element.value assignments")
+    for n_elements in (1, 100):
+        for fill_history in (False, True):
+            client = loaded_client(make_def_corpus(1, 1, n_elements))
+            prop = client.devices['dev0'].properties['prop0']
+            if fill_history:
+                for element in prop.elements.values():
+                    for idx in range(MAX_ELEMENT_HISTORY):
+                        element.history.add(prop.timestamp, float(idx))
+            element = prop.elements['elem0']
+            def run():
+                for idx in range(n_sets):
+                    element.value = float(idx)
+                while not client._outbound_queue.empty():
+                    client._outbound_queue.get_nowait()
+            elapsed = timed(run)
+            label = f"{n_elements} elements, {'full' if fill_history else 'empty'} history"
+            print(f"  {label:>30}: {elapsed / n_sets * 1e6:8.2f} us per set")
+
+def main():
+    log.set_log_level('ERROR')
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from .constants import (
     PropertyPerm,
     SwitchState,
     SwitchRule,
+    OverflowPolicy,
     parse_string_into_enum,
     INDI_PROTOCOL_VERSION_STRING,
     ISO_TIMESTAMP_FORMAT,
@@ -24,5 +25,6 @@ __all__ = (
     'PropertyPerm',
     'SwitchState',
     'SwitchRule',
+    'OverflowPolicy',
     'INDI_PROTOCOL_VERSION_STRING',
 )
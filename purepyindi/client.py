@@ -6,142 +6,758 @@ Scientist-grade (i.e. hacky) Python library to parse INDI messages,
 react to them, and issue one's own.
 '''
 import asyncio
+import concurrent.futures
+import contextlib
 import threading
 import datetime
+import fnmatch
+import heapq
+import itertools
+import json
 import socket
 import time
 import math
+import numbers
+import os
 import queue
 from .constants import (
     ConnectionStatus,
     INDIActions,
     INDIPropertyKind,
+    OverflowPolicy,
     PropertyPerm,
     PropertyState,
     SwitchRule,
     SwitchState,
     parse_string_into_enum,
     CHUNK_MAX_READ_SIZE,
+    CHUNK_LARGEST_READ_SIZE,
     MAX_ELEMENT_HISTORY,
 )
-from .log import debug, info, warn, error, critical
-from .parser import INDIStreamParser, parse_iso_to_datetime
-from .generator import mutation_to_xml_message, format_datetime_as_iso
+from .log import debug, info, warn, error, critical, debug_enabled
+from .parser import INDIStreamParser, parse_iso_to_datetime, parse_subscriptions, timestamp_to_datetime
+from .generator import (
+    PropertyMutation,
+    mutation_to_xml_message,
+    mutations_to_xml_message,
+    format_epoch_as_iso,
+    format_timestamp_as_iso,
+)
+from .dispatch import WatcherDispatcher, DEFAULT_MAX_PENDING
+from .stats import ClientStats
+from .history import (
+    ElementHistory,
+    NumberElementHistory,
+    MmapElementHistory,
+    HistoryManager,
+    DISABLED_HISTORY,
+    DISABLED_NUMBER_HISTORY,
+    DEFAULT_MMAP_HISTORY_RECORDS,
+)
 from pprint import pprint, pformat
 
 SYNCHRONIZATION_TIMEOUT = 1 # second
+RECONNECT_INITIAL_DELAY = 0.5 # seconds, doubling after each failed attempt...
+RECONNECT_MAX_DELAY = 30 # ...up to this
+RESYNC_QUIET_PERIOD = 2 # seconds without def messages before a resync is over
+SYNC_QUIET_PERIOD = 0.5 # seconds without def messages before the initial sync is over
+GLOB_CHARACTERS = frozenset('*?[')
+
+def _glob_values(mapping, pattern):
+    if GLOB_CHARACTERS.isdisjoint(pattern):
+        value = mapping.get(pattern)
+        return [] if value is None else [value]
+    return [value for name, value in mapping.items() if fnmatch.fnmatchcase(name, pattern)]
+
+class AdaptiveReadSize:
+    '''
+    Picks how much to ask for in each socket read: doubling while reads
+    come back full (the server has a backlog for us, e.g. the initial
+    property definitions) and halving after a run of mostly-empty reads
+    '''
+    SHRINK_AFTER_READS = 16
+    def __init__(self, minimum=CHUNK_MAX_READ_SIZE, maximum=CHUNK_LARGEST_READ_SIZE):
+        self.minimum, self.maximum = minimum, maximum
+        self.size = minimum
+        self._small_reads = 0
+    def observe(self, n_bytes):
+        if n_bytes >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+            self._small_reads = 0
+        elif n_bytes < self.size // 4 and self.size > self.minimum:
+            self._small_reads += 1
+            if self._small_reads >= self.SHRINK_AFTER_READS:
+                self.size = max(self.size // 2, self.minimum)
+                self._small_reads = 0
+        else:
+            self._small_reads = 0
+
+class TimerHandle:
+    '''What `Timers.call_later` returns, to ``cancel()`` the call with'''
+    __slots__ = ('callback', 'cancelled')
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+    def cancel(self):
+        self.cancelled = True
+
+class Timers:
+    '''
+    Calls callbacks after a delay, all from one daemon thread rather
+    than a `threading.Timer` thread each, so a burst of commands with
+    timeouts doesn't mean a burst of threads. The thread only runs
+    while there are calls waiting.
+    '''
+    def __init__(self, name='INDIClient-timers'):
+        self.name = name
+        self._condition = threading.Condition()
+        # (when, sequence number, TimerHandle), soonest first
+        self._queue = []
+        self._sequence = itertools.count()
+        self._thread = None
+    def call_later(self, delay, callback):
+        handle = TimerHandle(callback)
+        with self._condition:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            else:
+                self._condition.notify()
+        return handle
+    def _next_due(self):
+        '''Waits for the next call that's due and returns it, or None once there are none left'''
+        with self._condition:
+            while self._queue:
+                when, _, handle = self._queue[0]
+                if handle.cancelled:
+                    heapq.heappop(self._queue)
+                    continue
+                remaining = when - time.monotonic()
+                if remaining <= 0:
+                    heapq.heappop(self._queue)
+                    return handle
+                self._condition.wait(remaining)
+            self._thread = None
+            return None
+    def _run(self):
+        while True:
+            handle = self._next_due()
+            if handle is None:
+                return
+            try:
+                handle.callback()
+            except Exception:
+                error(f"Exception in timer callback {handle.callback!r}", exc_info=True)
+
+def _target_reached(target, current_value):
+    if 'test' in target:
+        return target['test'](current_value, target['value'])
+    return current_value == target['value']
 
-class INDIClient:
+class PropertyWaiter:
+    '''
+    Tracks the properties a `wait_for_properties` call is still missing,
+    resolving `future` (if given) when the last one is defined
+    '''
+    def __init__(self, missing, future=None):
+        self.missing = missing
+        self.future = future
+    def property_defined(self, key):
+        self.missing.discard(key)
+        if not self.missing and self.future is not None and not self.future.done():
+            self.future.set_result(None)
+
+class PendingCommand:
+    '''
+    A command sent to a property, waiting on the server's next
+    ``set*Vector`` for it. `future` gets the `Property` once that reports
+    Ok or Idle, or an exception for Alert or if `timeout_handle` fires first.
+    '''
+    def __init__(self, prop, future):
+        self.property = prop
+        self.future = future
+        self.timeout_handle = None
+    def _finish(self, result=None, exception=None):
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+        if self.future.done():  # e.g. cancelled by whoever was waiting
+            return
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(result)
+    def settle(self, state, message):
+        if state is PropertyState.ALERT:
+            self._finish(exception=RuntimeError(
+                f"{self.property.identifier} went to Alert state"
+                + (f": {message}" if message else "")
+            ))
+        else:
+            self._finish(result=self.property)
+
+class SerializationCache:
+    '''
+    Mixin caching `to_jsonable` and `to_json` (built by `_build_jsonable`
+    and `_build_json`) until `_invalidate_json` is called, which also
+    invalidates the object containing this one. The cached structures
+    are shared between callers, so don't modify them.
+    '''
+    __slots__ = ('_json_version', '_jsonable_cache', '_json_cache')
+    def __init__(self):
+        self._json_version = 0
+        self._jsonable_cache = self._json_cache = None
+    def _json_container(self):
+        return None
+    def _invalidate_json(self):
+        self._json_version += 1
+        container = self._json_container()
+        if container is not None:
+            container._invalidate_json()
+    def to_jsonable(self):
+        # tagged with the version it was built from, so an update
+        # arriving mid-build can't leave a stale result cached
+        cached = self._jsonable_cache
+        if cached is not None and cached[0] == self._json_version:
+            return cached[1]
+        version = self._json_version
+        jsonable = self._build_jsonable()
+        self._jsonable_cache = (version, jsonable)
+        return jsonable
+    def to_json(self):
+        '''Same as ``json.dumps(self.to_jsonable(), sort_keys=True)``, but cached'''
+        cached = self._json_cache
+        if cached is not None and cached[0] == self._json_version:
+            return cached[1]
+        version = self._json_version
+        serialized = self._build_json()
+        self._json_cache = (version, serialized)
+        return serialized
+
+def _join_json_members(members):
+    '''Stitches a JSON object together from a dict of name -> serialized value'''
+    return '{' + ', '.join(f'{json.dumps(name)}: {members[name]}' for name in sorted(members)) + '}'
+
+# what every Watchable starts out with, so those nobody watches share one
+NO_WATCHERS = frozenset()
+# what a Property's changed_* sets hold when nothing changed
+NOTHING_CHANGED = frozenset()
+# an Element's `_unrecorded_time` when its value is already in its history
+NOT_RECORDED = object()
+
+class Watchable:
+    '''
+    Mixin for the objects watcher callbacks can be attached to, which
+    are expected to start ``watchers`` out as `NO_WATCHERS`. Adding or
+    removing a watcher replaces the frozenset, under the client's
+    ``watcher_set_lock``, so notifying needn't lock anything and
+    watchers can add or remove watchers themselves.
+    '''
+    __slots__ = ()
+    def add_watcher(self, watcher_callback, dispatch=False,
+                    max_pending=DEFAULT_MAX_PENDING, overflow=OverflowPolicy.DROP_OLDEST):
+        '''
+        Call `watcher_callback` whenever this object is updated. With
+        ``dispatch=True`` it runs on the client's `WatcherDispatcher`
+        pool instead of the thread receiving updates, with at most
+        `max_pending` notifications queued and `overflow` deciding what
+        happens to the rest
+        '''
+        if dispatch:
+            watcher_callback = self._client.dispatcher.wrap(
+                watcher_callback,
+                max_pending=max_pending,
+                overflow=overflow
+            )
+        with self._client.watcher_set_lock:
+            self.watchers = self.watchers | {watcher_callback}
+    def remove_watcher(self, watcher_callback):
+        with self._client.watcher_set_lock:
+            if watcher_callback not in self.watchers:
+                raise KeyError(watcher_callback)
+            self.watchers = self.watchers - {watcher_callback}
+    def _notify_watchers(self, *args):
+        watchers = self.watchers
+        if not watchers:
+            return
+        stats = self._client._stats
+        if stats is None:
+            for watcher in watchers:
+                watcher(*args)
+            return
+        started = time.perf_counter()
+        for watcher in watchers:
+            watcher(*args)
+        stats.watched(len(watchers), time.perf_counter() - started)
+
+class INDIClient(Watchable, SerializationCache):
     QUEUE_CLASS = queue.Queue
-    def __init__(self, host, port):
+    def __init__(self, host, port, epoch_timestamps=False,
+                 history_dir=None, history_max_records=DEFAULT_MMAP_HISTORY_RECORDS,
+                 history_policies=None, history_max_bytes=None,
+                 dispatcher=None, flush_interval=0, subscriptions=None, collect_stats=False):
+        '''
+        Pass ``epoch_timestamps=True`` to store property and history
+        timestamps as float seconds since the epoch rather than
+        `datetime` instances, which are much cheaper to decode
+
+        Pass a directory as `history_dir` to keep the histories of
+        number elements in memory-mapped files there (one per element,
+        holding up to `history_max_records` samples, unless a
+        `history_policies` pattern says otherwise) instead of on the heap
+
+        `history_policies` maps glob patterns on element identifiers to
+        how many samples to keep (0 for none), first match winning, and
+        `history_max_bytes` caps the in-memory histories in total, by
+        clearing the least recently read. See `HistoryManager`.
+
+        Watchers added with ``dispatch=True`` run on `dispatcher`, which
+        is a `WatcherDispatcher` with default settings unless you supply one
+
+        Outbound messages that are queued together are sent together.
+        Set `flush_interval` (in seconds) to have the sender wait up to
+        that long after the first message to collect more.
+
+        To only receive some of what the server has, give an iterable
+        of ``device`` and ``device.property`` strings as `subscriptions`.
+        Only those are requested from the server, and anything else
+        that arrives is skipped by the parser.
+
+        Pass ``collect_stats=True`` to count and time what the client
+        does, for `stats` to report
+        '''
+        super().__init__()
         self.host, self.port = host, port
+        self.subscriptions = parse_subscriptions(subscriptions) if subscriptions is not None else None
+        self.epoch_timestamps = epoch_timestamps
+        self.history_dir = history_dir
+        self.history_max_records = history_max_records
+        self.history_manager = HistoryManager(history_policies, history_max_bytes)
         self.status = ConnectionStatus.STARTING
+        # guards the watchers of the client and everything in it
         self.watcher_set_lock = threading.Lock()
         self._outbound_queue = self.QUEUE_CLASS()
         self._inbound_queue = self.QUEUE_CLASS()
-        self._parser = INDIStreamParser(self._inbound_queue)
+        self._new_parser()
         self.devices = {}
+        # dotted identifier -> Property / Element, kept up to date as
+        # properties are defined and deleted
+        self._property_index = {}
+        self._element_index = {}
+        self._batch_state = threading.local()
+        # (device name, property name) -> list of PropertyWaiters
+        self._property_waiters = {}
+        self._property_waiter_condition = threading.Condition()
+        self.flush_interval = flush_interval
+        self._flush_counters = {
+            'flushes': 0,
+            'messages': 0,
+            'bytes': 0,
+            'max_messages_per_flush': 0,
+        }
         self._writer = self._reader = None
-        self.watchers = set()
-    def has_properties(self, properties):
-        property_specs = [property_spec.split('.') for property_spec in properties]
+        self.reconnect_automatically = False
+        self._stopping = threading.Event()
+        self._resync_started = None
+        self._last_def_received = None
+        # resolves to a summary once the initial sync is over, see start()
+        self.synced = None
+        self._sync_started = None
+        self._sync_definitions = 0
+        self.watchers = NO_WATCHERS
+        self._dispatcher = dispatcher
+        self._stats = ClientStats() if collect_stats else None
+        # guards every Property's list of PendingCommands
+        self._command_lock = threading.Lock()
+        self._timers = Timers()
+    @property
+    def _client(self):
+        return self
+    @property
+    def dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = WatcherDispatcher()
+        return self._dispatcher
+    def _parse_property_specs(self, properties):
+        property_specs = [tuple(property_spec.split('.')) for property_spec in properties]
         if not all(map(lambda x: x == 2, map(len, property_specs))):
             raise ValueError("The `properties` arg must be an iterable of strings in the format ``device_name.property_name``")
-        has_all = True
-        for device_name, property_name in property_specs:
-            if device_name not in self.devices:
-                has_all = False
-            else:
-                if property_name not in self.devices[device_name].properties:
-                    has_all = False
-        return has_all
+        return property_specs
+    def _missing_properties(self, property_specs):
+        return {
+            (device_name, property_name)
+            for device_name, property_name in property_specs
+            if device_name not in self.devices or property_name not in self.devices[device_name].properties
+        }
+    def has_properties(self, properties):
+        return not self._missing_properties(self._parse_property_specs(properties))
+    def _add_property_waiter(self, waiter):
+        for key in waiter.missing:
+            self._property_waiters.setdefault(key, []).append(waiter)
+    def _remove_property_waiter(self, waiter):
+        for key in waiter.missing:
+            waiters = self._property_waiters.get(key, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._property_waiters.pop(key, None)
+    def _property_defined(self, device_name, property_name):
+        '''Called by `Device.apply_update` to wake up anyone waiting on this property'''
+        key = device_name, property_name
+        # checked under the lock, or a waiter that has just found the
+        # property missing could register after we looked and never wake
+        with self._property_waiter_condition:
+            if not self._property_waiters:
+                return
+            waiters = self._property_waiters.pop(key, None)
+            if waiters:
+                for waiter in waiters:
+                    waiter.property_defined(key)
+                self._property_waiter_condition.notify_all()
     def wait_for_properties(self, properties, timeout=None):
         '''
         Supply an iterable of ``device_name.property_name`` strings
         and optionally a `timeout` in seconds, and this function will block
         until they are all available. Returns number of seconds it took, in case you're curious.
         '''
-        ready = False
-        started = time.time()
-        elapsed = 0
-        while not ready:
-            has_all = self.has_properties(properties)
-            if has_all:
-                ready = True
-            else:
-                elapsed = time.time() - started
-                debug(f'{elapsed} sec elapsed, timeout is {timeout}')
-                if timeout is None or elapsed < timeout:
-                    time.sleep(0.1)
-                else:
+        property_specs = self._parse_property_specs(properties)
+        started = time.monotonic()
+        with self._property_waiter_condition:
+            waiter = PropertyWaiter(self._missing_properties(property_specs))
+            if waiter.missing:
+                self._add_property_waiter(waiter)
+                try:
+                    ready = self._property_waiter_condition.wait_for(lambda: not waiter.missing, timeout)
+                finally:
+                    self._remove_property_waiter(waiter)
+                if not ready:
                     raise TimeoutError(f"Timed out waiting for properties: {properties}")
-        return time.time() - started
-    def add_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.add(watcher_callback)
-    def remove_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.remove(watcher_callback)
+        return time.monotonic() - started
     def get_properties(self):
-        self._outbound_queue.put_nowait({'action': INDIActions.GET_PROPERTIES})
+        if self.subscriptions is None:
+            self._outbound_queue.put_nowait({'action': INDIActions.GET_PROPERTIES})
+            return
+        for device_name, property_names in self.subscriptions.items():
+            if property_names is None:
+                self._outbound_queue.put_nowait({'action': INDIActions.GET_PROPERTIES, 'device': device_name})
+                continue
+            for property_name in sorted(property_names):
+                self._outbound_queue.put_nowait({
+                    'action': INDIActions.GET_PROPERTIES,
+                    'device': device_name,
+                    'name': property_name,
+                })
+    def _drain_outbound(self, first_item):
+        '''
+        Collects `first_item` plus whatever else is already waiting in
+        the outbound queue (or arrives within ``flush_interval``)
+        '''
+        items = [first_item]
+        if self.flush_interval > 0:
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._outbound_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        while True:
+            try:
+                items.append(self._outbound_queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+    def _encode_outbound(self, items):
+        '''
+        Encodes queued mutations (and batches of them) into one buffer,
+        returns it along with the number of messages it holds
+        '''
+        mutations = []
+        for item in items:
+            if isinstance(item, list):
+                mutations.extend(item)
+            else:
+                mutations.append(item)
+        return mutations_to_xml_message(mutations), len(mutations)
+    def _record_flush(self, n_messages, n_bytes):
+        if self._stats is not None:
+            self._stats.sent(n_messages)
+        counters = self._flush_counters
+        counters['flushes'] += 1
+        counters['messages'] += n_messages
+        counters['bytes'] += n_bytes
+        counters['max_messages_per_flush'] = max(counters['max_messages_per_flush'], n_messages)
+    def flush_stats(self):
+        '''Counters describing how outbound messages have been coalesced into writes'''
+        stats = dict(self._flush_counters)
+        flushes = stats['flushes']
+        stats['messages_per_flush'] = stats['messages'] / flushes if flushes else 0.0
+        stats['bytes_per_flush'] = stats['bytes'] / flushes if flushes else 0.0
+        return stats
     def _handle_outbound(self, current_socket):
         self.get_properties()
-        while not self.status == ConnectionStatus.STOPPED:
+        while self.status is ConnectionStatus.CONNECTED:
             try:
-                mutation = self._outbound_queue.get(timeout=SYNCHRONIZATION_TIMEOUT)
+                first_item = self._outbound_queue.get(timeout=SYNCHRONIZATION_TIMEOUT)
             except queue.Empty:
                 continue
-            debug(f"Issuing mutation:\n{pformat(mutation)}")
-            outdata = mutation_to_xml_message(mutation)
-            debug(f"XML for mutation:\n{outdata.decode('utf8')}")
+            outdata, n_messages = self._encode_outbound(self._drain_outbound(first_item))
+            debug("Sending %d messages (%d bytes)", n_messages, len(outdata))
             try:
                 current_socket.sendall(outdata)
-            except Exception:
+            except Exception as e:
+                if self.status is ConnectionStatus.STOPPED:
+                    return
                 self.status = ConnectionStatus.ERROR
+                if self.reconnect_automatically:
+                    warn(f"Dropped {n_messages} messages, failed to send: {e!r}")
+                    return
                 raise
+            self._record_flush(n_messages, len(outdata))
     def _handle_inbound(self, current_socket):
-        while not self.status == ConnectionStatus.STOPPED:
+        # one reusable buffer, replaced only when the read size outgrows it
+        read_size = AdaptiveReadSize()
+        buffer = bytearray(read_size.size)
+        view = memoryview(buffer)
+        while self.status is ConnectionStatus.CONNECTED:
+            if self._resync_started is not None:
+                self._finish_resync_if_quiet()
+            if self._sync_started is not None:
+                # wake up in time to notice the definitions have stopped
+                remaining = self._finish_sync_if_quiet()
+                current_socket.settimeout(
+                    SYNCHRONIZATION_TIMEOUT if remaining is None else min(remaining, SYNCHRONIZATION_TIMEOUT)
+                )
+            if len(buffer) < read_size.size:
+                buffer = bytearray(read_size.size)
+                view = memoryview(buffer)
             try:
-                data = current_socket.recv(CHUNK_MAX_READ_SIZE)
+                n_bytes = current_socket.recv_into(buffer, read_size.size)
             except socket.timeout:
                 continue
             except Exception:
+                if self.status is ConnectionStatus.STOPPED:
+                    return
                 self.status = ConnectionStatus.ERROR
                 raise
-            debug(f"Feeding to parser: {repr(data)}")
-            self._parser.parse(data)
+            if n_bytes == 0:
+                if self.status is not ConnectionStatus.STOPPED:
+                    info(f"Got EOF from {self.host}:{self.port}")
+                    self.status = ConnectionStatus.ERROR
+                return
+            read_size.observe(n_bytes)
+            debug("Feeding %d bytes to parser", n_bytes)
+            self._parse(self._parser, view[:n_bytes])
             while not self._inbound_queue.empty():
                 update = self._inbound_queue.get_nowait()
-                debug(f"Got update:\n{pformat(update)}")
-                self.apply_update(update)
-    def start(self):
+                if debug_enabled():
+                    debug("Got update:\n%s", pformat(update))
+                self._apply_inbound(update)
+    def _parse(self, parser, data):
+        stats = self._stats
+        if stats is None:
+            parser.parse(data)
+            return
+        started = time.perf_counter()
+        parser.parse(data)
+        stats.parsed(len(data), time.perf_counter() - started)
+    def _apply_inbound(self, update):
+        '''`apply_update` for updates from the server, timed if collecting stats'''
+        stats = self._stats
+        if stats is None:
+            return self.apply_update(update)
+        started = time.perf_counter()
+        did_anything_change = self.apply_update(update)
+        stats.applied(update, time.perf_counter() - started)
+        return did_anything_change
+    def stats(self):
+        '''
+        Counters, queue depths and latency histograms (in seconds) for
+        parsing, applying updates and running watchers. The update
+        timings include the watchers they set off.
+        '''
+        if self._stats is None:
+            raise RuntimeError("Not collecting stats, pass collect_stats=True to the client")
+        result = self._stats.to_dict()
+        result['inbound_queue_depth'] = self._inbound_queue.qsize()
+        result['outbound_queue_depth'] = self._outbound_queue.qsize()
+        result['flushes'] = self.flush_stats()
+        result['history'] = self.history_manager.stats()
+        return result
+    def _receive_and_reconnect(self):
+        '''Receiver thread: reads from the server, reconnecting if it should'''
+        try:
+            while True:
+                try:
+                    self._handle_inbound(self._socket)
+                except Exception as e:
+                    if not self.reconnect_automatically:
+                        raise
+                    warn(f"Lost connection to {self.host}:{self.port}: {e!r}")
+                if self.status is ConnectionStatus.STOPPED or not self.reconnect_automatically:
+                    return
+                if not self._reconnect():
+                    return
+        finally:
+            self._abandon_sync()
+    def _reconnect(self):
+        '''
+        Retries the connection with exponential backoff until it comes
+        back (returning True) or the client is stopped (returning False)
+        '''
+        self.status = ConnectionStatus.RECONNECTING
+        self._socket.close()
+        if self._writer is not None:
+            self._writer.join()
+        delay = RECONNECT_INITIAL_DELAY
+        while True:
+            info(f"Reconnecting to {self.host}:{self.port} in {delay} sec")
+            if self._stopping.wait(delay):
+                return False
+            try:
+                self._connect()
+            except OSError as e:
+                warn(f"Reconnection to {self.host}:{self.port} failed: {e!r}")
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            if self._stopping.is_set():
+                # stop() came in while we were connecting
+                self._socket.close()
+                self.status = ConnectionStatus.STOPPED
+                return False
+            self._begin_resync()
+            self._start_writer()
+            return True
+    def _begin_resync(self):
+        '''
+        Marks every known property stale, until the server redefines it.
+        Any still stale once def messages stop arriving are deleted.
+        '''
+        for device in self.devices.values():
+            for prop in device.properties.values():
+                prop.stale = True
+        self._resync_started = self._last_def_received = time.monotonic()
+    def _finish_resync_if_quiet(self):
+        if time.monotonic() - self._last_def_received < RESYNC_QUIET_PERIOD:
+            return
+        self._resync_started = None
+        for device_name, device in list(self.devices.items()):
+            stale = [name for name, prop in device.properties.items() if prop.stale]
+            if not stale:
+                continue
+            info(f"Removing {len(stale)} properties of {device_name} not redefined after reconnecting")
+            if len(stale) == len(device.properties):
+                self.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': device_name})
+                continue
+            for property_name in stale:
+                self.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': device_name, 'name': property_name})
+    def _begin_sync(self):
+        '''
+        Starts applying definitions without notifying any watchers,
+        until they stop arriving and `synced` is resolved
+        '''
+        self.synced = self._new_command_future()
+        self._sync_definitions = 0
+        self._sync_started = self._last_def_received = time.monotonic()
+    def _finish_sync_if_quiet(self):
+        '''
+        Ends the initial sync if definitions have stopped arriving,
+        otherwise returns how long until they'll have been quiet for
+        long enough
+        '''
+        remaining = SYNC_QUIET_PERIOD - (time.monotonic() - self._last_def_received)
+        if remaining > 0:
+            return remaining
+        summary = {
+            'devices': len(self.devices),
+            'properties': len(self._property_index),
+            'elements': len(self._element_index),
+            'definitions': self._sync_definitions,
+            'elapsed': self._last_def_received - self._sync_started,
+        }
+        self._sync_started = None
+        info(
+            f"Synchronized {summary['properties']} properties of {summary['devices']} "
+            f"devices in {summary['elapsed']:.3f} sec"
+        )
+        self.synced.set_result(summary)
+        return None
+    def _abandon_sync(self):
+        if self._sync_started is None:
+            return
+        self._sync_started = None
+        if self.status is ConnectionStatus.STOPPED:
+            self.synced.cancel()
+        else:
+            self.synced.set_exception(ConnectionError(
+                f"Lost connection to {self.host}:{self.port} before the initial sync was over"
+            ))
+    def _connect(self):
+        new_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            new_socket.connect((self.host, self.port))
+        except OSError:
+            new_socket.close()
+            raise
+        new_socket.settimeout(SYNCHRONIZATION_TIMEOUT)
+        # we do our own coalescing of outbound messages
+        new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket = new_socket
+        # don't carry a half-parsed message over from the last connection
+        self._new_parser()
+        self.status = ConnectionStatus.CONNECTED
+        debug(f"Connected to {self.host}:{self.port}")
+    def _start_writer(self):
+        self._writer = threading.Thread(
+            target=self._handle_outbound,
+            name='INDIClient-sender',
+            daemon=True,
+            args=(self._socket,)
+        )
+        self._writer.start()
+    def start(self, reconnect_automatically=False, initial_sync=False):
+        '''
+        Connects to the server and starts the sender and receiver
+        threads. With ``reconnect_automatically=True``, a lost
+        connection is retried with exponential backoff, and the device
+        tree is kept and resynchronized against the server's
+        definitions once it's back, removing properties it no longer has.
+
+        With ``initial_sync=True``, the flood of definitions the server
+        sends on connecting is applied without calling any watchers
+        (set messages and our own changes are reported as usual). Once
+        no definition has arrived for `SYNC_QUIET_PERIOD` seconds, the
+        `synced` future resolves to a dict counting the ``devices``,
+        ``properties`` and ``elements`` loaded and the ``definitions``
+        applied, along with the seconds it took (``elapsed``), and
+        definitions are reported to watchers again from then on.
+
+        >>> c.start(initial_sync=True)
+        >>> c.synced.result(timeout=30)
+        '''
         if self.status is not ConnectionStatus.CONNECTED:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.reconnect_automatically = reconnect_automatically
+            self._stopping.clear()
             try:
-                self._socket.connect((self.host, self.port))
-            except ConnectionRefusedError as e:
+                self._connect()
+            except OSError as e:
                 self.status = ConnectionStatus.ERROR
-                error(f"Connection refused: {e}")
+                error(f"Connection failed: {e}")
                 raise
-            self._socket.settimeout(SYNCHRONIZATION_TIMEOUT)
-            debug("connected")
-            self.status = ConnectionStatus.CONNECTED
-            debug(f"Connected to {self.host}:{self.port}")
-            self._writer = threading.Thread(
-                target=self._handle_outbound,
-                name='INDIClient-sender',
-                daemon=True,
-                args=(self._socket,)
-            )
-            self._writer.start()
+            if initial_sync:
+                self._begin_sync()
+            self._start_writer()
             self._reader = threading.Thread(
-                target=self._handle_inbound,
+                target=self._receive_and_reconnect,
                 name='INDIClient-receiver',
                 daemon=True,
-                args=(self._socket,)
             )
             self._reader.start()
     def stop(self):
+        # n.b. order matters, see _reconnect
+        self._stopping.set()
         self.status = ConnectionStatus.STOPPED
         if self._reader is not None:
             self._reader.join()
@@ -149,14 +765,40 @@ class INDIClient:
         if self._writer is not None:
             self._writer.join()
             self._writer = None
+        self._close_histories()
+    def _close_histories(self):
+        for device in self.devices.values():
+            for prop in device.properties.values():
+                prop._close_histories()
     def _new_parser(self):
-        self._parser = INDIStreamParser(self._inbound_queue)
+        self._parser = INDIStreamParser(
+            self._inbound_queue,
+            epoch_timestamps=self.epoch_timestamps,
+            subscriptions=self.subscriptions,
+        )
+    def new_element_history(self, element):
+        on_disk = self.history_dir is not None and isinstance(element, NumberElement)
+        max_history = self.history_manager.max_history_for(
+            element.identifier,
+            default=self.history_max_records if on_disk else None,
+        )
+        if max_history == 0:
+            return element.DISABLED_HISTORY
+        if on_disk:
+            filename = element.identifier.replace(os.sep, '_') + '.history'
+            return MmapElementHistory(
+                element,
+                os.path.join(self.history_dir, filename),
+                max_records=max_history,
+            )
+        return self.history_manager.adopt(element.HISTORY_CLASS(element, max_history=max_history))
     def get_or_create_device(self, device_name):
         if device_name in self.devices:
             device = self.devices[device_name]
         else:
             device = Device(device_name, self)
             self.devices[device_name] = device
+            self._invalidate_json()
         return device
     def apply_update(self, update):
         '''
@@ -168,38 +810,119 @@ class INDIClient:
         device_name = update['device']
         did_anything_change = False
         if update['action'] is INDIActions.PROPERTY_DEF:
+            if self._resync_started is not None or self._sync_started is not None:
+                self._last_def_received = time.monotonic()
+                self._sync_definitions += 1
             the_device = self.get_or_create_device(device_name)
+            property_name = update['property']['name']
+            existing_prop = the_device.properties.get(property_name)
+            resynced = existing_prop is not None and existing_prop.stale
+            self._unindex_property(the_device, property_name)
             did_anything_change = the_device.apply_update(update)
+            self._index_property(the_device, property_name)
             debug("Finished apply_update on device")
+            if resynced and not did_anything_change:
+                return False  # nothing to tell anyone after reconnecting
         elif update['action'] in (INDIActions.PROPERTY_SET, INDIActions.PROPERTY_NEW):
             if device_name in self.devices:
                 did_anything_change = self.devices[device_name].apply_update(update)
             else:
-                debug(f"got an update for a property "
-                      f"on a device we never saw defined: {update}")
+                debug("got an update for a property on a device we never saw defined: %s", update)
                 return False
         elif update['action'] is INDIActions.PROPERTY_DEL:
             if update['device'] not in self.devices:
                 did_anything_change = False
             else:
+                the_device = self.devices[update['device']]
                 if 'name' in update:
                     # delete one property
-                    self.devices[update['device']].apply_update(update)
+                    self._unindex_property(the_device, update['name'])
+                    the_device.apply_update(update)
                 else:
+                    for property_name, prop in the_device.properties.items():
+                        self._unindex_property(the_device, property_name)
+                        prop._abandon_commands()
+                        prop._close_histories()
                     del self.devices[update['device']]
+                    self._invalidate_json()
                 did_anything_change = True
-        with self.watcher_set_lock:
-            for watcher in self.watchers:
-                watcher(update, did_anything_change)
+        if not self._is_initial_definition(update):
+            self._notify_watchers(update, did_anything_change)
+        return did_anything_change
+    def _is_initial_definition(self, update):
+        '''Whether `update` is part of the initial sync, which watchers don't hear about'''
+        return self._sync_started is not None and update['action'] is INDIActions.PROPERTY_DEF
+    def _index_property(self, device, property_name):
+        prop = device.properties.get(property_name)
+        if prop is None:
+            return
+        self._property_index[prop.identifier] = prop
+        for element in prop.elements.values():
+            self._element_index[element.identifier] = element
+    def _unindex_property(self, device, property_name):
+        prop = device.properties.get(property_name)
+        if prop is None:
+            return
+        self._property_index.pop(prop.identifier, None)
+        for element in prop.elements.values():
+            self._element_index.pop(element.identifier, None)
+    def _new_command_future(self):
+        return concurrent.futures.Future()
+    def _call_later(self, delay, callback):
+        '''Calls `callback` after `delay` seconds, returning something with a ``cancel()``'''
+        return self._timers.call_later(delay, callback)
+    def _apply_mutation(self, mutation):
+        '''
+        Applies one of our own `PropertyMutation`s, as `apply_update`
+        would the equivalent new message
+        '''
+        device = self.devices.get(mutation.device)
+        did_anything_change = device._apply_mutation(mutation) if device is not None else False
+        self._notify_watchers(mutation, did_anything_change)
         return did_anything_change
     def mutate(self, update):
-        self.apply_update(update)
+        if isinstance(update, PropertyMutation):
+            self._apply_mutation(update)
+        else:
+            self.apply_update(update)
         self._outbound_queue.put_nowait(update)
-        debug(f"Enqueued mutation: {update}")
+        debug("Enqueued mutation: %s", update)
+    def _current_batch(self):
+        return getattr(self._batch_state, 'pending', None)
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Context manager collecting the element changes made in its body
+        (on this thread) and sending them when it exits, with all the
+        changes to a property in a single ``new*Vector`` message and all
+        the messages in one write. Nothing is sent if the body raises.
+        Nested batches are folded into the outermost one.
+
+        >>> with c.batch():
+        ...     c['stage.position.x'] = 1
+        ...     c['stage.position.y'] = 2
+        '''
+        if self._current_batch() is not None:
+            yield
+            return
+        self._batch_state.pending = pending = {}
+        try:
+            yield
+        finally:
+            self._batch_state.pending = None
+        mutations = [prop._new_mutation(values) for prop, values in pending.items()]
+        if not mutations:
+            return
+        for mutation in mutations:
+            self._apply_mutation(mutation)
+        self._outbound_queue.put_nowait(mutations)
+        debug(f"Enqueued batch of {len(mutations)} mutations")
     def to_dict(self):
         return {name: device.to_dict() for name, device in self.devices.items()}
-    def to_jsonable(self):
+    def _build_jsonable(self):
         return {name: device.to_jsonable() for name, device in self.devices.items()}
+    def _build_json(self):
+        return _join_json_members({name: device.to_json() for name, device in self.devices.items()})
     def __str__(self):
         str_represenation = ''
         for device_name in self.devices:
@@ -210,7 +933,70 @@ class INDIClient:
                     value = property.elements[element_name].value
                     str_represenation += f"{device_name}.{property_name}.{element_name}={value}\n"
         return str_represenation
+    def _find_element(self, key):
+        '''
+        Returns the element for a ``device.property.element`` key, or
+        None if there's no such element
+        '''
+        element = self._element_index.get(key)
+        if element is None:
+            # elements can also be created by set messages, which we
+            # don't index eagerly
+            bits = key.split('.', 2)
+            if len(bits) != 3:
+                return None
+            device_name, property_name, element_name = bits
+            device = self.devices.get(device_name)
+            prop = device.properties.get(property_name) if device is not None else None
+            element = prop.elements.get(element_name) if prop is not None else None
+            if element is not None:
+                self._element_index[key] = element
+        return element
+    def lookup_property(self, key):
+        prop = self._property_index.get(key)
+        if prop is None:
+            if '.' not in key:
+                raise KeyError(f"Expected a key like device.property, got {repr(key)}")
+            device_name, property_name = key.split('.', 1)
+            if device_name not in self.devices:
+                raise KeyError(f"Unknown device {device_name}")
+            raise KeyError(f"Unknown property {property_name} for device "
+                           f"{device_name} (valid properties are "
+                           f"{tuple(self.devices[device_name].properties.keys())})")
+        return prop
+    def select(self, pattern):
+        '''
+        Returns a list of the elements whose ``device.property.element``
+        identifiers match `pattern`, which is either a glob pattern
+        like ``'camwfs*.fps*.current'`` or a compiled regular expression.
+
+        Glob patterns are matched one level at a time, so a level
+        without wildcards is a dict lookup rather than a scan. Regular
+        expressions must match the whole identifier.
+        '''
+        if hasattr(pattern, 'fullmatch'):
+            # walk the tree rather than the index, which is missing
+            # elements created by set messages until they're looked up
+            return [
+                element
+                for device in self.devices.values()
+                for prop in device.properties.values()
+                for element in prop.elements.values()
+                if pattern.fullmatch(element.identifier)
+            ]
+        bits = pattern.split('.', 2)
+        if len(bits) != 3:
+            raise ValueError(f"Expected a pattern like device.property.element, got {repr(pattern)}")
+        device_pattern, property_pattern, element_pattern = bits
+        matches = []
+        for device in _glob_values(self.devices, device_pattern):
+            for prop in _glob_values(device.properties, property_pattern):
+                matches.extend(_glob_values(prop.elements, element_pattern))
+        return matches
     def lookup_element(self, key):
+        element = self._find_element(key)
+        if element is not None:
+            return element
         bits = key.split('.', 2)
         device_name, property_name, element_name = bits
         if device_name in self.devices:
@@ -231,18 +1017,17 @@ class INDIClient:
                            f"are {tuple(property.elements.keys())})")
         return element
     def __contains__(self, key):
-        try:
-            self.lookup_element(key)
-            return True
-        except KeyError:
-            return False
+        return self._find_element(key) is not None
     def __getitem__(self, key):
         return self.lookup_element(key).value
     def __setitem__(self, key, value):
         element = self.lookup_element(key)
         element.value = value
-    def wait_for_state(self, user_state_dict, wait_for_properties=False, timeout=None):
-        required_properties = set()
+    def _normalize_state_dict(self, user_state_dict):
+        '''
+        Returns the state dict in long form, along with the set of
+        ``device.property`` strings it refers to
+        '''
         state_dict = {}
         # enable shorthand of key: value instead of key: {'value': value}
         for key in user_state_dict:
@@ -250,79 +1035,92 @@ class INDIClient:
                 state_dict[key] = user_state_dict[key]
             else:
                 state_dict[key] = {'value': user_state_dict[key]}
-        state_reached = state_dict.copy()
-        for key, value in state_reached.items():
-            state_reached[key] = self[key] == value['value']
-            required_properties.add(key.rsplit('.', 1)[0])
-        if wait_for_properties:
-            debug(f"Waiting for properties to become available: {required_properties}")
-            self.wait_for_properties(required_properties, timeout=timeout)
+        required_properties = {key.rsplit('.', 1)[0] for key in state_dict}
+        return state_dict, required_properties
+    def _watch_for_state(self, state_dict, on_reached):
+        '''
+        Commands every element in `state_dict` that isn't at its target
+        yet, and watches their properties until all of them are, at
+        which point `on_reached` is called (once). Returns a function
+        that removes the watchers again.
+        '''
+        state_reached = {}
+        for key, target in state_dict.items():
+            state_reached[key] = _target_reached(target, self[key])
+        reached = False
+        def check_reached():
+            nonlocal reached
+            if not reached and all(state_reached.values()):
+                debug(f'Reached all of {list(state_reached)}')
+                reached = True
+                on_reached()
         def watcher_closure(the_prop, did_anything_change):
-            debug(f'in watcher_closure for {the_prop.identifier}')
             if the_prop.state is PropertyState.BUSY:
                 return
             for the_elem in the_prop.elements.values():
                 ident = the_elem.identifier
-                if ident not in state_dict:
-                    debug(f'no {ident} in {state_dict}')
-                    continue
-                value = state_dict[ident]['value']
-                if 'test' in state_dict[ident]:
-                    target_reached = state_dict[ident]['test'](the_elem.value, value)
-                else:
-                    target_reached = value == the_elem.value
-                debug(f'Touching state_reached[{repr(ident)}], was {state_reached[ident]}')
-                state_reached[ident] = target_reached
-        watched_properties = set()
-        for key, value in state_dict.items():
-            element = self.lookup_element(key)
-            if element.property not in watched_properties:
-                element.property.add_watcher(watcher_closure)
-                watched_properties.add(element.property)
-            if not state_reached[key]:
-                element.value = value['value']
-            debug(f"{element.property.name}.state={element.property.state}")
-            debug(f"new element value: {key}={value['value']}")
-            debug(f"Added watcher to element {element.identifier}")
-        ready = False
-        started = time.time()
-        elapsed = 0
-        while not ready:
-            if all(state_reached.values()):
-                debug(f'Reached all: {pformat(state_reached)}')
-                ready = True
-                break
-            else:
-                debug(f'Still waiting on wait_for_state: {pformat(state_reached)}')
-            elapsed = time.time() - started
-            debug(f'{elapsed} sec elapsed, timeout is {timeout}')
-            if timeout is None or elapsed < timeout:
-                time.sleep(0.1)
-            else:
+                if ident in state_dict:
+                    state_reached[ident] = _target_reached(state_dict[ident], the_elem.value)
+            check_reached()
+        watched_properties = []
+        for key in state_dict:
+            prop = self.lookup_element(key).property
+            if prop not in watched_properties:
+                prop.add_watcher(watcher_closure)
+                watched_properties.append(prop)
+        def stop_watching():
+            for prop in watched_properties:
+                prop.remove_watcher(watcher_closure)
+        try:
+            with self.batch():
+                for key, target in state_dict.items():
+                    if not state_reached[key]:
+                        debug(f"Commanding {key}={target['value']}")
+                        self.lookup_element(key).value = target['value']
+        except Exception:
+            stop_watching()
+            raise
+        check_reached()
+        return stop_watching
+    def wait_for_state(self, user_state_dict, wait_for_properties=False, timeout=None):
+        '''
+        Command elements to the values in `user_state_dict` (keyed by
+        ``device.property.element``) and block until the server reports
+        all of them there, or `timeout` seconds pass. Returns number of
+        seconds it took.
+        '''
+        started = time.monotonic()
+        state_dict, required_properties = self._normalize_state_dict(user_state_dict)
+        if wait_for_properties:
+            debug(f"Waiting for properties to become available: {required_properties}")
+            self.wait_for_properties(required_properties, timeout=timeout)
+        reached = threading.Event()
+        stop_watching = self._watch_for_state(state_dict, reached.set)
+        try:
+            remaining = None if timeout is None else max(timeout - (time.monotonic() - started), 0)
+            if not reached.wait(remaining):
                 raise TimeoutError(f"Timed out waiting for state: {state_dict}")
-        for propstr in required_properties:
-            devname, propname = propstr.split('.', 1)
-            self.devices[devname].properties[propname].remove_watcher(watcher_closure)
-        return time.time() - started
+        finally:
+            stop_watching()
+        return time.monotonic() - started
 
-class Device:
+class Device(Watchable, SerializationCache):
+    __slots__ = ('client_instance', 'name', 'properties', 'watchers')
     def __init__(self, name, client_instance):
+        super().__init__()
         self.client_instance = client_instance
         self.name = name
         self.properties = {}
-        self.watchers = set()
-        self.watcher_set_lock = threading.Lock()
+        self.watchers = NO_WATCHERS
+    @property
+    def _client(self):
+        return self.client_instance
     @property
     def identifier(self):
         return f'{self.name}'
-    def add_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.add(watcher_callback)
-    def remove_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.remove(watcher_callback)
     def apply_update(self, update):
         did_anything_change = False
+        resynced = False
         if update['action'] is INDIActions.PROPERTY_DEF:
             property_name = update['property']['name']
             if property_name in self.properties:
@@ -331,27 +1129,47 @@ class Device:
                 # get a del[Kind]Property for all remote drivers, we must
                 # accept redefinitions.
                 debug(f"Redefining property {self.name}.{property_name} with new def message")
-            the_prop = self.get_or_create_property(property_name, update)
-            did_anything_change = True
+            existing_prop = self.properties.get(property_name)
+            if existing_prop is not None and existing_prop.KIND is update['property']['kind']:
+                # Update the objects we have, so watchers, histories and
+                # pending commands stay put and only real changes are reported
+                resynced = existing_prop.stale
+                did_anything_change = existing_prop.apply_update(update)
+                existing_prop.stale = False
+            else:
+                self.get_or_create_property(property_name, update)
+                did_anything_change = True
+            self.client_instance._property_defined(self.name, property_name)
             debug("Finished apply_update on property")
         elif update['action'] in (INDIActions.PROPERTY_SET, INDIActions.PROPERTY_NEW):
             property_name = update['property']['name']
             if property_name in self.properties:
-                did_anything_change = self.properties[property_name].apply_update(update)
+                the_prop = self.properties[property_name]
+                did_anything_change = the_prop.apply_update(update)
+                if update['action'] is INDIActions.PROPERTY_SET:
+                    the_prop._settle_commands()
             else:
                 did_anything_change = False
-                debug(f"WARNING: got an update for a property "
-                      f"we never saw defined: {update}")
+                debug("WARNING: got an update for a property we never saw defined: %s", update)
         elif update['action'] is INDIActions.PROPERTY_DEL:
             if update['name'] in self.properties:
                 # delete one property
-                del self.properties[update['name']]
+                prop = self.properties.pop(update['name'])
+                prop._abandon_commands()
+                prop._close_histories()
+                self._invalidate_json()
                 did_anything_change = True
         else:
             raise RuntimeError("Unknown INDIAction:", update['action'])
-        with self.watcher_set_lock:
-            for watcher in self.watchers:
-                watcher(self, did_anything_change)
+        if resynced and not did_anything_change:
+            return False
+        if not self.client_instance._is_initial_definition(update):
+            self._notify_watchers(self, did_anything_change)
+        return did_anything_change
+    def _apply_mutation(self, mutation):
+        prop = self.properties.get(mutation.name)
+        did_anything_change = prop._apply_mutation(mutation) if prop is not None else False
+        self._notify_watchers(self, did_anything_change)
         return did_anything_change
     def get_or_create_property(self, property_name, update):
         kind = update['property']['kind']
@@ -367,25 +1185,28 @@ class Device:
             raise ValueError(f"Unknown property kind: {kind}")
         # Define all elements and metadata
         prop.apply_update(update)
-        # NOTE: Notable spec deviation! We attempt to cleanly migrate
-        # element histories and watchers to redefined properties
+        # NOTE: Notable spec deviation! A property redefined as a
+        # different kind gets new objects, but we attempt to cleanly
+        # migrate watchers to them (histories of the old kind are dropped)
         if property_name in self.properties:
             existing_prop = self.properties[property_name]
             prop.watchers = existing_prop.watchers
+            prop._pending_commands = existing_prop._pending_commands
+            for command in prop._pending_commands:
+                command.property = prop
             for element_name, element in existing_prop.elements.items():
-                times, values = element.history.times, element.history.values
-                if element in prop.elements:
-                    prop.elements[element].watchers = element.watchers
-                    prop.elements[element].history.times = times
-                    prop.elements[element].history.values = values
+                if element_name in prop.elements:
+                    prop.elements[element_name].watchers = element.watchers
                 else:
                     if len(element.watchers):
                         raise RuntimeError(
                             "Losing reference to watchers upon property redefinition!"
                         )
             # Delete pre-existing property instance
+            existing_prop._close_histories()
             del self.properties[property_name]
         self.properties[property_name] = prop
+        self._invalidate_json()
         return prop
     def mutate(self, update):
         self.client_instance.mutate(update)
@@ -394,47 +1215,68 @@ class Device:
             'name': self.name,
             'properties': {name: prop.to_dict() for name, prop in self.properties.items()},
         }
-    def to_jsonable(self):
+    def _json_container(self):
+        return self.client_instance
+    def _build_jsonable(self):
         return {
             'name': self.name,
             'properties': {name: prop.to_jsonable() for name, prop in self.properties.items()},
         }
+    def _build_json(self):
+        properties = _join_json_members({name: prop.to_json() for name, prop in self.properties.items()})
+        return f'{{"name": {json.dumps(self.name)}, "properties": {properties}}}'
 
-class ElementHistory:
-    def __init__(self, element, max_history=MAX_ELEMENT_HISTORY):
-        self.element = element
-        self.max_history = max_history
-        self.times, self.values = [], []
-    def add(self, timestamp, value):
-        self.times.append(timestamp)
-        self.values.append(value)
-        if len(self.times) > self.max_history:
-            self.times.pop(0)
-            self.values.pop(0)
-            assert len(self.times) <= self.max_history
-    def to_dict(self):
-        return {'times': self.times, 'values': self.values}
-    def to_jsonable(self):
-        the_dict = self.to_dict()
-        the_dict['times'] = list(map(format_datetime_as_iso, the_dict['times']))
-        the_dict['values'] = list(map(self.element._make_value_jsonable, the_dict['values']))
-        return the_dict
-
-class Element:
+class Element(Watchable):
+    HISTORY_CLASS = ElementHistory
+    DISABLED_HISTORY = DISABLED_HISTORY
+    # metadata copied over from updates by `_update_from_server`
+    UPDATABLE_ATTRIBUTES = ()
+    __slots__ = ('property', 'name', '_value', '_label', 'watchers', '_history', '_unrecorded_time')
     def __init__(self, name, parent_property):
         self.property = parent_property
         self.name = name
         self._value = None
         self._label = None
-        self.watchers = set()
-        self.watcher_set_lock = threading.Lock()
-        self.history = ElementHistory(self)
-    def add_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.add(watcher_callback)
-    def remove_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.remove(watcher_callback)
+        self.watchers = NO_WATCHERS
+        self._history = None
+        # when `_value` arrived, if it's yet to go in a history
+        self._unrecorded_time = NOT_RECORDED
+    @property
+    def history(self):
+        '''
+        This element's past values, which the client creates on first
+        use. Reading it counts as a use for the `HistoryManager`.
+        '''
+        history = self._history
+        if history is None:
+            history = self._open_history()
+        if history.manager is not None:
+            history.manager.touch(history)
+        return history
+    def _open_history(self):
+        history = self._history = self._client.new_element_history(self)
+        if self._unrecorded_time is not NOT_RECORDED:
+            history.add(self._unrecorded_time, self._value)
+            self._unrecorded_time = NOT_RECORDED
+        return history
+    def _record_history(self, value):
+        '''Records `value`, which is about to replace `_value`, in the history'''
+        history = self._history
+        if history is None:
+            if self._unrecorded_time is NOT_RECORDED:
+                # Most elements are defined and never change, so a
+                # history only comes into being once there are two
+                # samples for it (or it's read)
+                self._unrecorded_time = self.property.timestamp
+                return
+            history = self._open_history()
+        history.add(self.property.timestamp, value)
+    def _close_history(self):
+        '''Releases any file backing the history, which is reopened if it's used again'''
+        history = self._history
+        if history is not None and hasattr(history, 'close'):
+            history.close()
+            self._history = None
     def to_dict(self):
         return {
             'name': self.name,
@@ -451,19 +1293,29 @@ class Element:
         the_dict['value'] = self._make_value_jsonable(the_dict['value'])
         the_dict['history'] = self.history.to_jsonable()
         return the_dict
-    def _update_from_server(self, element_update):
-        did_anything_change = False
-        if element_update['value'] != self._value:
-            self._value = element_update['value']
-            did_anything_change = True
+    def _update_from_server(self, element_update, notify=True):
+        value = element_update['value']
+        did_anything_change = value != self._value
         if 'label' in element_update and element_update['label'] != self._label:
             self._label = element_update['label']
             did_anything_change = True
         if did_anything_change:
-            self.history.add(self.property.timestamp, self._value)
-        with self.watcher_set_lock:
-            for watcher in self.watchers:
-                watcher(self, did_anything_change)
+            self._record_history(value)
+            self._value = value
+        for key in self.UPDATABLE_ATTRIBUTES:
+            if key in element_update and element_update[key] != getattr(self, key):
+                setattr(self, key, element_update[key])
+                did_anything_change = True
+        if notify:
+            self._notify_watchers(self, did_anything_change)
+        return did_anything_change
+    def _update_value(self, value):
+        '''Like `_update_from_server`, for a new value we're sending'''
+        did_anything_change = value != self._value
+        if did_anything_change:
+            self._record_history(value)
+            self._value = value
+        self._notify_watchers(self, did_anything_change)
         return did_anything_change
     @property
     def label(self):
@@ -480,18 +1332,45 @@ class Element:
                 f"to {repr(new_value)}"
             )
         self.property.mutate(self, new_value)
+    def set(self, new_value, timeout=None):
+        '''
+        Like assigning to `value`, but returns a future that resolves
+        (to the `Property`) when the server acknowledges the change. See
+        `Property.set_many` for details.
+        '''
+        return self.property._command(lambda: setattr(self, 'value', new_value), timeout)
+    @property
+    def _client(self):
+        return self.property.device.client_instance
     @property
     def identifier(self):
         return f'{self.property.device.name}.{self.property.name}.{self.name}'
 
 class TextElement(Element):
-    pass
+    __slots__ = ()
 
 class NumberElement(Element):
-    format = "%e"
-    min = None
-    max = None
-    step = None
+    HISTORY_CLASS = NumberElementHistory
+    DISABLED_HISTORY = DISABLED_NUMBER_HISTORY
+    UPDATABLE_ATTRIBUTES = ('format', 'min', 'max', 'step')
+    __slots__ = UPDATABLE_ATTRIBUTES
+    def __init__(self, name, parent_property):
+        super().__init__(name, parent_property)
+        self.format = "%e"
+        self.min = self.max = self.step = None
+    @property
+    def value(self):
+        return self._value
+    @value.setter
+    def value(self, new_value):
+        # checked before anything changes, as the history only takes
+        # numbers; numeric strings are converted, and ints left as they are
+        if not isinstance(new_value, numbers.Real):
+            try:
+                new_value = float(new_value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Number elements take numbers, got {new_value=}") from None
+        Element.value.fset(self, new_value)
     def _make_value_jsonable(self, value):
         if value is not None and math.isfinite(value):
             return value
@@ -503,23 +1382,9 @@ class NumberElement(Element):
         result['max'] = self.max
         result['step'] = self.step
         return result
-    def _update_from_server(self, element_update):
-        did_anything_change = super()._update_from_server(element_update)
-        if 'format' in element_update and element_update['format'] != self.format:
-            self.format = element_update['format']
-            did_anything_change = True
-        if 'min' in element_update and element_update['min'] != self.min:
-            self.min = element_update['min']
-            did_anything_change = True
-        if 'max' in element_update and element_update['max'] != self.max:
-            self.max = element_update['max']
-            did_anything_change = True
-        if 'step' in element_update and element_update['step'] != self.step:
-            self.step = element_update['step']
-            did_anything_change = True
-        return did_anything_change
 
 class LightElement(Element):
+    __slots__ = ()
     @property
     def value(self):
         return self._value
@@ -528,6 +1393,7 @@ class LightElement(Element):
         raise ValueError("Clients can't change lights")
 
 class SwitchElement(Element):
+    __slots__ = ()
     def to_dict(self):
         result = super().to_dict()
         result['value'] = self.value.value
@@ -542,10 +1408,25 @@ class SwitchElement(Element):
         else:
             raise ValueError(f"Valid switch states are attributes of the SwitchState enum, got {new_value=}")
 
-class Property:
+class Property(Watchable, SerializationCache):
     ELEMENT_CLASS = Element
     KIND = None
+    # (message key, attribute) pairs copied over by `apply_update`
+    UPDATABLE_ATTRIBUTES = (
+        ('timestamp', 'timestamp'),
+        ('label', '_label'),
+        ('perm', '_perm'),
+        ('timeout', 'timeout'),
+        ('group', 'group'),
+        ('state', '_state'),
+    )
+    __slots__ = (
+        'device', 'name', 'timestamp', 'elements', '_label', '_perm', 'timeout', 'group', '_state',
+        'message', 'watchers', '_pending_commands', 'changed_attributes', 'changed_elements',
+        'removed_elements', 'stale',
+    )
     def __init__(self, name, device):
+        super().__init__()
         self.device = device
         self.name = name
         self.timestamp = None
@@ -556,14 +1437,11 @@ class Property:
         self.group = None
         self._state = None
         self.message = None
-        self.watchers = set()
-        self.watcher_set_lock = threading.Lock()
-    def add_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.add(watcher_callback)
-    def remove_watcher(self, watcher_callback):
-        with self.watcher_set_lock:
-            self.watchers.remove(watcher_callback)
+        self.watchers = NO_WATCHERS
+        self._pending_commands = []
+        self.changed_attributes = self.changed_elements = self.removed_elements = NOTHING_CHANGED
+        # set while reconnecting, until the server redefines us
+        self.stale = False
     @property
     def state(self):
         return self._state
@@ -574,8 +1452,14 @@ class Property:
     def perm(self):
         return self._perm if self._perm is not None else PropertyPerm.READ_ONLY
     @property
+    def _client(self):
+        return self.device.client_instance
+    @property
     def identifier(self):
         return f'{self.device.name}.{self.name}'
+    @property
+    def timestamp_datetime(self):
+        return timestamp_to_datetime(self.timestamp)
     def to_dict(self):
         property_dict = {
             'name': self.name,
@@ -592,10 +1476,14 @@ class Property:
         for element in self.elements:
             property_dict['elements'][element] = self.elements[element].to_dict()
         return property_dict
-    def to_jsonable(self):
+    def _json_container(self):
+        return self.device
+    def _build_json(self):
+        return json.dumps(self.to_jsonable(), sort_keys=True)
+    def _build_jsonable(self):
         property_dict = {
             'name': self.name,
-            'timestamp': format_datetime_as_iso(self.timestamp),
+            'timestamp': format_timestamp_as_iso(self.timestamp),
             'label': self._label,
             'perm': self.perm.value,
             'timeout': self.timeout,
@@ -610,97 +1498,191 @@ class Property:
         return property_dict
 
     def apply_update(self, update):
-        did_anything_change = False
-        prop = update['property']
-        if 'timestamp' in prop and prop['timestamp'] != self.timestamp:
-            self.timestamp = prop['timestamp']
-            did_anything_change = True
-        if 'label' in prop and prop['label'] != self._label:
-            self._label = prop['label']
-            did_anything_change = True
-        if 'perm' in prop and prop['perm'] != self._perm:
-            self._perm = prop['perm']
-            did_anything_change = True
-        if 'timeout' in prop and prop['timeout'] != self.timeout:
-            self.timeout = prop['timeout']
-            did_anything_change = True
-        if 'group' in prop and prop['group'] != self.group:
-            self.group = prop['group']
-            did_anything_change = True
-        if 'state' in prop and prop['state'] != self._state:
-            self._state = prop['state']
-            did_anything_change = True
+        '''
+        Applies a def, set or new message for this property, returning
+        whether it changed anything. What it changed is left in
+        `changed_attributes` (property attributes, by message key),
+        `changed_elements` (names of elements added or updated) and
+        `removed_elements` (names of elements a redefinition dropped).
 
+        A redefinition only counts as a change if something other than
+        the timestamp differs, so a driver restarting with the same
+        definitions doesn't look like every property changed.
+        '''
+        prop = update['property']
+        changed_attributes = set()
+        for key, attribute in self.UPDATABLE_ATTRIBUTES:
+            if key in prop and prop[key] != getattr(self, attribute):
+                setattr(self, attribute, prop[key])
+                changed_attributes.add(key)
+        removed_elements = set()
+        if update['action'] is INDIActions.PROPERTY_DEF:
+            for element_name in self.elements.keys() - prop['elements'].keys():
+                element = self.elements.pop(element_name)
+                element._close_history()
+                removed_elements.add(element_name)
+                if element.watchers:
+                    warn(f"Dropping watchers of {element.identifier}, which was removed by a redefinition")
+        notify = not self.device.client_instance._is_initial_definition(update)
+        # redefining a property left stale by a reconnect is only news
+        # to the watchers of what it changes
+        resyncing = self.stale and update['action'] is INDIActions.PROPERTY_DEF
+        changed_elements = set()
         for element_update in prop['elements'].values():
             el = self.get_or_create_element(element_update['name'])
-            did_element_change = el._update_from_server(element_update)
+            did_element_change = el._update_from_server(element_update, notify and not resyncing)
             assert did_element_change in (True, False), "Missing boolean return from Element._update_from_server"
-            did_anything_change = did_element_change or did_anything_change
-        with self.watcher_set_lock:
-            for watcher in self.watchers:
-                watcher(self, did_anything_change)
+            if did_element_change:
+                changed_elements.add(el.name)
+                if notify and resyncing:
+                    el._notify_watchers(el, True)
+        self._record_changes(changed_attributes, changed_elements, removed_elements)
+        if update['action'] is INDIActions.PROPERTY_DEF:
+            changed_attributes = changed_attributes - {'timestamp'}
+        did_anything_change = bool(changed_attributes or changed_elements or removed_elements)
+        if notify and (did_anything_change or not resyncing):
+            self._notify_watchers(self, did_anything_change)
+        return did_anything_change
+    def _apply_mutation(self, mutation):
+        '''
+        Applies one of our own `PropertyMutation`s, as `apply_update`
+        would the equivalent new message, without building its dicts
+        '''
+        changed_attributes = set()
+        if self._state is not PropertyState.BUSY:
+            self._state = PropertyState.BUSY
+            changed_attributes.add('state')
+        changed_elements = set()
+        for element_name, value in mutation.values.items():
+            if self.elements[element_name]._update_value(value):
+                changed_elements.add(element_name)
+        self._record_changes(changed_attributes, changed_elements, set())
+        did_anything_change = bool(changed_attributes or changed_elements)
+        self._notify_watchers(self, did_anything_change)
         return did_anything_change
+    def _record_changes(self, changed_attributes, changed_elements, removed_elements):
+        # properties that are left alone share one empty set
+        self.changed_attributes = changed_attributes or NOTHING_CHANGED
+        self.changed_elements = changed_elements or NOTHING_CHANGED
+        self.removed_elements = removed_elements or NOTHING_CHANGED
+        if changed_attributes or changed_elements or removed_elements:
+            self._invalidate_json()
     def get_or_create_element(self, element_name):
         if not element_name in self.elements:
             self.elements[element_name] = self.ELEMENT_CLASS(element_name, self)
         return self.elements[element_name]
-    def mutate(self, element, value):
-        mutation = {
-            'action': INDIActions.PROPERTY_NEW,
-            'device': self.device.name,
-            'timestamp': format_datetime_as_iso(datetime.datetime.utcnow()),
-            'property': {
-                'name': self.name,
-                'kind': self.KIND,
-                'elements': {},
-                'state': PropertyState.BUSY
-            }
-        }
+    def set_many(self, values, timeout=None):
+        '''
+        Change several elements at once, given a dict of element names
+        to new values, sending them in a single message
+
+        Returns a future (`concurrent.futures.Future`, or an `asyncio`
+        one for `AsyncINDIClient`) that resolves to this property when
+        the server's next ``set*Vector`` for it reports Ok or Idle. An
+        Alert state raises `RuntimeError` from the future instead, and
+        going `timeout` seconds without an answer raises `TimeoutError`.
+        The timeout defaults to the one the device gave in its
+        definition, if any.
+        '''
+        def send():
+            with self.device.client_instance.batch():
+                for element_name, value in values.items():
+                    self.elements[element_name].value = value
+        return self._command(send, timeout)
+    def _command(self, send, timeout):
+        client = self.device.client_instance
+        command = PendingCommand(self, client._new_command_future())
+        # registered before sending, so the reply can't beat us to it
+        with client._command_lock:
+            self._pending_commands.append(command)
+        try:
+            send()
+        except Exception:
+            with client._command_lock:
+                self._pending_commands.remove(command)
+            raise
+        if timeout is None:
+            timeout = self._default_timeout()
+        if timeout is not None and not command.future.done():
+            command.timeout_handle = client._call_later(timeout, lambda: self._expire_command(command, timeout))
+        return command.future
+    def _default_timeout(self):
+        '''The timeout from our definition in seconds, or None if it's missing, zero or nonsense'''
+        try:
+            return float(self.timeout) or None
+        except (TypeError, ValueError):
+            return None
+    def _take_commands(self, command=None):
+        with self.device.client_instance._command_lock:
+            if command is None:
+                commands, self._pending_commands = self._pending_commands, []
+                return commands
+            if command in self._pending_commands:
+                self._pending_commands.remove(command)
+                return [command]
+            return []
+    def _settle_commands(self):
+        if not self._pending_commands or self._state is PropertyState.BUSY:
+            return
+        for command in self._take_commands():
+            command.settle(self._state, self.message)
+    def _expire_command(self, command, timeout):
+        for command in self._take_commands(command):
+            command._finish(exception=TimeoutError(
+                f"No acknowledgement from {self.identifier} within {timeout} sec"
+            ))
+    def _abandon_commands(self):
+        for command in self._take_commands():
+            command._finish(exception=RuntimeError(f"{self.identifier} was deleted"))
+    def _close_histories(self):
+        for element in self.elements.values():
+            element._close_history()
+    def _new_mutation(self, values):
         # > The Client must send all members of Number and Text
         # > vectors, or may send just the members that change
         # > for other types.
         #    - INDI Whitepaper, page 4
         # "You know, it's fine to have our own standard"
         #    - Dr. Jared R. Males, 2019-11-11
-        mutation['property']['elements'][element.name] = element.to_dict()
-        # Actually encode the new value
-        mutation['property']['elements'][element.name]['value'] = value
-        self.device.mutate(mutation)
+        return PropertyMutation(self.device.name, self.name, self.KIND, values, time.time())
+    def mutate(self, element, value):
+        batch = self.device.client_instance._current_batch()
+        if batch is not None:
+            batch.setdefault(self, {})[element.name] = value
+            return
+        self.device.mutate(self._new_mutation({element.name: value}))
 
 class TextProperty(Property):
     ELEMENT_CLASS = TextElement
     KIND = INDIPropertyKind.TEXT
+    __slots__ = ()
 
 class NumberProperty(Property):
     ELEMENT_CLASS = NumberElement
     KIND = INDIPropertyKind.NUMBER
+    __slots__ = ()
 
 class SwitchProperty(Property):
     ELEMENT_CLASS = SwitchElement
     KIND = INDIPropertyKind.SWITCH
+    UPDATABLE_ATTRIBUTES = Property.UPDATABLE_ATTRIBUTES + (('rule', 'rule'),)
+    __slots__ = ('rule',)
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.rule = None
-    def apply_update(self, update):
-        did_anything_change = False
-        prop = update['property']
-        if 'rule' in prop and prop['rule'] != self.rule:
-            self.rule = prop['rule']
-            did_anything_change = True
-        did_super_change = super().apply_update(update)
-        return did_super_change or did_anything_change
     def to_dict(self):
         the_dict = super().to_dict()
         the_dict['rule'] = self.rule
         return the_dict
-    def to_jsonable(self):
-        the_dict = super().to_jsonable()
+    def _build_jsonable(self):
+        the_dict = super()._build_jsonable()
         the_dict['rule'] = self.rule.value
         return the_dict
 
 class LightProperty(Property):
     ELEMENT_CLASS = LightElement
     KIND = INDIPropertyKind.LIGHT
+    __slots__ = ()
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._perm = PropertyPerm.READ_ONLY
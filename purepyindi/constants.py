@@ -8,15 +8,20 @@ __all__ = (
     'PropertyPerm',
     'SwitchState',
     'SwitchRule',
+    'OverflowPolicy',
     'parse_string_into_enum',
     'INDI_PROTOCOL_VERSION_STRING',
     'ISO_TIMESTAMP_FORMAT',
     'DEFAULT_HOST',
     'DEFAULT_PORT',
     'CHUNK_MAX_READ_SIZE',
+    'CHUNK_LARGEST_READ_SIZE',
 )
 
+# Reads start at CHUNK_MAX_READ_SIZE bytes and grow up to
+# CHUNK_LARGEST_READ_SIZE while the server has a backlog for us
 CHUNK_MAX_READ_SIZE = 1024
+CHUNK_LARGEST_READ_SIZE = 1048576
 MAX_ELEMENT_HISTORY = 100
 
 DEFAULT_HOST = 'localhost'
@@ -68,8 +73,27 @@ class SwitchRule(Enum):
     AT_MOST_ONE = 'AtMostOne'
     ANY_OF_MANY = 'AnyOfMany'
 
+class OverflowPolicy(Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    CONFLATE_LATEST = 'conflate_latest'
+
+_ENUM_LOOKUPS = {}
+
+def enum_lookup_table(enumtype):
+    '''
+    Returns a (cached) dict mapping the string values of `enumtype`
+    members back to the members themselves
+    '''
+    try:
+        return _ENUM_LOOKUPS[enumtype]
+    except KeyError:
+        table = {entry.value: entry for entry in enumtype}
+        _ENUM_LOOKUPS[enumtype] = table
+        return table
+
 def parse_string_into_enum(string, enumtype):
-    for entry in enumtype:
-        if string == entry.value:
-            return entry
-    raise ValueError(f"No enum instance in {enumtype} for string {repr(string)}")
+    try:
+        return enum_lookup_table(enumtype)[string]
+    except (KeyError, TypeError):
+        raise ValueError(f"No enum instance in {enumtype} for string {repr(string)}") from None
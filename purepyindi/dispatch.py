@@ -0,0 +1,155 @@
+'''
+Runs watcher callbacks on a thread pool, so a slow watcher can't hold
+up the thread reading from the INDI server
+'''
+import collections
+import queue
+import threading
+import time
+import weakref
+from .constants import OverflowPolicy
+from .log import debug, error
+
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_WORKERS = 4
+
+_worker_state = threading.local()
+
+class DispatchedWatcher:
+    '''
+    Wraps a watcher callback with a bounded queue of pending
+    notifications, which the `WatcherDispatcher` workers drain in order
+
+    Compares and hashes equal to the wrapped callback, so it can be
+    removed with ``remove_watcher(callback)`` like any other watcher.
+    '''
+    def __init__(self, callback, dispatcher, max_pending=DEFAULT_MAX_PENDING,
+                 overflow=OverflowPolicy.DROP_OLDEST):
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be at least 1, got {max_pending}")
+        self.callback = callback
+        self.dispatcher = dispatcher
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.delivered = 0
+        self.dropped = 0
+        self.last_latency = 0.0
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._scheduled = False
+    def __hash__(self):
+        return hash(self.callback)
+    def __eq__(self, other):
+        if isinstance(other, DispatchedWatcher):
+            return self.callback == other.callback
+        return self.callback == other
+    def __repr__(self):
+        return f"<DispatchedWatcher for {self.callback!r}>"
+    @property
+    def pending(self):
+        return len(self._pending)
+    @property
+    def lag(self):
+        '''Seconds the oldest pending notification has been waiting'''
+        try:
+            enqueued_at, _ = self._pending[0]
+        except IndexError:
+            return 0.0
+        return time.monotonic() - enqueued_at
+    def stats(self):
+        return {
+            'callback': self.callback,
+            'pending': self.pending,
+            'lag': self.lag,
+            'last_latency': self.last_latency,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+    def __call__(self, *args):
+        with self._condition:
+            if self.overflow is OverflowPolicy.CONFLATE_LATEST:
+                if self._pending:
+                    self.dropped += len(self._pending)
+                    self._pending.clear()
+            elif len(self._pending) >= self.max_pending:
+                # A worker blocking on a queue only workers drain would deadlock
+                if self.overflow is OverflowPolicy.BLOCK and not getattr(_worker_state, 'active', False):
+                    while len(self._pending) >= self.max_pending:
+                        self._condition.wait()
+                else:
+                    self._pending.popleft()
+                    self.dropped += 1
+            self._pending.append((time.monotonic(), args))
+            needs_scheduling = not self._scheduled
+            self._scheduled = True
+        if needs_scheduling:
+            self.dispatcher._schedule(self)
+    def _run_one(self):
+        with self._condition:
+            enqueued_at, args = self._pending.popleft()
+            self._condition.notify()
+        self.last_latency = time.monotonic() - enqueued_at
+        try:
+            self.callback(*args)
+        except Exception:
+            error(f"Exception in dispatched watcher {self.callback!r}", exc_info=True)
+        self.delivered += 1
+        with self._condition:
+            if self._pending:
+                return True
+            self._scheduled = False
+            return False
+
+class WatcherDispatcher:
+    '''
+    Pool of worker threads running `DispatchedWatcher` callbacks. Each
+    watcher runs on at most one worker at a time, so it sees its
+    notifications in order, while different watchers run concurrently.
+    '''
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.n_workers = workers
+        self._ready = queue.SimpleQueue()
+        self._workers = []
+        self._watchers = weakref.WeakSet()
+        self._lock = threading.Lock()
+    def wrap(self, callback, max_pending=DEFAULT_MAX_PENDING, overflow=OverflowPolicy.DROP_OLDEST):
+        watcher = DispatchedWatcher(callback, self, max_pending=max_pending, overflow=overflow)
+        with self._lock:
+            self._watchers.add(watcher)
+        return watcher
+    def stats(self):
+        with self._lock:
+            watchers = list(self._watchers)
+        return [watcher.stats() for watcher in watchers]
+    def _schedule(self, watcher):
+        if len(self._workers) < self.n_workers:
+            self._start_workers()
+        self._ready.put(watcher)
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.n_workers:
+                worker = threading.Thread(
+                    target=self._work,
+                    name=f'INDIClient-dispatch-{len(self._workers)}',
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+    def _work(self):
+        _worker_state.active = True
+        while True:
+            watcher = self._ready.get()
+            if watcher is None:
+                debug("Watcher dispatch worker exiting")
+                return
+            if watcher._run_one():
+                # back of the line, so one busy watcher can't hog a worker
+                self._ready.put(watcher)
+    def shutdown(self, wait=True):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._ready.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
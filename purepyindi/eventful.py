@@ -1,9 +1,9 @@
 import asyncio
+import socket
 import time
 from pprint import pformat
-from .client import INDIClient
+from .client import INDIClient, AdaptiveReadSize, PropertyWaiter
 from .constants import *
-from .generator import mutation_to_xml_message
 import logging
 
 RECONNECTION_DELAY = 2
@@ -22,29 +22,62 @@ class AsyncINDIClient(INDIClient):
         and optionally a `timeout` in seconds, and this function will block
         until they are all available. Returns number of seconds it took, in case you're curious.
         '''
-        ready = False
-        started = time.time()
-        elapsed = 0
-        while not ready:
-            has_all = self.has_properties(properties)
-            if has_all:
-                ready = True
-            else:
-                elapsed = time.time() - started
-                if timeout is None or elapsed < timeout:
-                    await asyncio.sleep(1)
-                else:
-                    raise TimeoutError(f"Timed out waiting for properties: {properties}")
-        return time.time() - started
-    async def wait_for_state(self, state_dict, wait_for_properties=False, timeout=None):
-        raise NotImplementedError("Still needs async implementation!")
+        property_specs = self._parse_property_specs(properties)
+        started = time.monotonic()
+        with self._property_waiter_condition:
+            waiter = PropertyWaiter(
+                self._missing_properties(property_specs),
+                future=asyncio.get_running_loop().create_future()
+            )
+            if not waiter.missing:
+                return time.monotonic() - started
+            self._add_property_waiter(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for properties: {properties}")
+        finally:
+            with self._property_waiter_condition:
+                self._remove_property_waiter(waiter)
+        return time.monotonic() - started
+    async def wait_for_state(self, user_state_dict, wait_for_properties=False, timeout=None):
+        '''
+        Command elements to the values in `user_state_dict` (keyed by
+        ``device.property.element``) and wait until the server reports
+        all of them there, or `timeout` seconds pass. Returns number of
+        seconds it took.
+        '''
+        started = time.monotonic()
+        state_dict, required_properties = self._normalize_state_dict(user_state_dict)
+        if wait_for_properties:
+            await self.wait_for_properties(required_properties, timeout=timeout)
+        reached = asyncio.get_running_loop().create_future()
+        stop_watching = self._watch_for_state(state_dict, lambda: reached.set_result(None))
+        try:
+            remaining = None if timeout is None else max(timeout - (time.monotonic() - started), 0)
+            await asyncio.wait_for(reached, remaining)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for state: {state_dict}")
+        finally:
+            stop_watching()
+        return time.monotonic() - started
+    def _new_command_future(self):
+        return asyncio.get_running_loop().create_future()
+    def _call_later(self, delay, callback):
+        return asyncio.get_running_loop().call_later(delay, callback)
     def add_async_watcher(self, watcher_callback):
         self.async_watchers.add(watcher_callback)
     def remove_async_watcher(self, watcher_callback):
         self.async_watchers.remove(watcher_callback)
     def start(self):
         raise NotImplementedError("To start, schedule an async task for AsyncINDIClient.run")
-    async def run(self, reconnect_automatically=False):
+    async def run(self, reconnect_automatically=False, initial_sync=False):
+        '''
+        Connects and serves the connection until `stop` is called, or
+        it's lost and not ``reconnect_automatically``. See
+        `INDIClient.start` for ``initial_sync``, which applies to the
+        first connection only.
+        '''
         while self.status is not ConnectionStatus.STOPPED:
             try:
                 reader_handle, writer_handle = await asyncio.open_connection(
@@ -54,6 +87,8 @@ class AsyncINDIClient(INDIClient):
                 addr = writer_handle.get_extra_info("peername")
                 log.info(f"Connected to {addr!r}")
                 self.status = ConnectionStatus.CONNECTED
+                if initial_sync and self.synced is None:
+                    self._begin_sync()
                 self.get_properties()
                 self._reader = asyncio.ensure_future(self._handle_inbound(reader_handle))
                 self._writer = asyncio.ensure_future(self._handle_outbound(writer_handle))
@@ -72,6 +107,8 @@ class AsyncINDIClient(INDIClient):
                 raise
             finally:
                 self._cancel_tasks()
+            if self.status is ConnectionStatus.STOPPED or not reconnect_automatically:
+                self._abandon_sync()
             if reconnect_automatically:
                 self.status = ConnectionStatus.RECONNECTING
                 await asyncio.sleep(RECONNECTION_DELAY)
@@ -85,31 +122,52 @@ class AsyncINDIClient(INDIClient):
     async def stop(self):
         self.status = ConnectionStatus.STOPPED
         self._cancel_tasks()
+        self._abandon_sync()
+        self._close_histories()
     async def _handle_inbound(self, reader_handle):
+        read_size = AdaptiveReadSize()
         while self.status == ConnectionStatus.CONNECTED:
+            timeout = SOCKET_READ_TIMEOUT
+            if self._sync_started is not None:
+                remaining = self._finish_sync_if_quiet()
+                if remaining is not None:
+                    timeout = remaining
             try:
-                data = await asyncio.wait_for(reader_handle.read(CHUNK_MAX_READ_SIZE), SOCKET_READ_TIMEOUT)
+                data = await asyncio.wait_for(reader_handle.read(read_size.size), timeout)
             except asyncio.TimeoutError:
-                log.debug(f"No data for {SOCKET_READ_TIMEOUT} sec")
+                if timeout == SOCKET_READ_TIMEOUT:
+                    log.debug(f"No data for {SOCKET_READ_TIMEOUT} sec")
                 continue
             if data == b'':
                 log.debug("Got EOF from server")
                 raise ConnectionError("Got EOF from server")
-            log.debug(f"Feeding to parser: {repr(data)}")
-            self._parser.parse(data)
+            read_size.observe(len(data))
+            log.debug("Feeding %d bytes to parser", len(data))
+            self._parse(self._parser, data)
             while not self._inbound_queue.empty():
                 update = await self._inbound_queue.get()
-                log.debug(f"Got update:\n{pformat(update)}")
-                did_anything_change = self.apply_update(update)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Got update:\n%s", pformat(update))
+                did_anything_change = self._apply_inbound(update)
+                if self._is_initial_definition(update):
+                    continue
                 for watcher in self.async_watchers:
                     await watcher(update, did_anything_change)
     async def _handle_outbound(self, writer_handle):
+        sock = writer_handle.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         while self.status == ConnectionStatus.CONNECTED:
             try:
-                mutation = await self._outbound_queue.get()
-                outdata = mutation_to_xml_message(mutation)
+                items = [await self._outbound_queue.get()]
+                if self.flush_interval > 0:
+                    await asyncio.sleep(self.flush_interval)
+                while not self._outbound_queue.empty():
+                    items.append(self._outbound_queue.get_nowait())
+                outdata, n_messages = self._encode_outbound(items)
                 writer_handle.write(outdata)
                 await writer_handle.drain()
+                self._record_flush(n_messages, len(outdata))
             except asyncio.CancelledError:
                 writer_handle.close()
                 await writer_handle.wait_closed()
@@ -1,9 +1,12 @@
 import xml.etree.ElementTree as ET
 import datetime
+import functools
 import logging
+import time
 from .constants import (
     INDIPropertyKind,
     INDIActions,
+    PropertyState,
     ISO_TIMESTAMP_FORMAT,
     INDI_PROTOCOL_VERSION_STRING,
 )
@@ -16,15 +19,90 @@ KINDS_TO_NEW_TAG_NAMES = {
     INDIPropertyKind.SWITCH: ('newSwitchVector', 'oneSwitch'),
 }
 
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+_MICROSECONDS_PER_DAY = 86400 * 1000000
+# (days since epoch, 'YYYY-MM-DDT') for the last timestamp formatted
+_iso_date_prefix_cache = (None, None)
+
+class PropertyMutation:
+    '''
+    A ``new*Vector`` message we're sending: the property it's for, the
+    new values of just the elements being changed (by name), and when
+    it was made (epoch seconds). Made by `Property.mutate` and friends,
+    this is what goes through the outbound queue.
+
+    It can also be read like the update dicts the parser produces
+    (``mutation['property']['elements']`` etc.), but those are built on
+    every access, so code on a hot path should use the attributes.
+    '''
+    __slots__ = ('device', 'name', 'kind', 'values', 'timestamp')
+    action = INDIActions.PROPERTY_NEW
+    _KEYS = ('action', 'device', 'timestamp', 'property')
+    def __init__(self, device, name, kind, values, timestamp):
+        self.device = device
+        self.name = name
+        self.kind = kind
+        self.values = values
+        self.timestamp = timestamp
+    def __repr__(self):
+        return f"<PropertyMutation {self.device}.{self.name} {self.values!r}>"
+    def __getitem__(self, key):
+        if key == 'action':
+            return self.action
+        if key == 'device':
+            return self.device
+        if key == 'timestamp':
+            return format_epoch_as_iso(self.timestamp)
+        if key == 'property':
+            return {
+                'name': self.name,
+                'kind': self.kind,
+                'state': PropertyState.BUSY,
+                'elements': {
+                    element_name: {'name': element_name, 'value': value}
+                    for element_name, value in self.values.items()
+                },
+            }
+        raise KeyError(key)
+    def __contains__(self, key):
+        return key in self._KEYS
+    def get(self, key, default=None):
+        return self[key] if key in self._KEYS else default
+
 def format_datetime_as_iso(dt):
     return dt.astimezone(datetime.timezone.utc).strftime(ISO_TIMESTAMP_FORMAT)
 
+def format_epoch_as_iso(epoch_seconds):
+    global _iso_date_prefix_cache
+    days, microseconds = divmod(round(epoch_seconds * 1e6), _MICROSECONDS_PER_DAY)
+    cached_days, prefix = _iso_date_prefix_cache
+    if days != cached_days:
+        prefix = (_EPOCH_DATE + datetime.timedelta(days=days)).strftime('%Y-%m-%dT')
+        _iso_date_prefix_cache = (days, prefix)
+    seconds, microseconds = divmod(microseconds, 1000000)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{prefix}{hours:02d}:{minutes:02d}:{seconds:02d}.{microseconds:06d}Z'
+
+def format_timestamp_as_iso(timestamp):
+    '''
+    Formats either kind of timestamp the client stores (`datetime` or
+    float epoch seconds) as an ISO timestamp string
+    '''
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, datetime.datetime):
+        return format_datetime_as_iso(timestamp)
+    return format_epoch_as_iso(timestamp)
+
 def construct_property_new(mutation, timestamp):
+    if not isinstance(timestamp, str):
+        timestamp = format_timestamp_as_iso(timestamp)
     root_tag, sub_tag = KINDS_TO_NEW_TAG_NAMES[mutation['property']['kind']]
     xml_doc = ET.Element(root_tag, attrib={
         'device': mutation['device'],
         'name': mutation['property']['name'],
-        'timestamp': format_datetime_as_iso(timestamp),
+        'timestamp': timestamp,
     })
     for element in mutation['property']['elements'].values():
         sub = ET.SubElement(xml_doc, sub_tag, attrib={'name': element['name']})
@@ -50,13 +128,93 @@ def construct_get_properties(mutation):
             attribs['name'] = mutation['name']
     return ET.Element('getProperties', attrib=attribs)
 
+def escape_xml_text(text):
+    '''Escapes `text` for character data, exactly as ElementTree does'''
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def escape_xml_attribute(text):
+    '''Escapes `text` for a double-quoted attribute, exactly as ElementTree does'''
+    text = escape_xml_text(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+@functools.lru_cache(maxsize=4096)
+def property_new_template(device, name, kind, element_names):
+    '''
+    Pieces of the ``new*Vector`` message for one property and set of
+    elements: the start up to the timestamp, the rest of the opening
+    tag, and per element the start of its tag plus its closing tag
+    '''
+    root_tag, sub_tag = KINDS_TO_NEW_TAG_NAMES[kind]
+    start = f'<{root_tag} device="{escape_xml_attribute(device)}" name="{escape_xml_attribute(name)}" timestamp="'
+    elements = tuple(
+        (f'<{sub_tag} name="{escape_xml_attribute(element_name)}"', f'</{sub_tag}>')
+        for element_name in element_names
+    )
+    return start, '">', elements, f'</{root_tag}>\n'
+
+def encode_property_new(mutation, timestamp):
+    '''
+    Encodes a ``new*Vector`` mutation (a `PropertyMutation` or update
+    dict) by filling in a cached template, byte-for-byte the same as
+    serializing `construct_property_new`
+    '''
+    if isinstance(mutation, PropertyMutation):
+        device, name, kind = mutation.device, mutation.name, mutation.kind
+        element_names, values = tuple(mutation.values), mutation.values.values()
+    else:
+        prop = mutation['property']
+        device, name, kind = mutation['device'], prop['name'], prop['kind']
+        elements = prop['elements'].values()
+        element_names = tuple(element['name'] for element in elements)
+        values = [element['value'] for element in elements]
+    start, start_end, element_tags, end = property_new_template(device, name, kind, element_names)
+    parts = [start, escape_xml_attribute(timestamp), start_end]
+    for (open_tag, close_tag), value in zip(element_tags, values):
+        if kind is INDIPropertyKind.NUMBER:
+            text = str(value) if value is not None else ''
+        elif kind is INDIPropertyKind.SWITCH:
+            text = value.value
+        else:
+            text = value
+        if text:
+            parts += (open_tag, '>', escape_xml_text(text), close_tag)
+        else:
+            parts += (open_tag, ' />')
+    parts.append(end)
+    return ''.join(parts).encode('utf8')
+
 def mutation_to_xml_message(mutation, timestamp=None):
-    if timestamp is None:
-        timestamp = datetime.datetime.utcnow()
     if mutation['action'] is INDIActions.PROPERTY_NEW:
+        if timestamp is None:
+            timestamp = format_epoch_as_iso(
+                mutation.timestamp if isinstance(mutation, PropertyMutation) else time.time()
+            )
+        elif not isinstance(timestamp, str):
+            timestamp = format_timestamp_as_iso(timestamp)
+        try:
+            return encode_property_new(mutation, timestamp)
+        except (TypeError, AttributeError):
+            pass  # not a value we know how to put in the template, so let ElementTree complain
         xml_doc = construct_property_new(mutation, timestamp)
     elif mutation['action'] is INDIActions.GET_PROPERTIES:
         xml_doc = construct_get_properties(mutation)
     xml_message = ET.tostring(xml_doc, encoding='unicode')
     log.debug(xml_message)
     return xml_message.encode('utf8') + b'\n'
+
+def mutations_to_xml_message(mutations, timestamp=None):
+    return b''.join(mutation_to_xml_message(mutation, timestamp=timestamp) for mutation in mutations)
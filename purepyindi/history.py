@@ -0,0 +1,531 @@
+import array
+import collections
+import datetime
+import fnmatch
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import weakref
+from .constants import MAX_ELEMENT_HISTORY
+from .generator import format_timestamp_as_iso
+from .log import warn
+from .parser import timestamp_to_datetime
+
+DEFAULT_MMAP_HISTORY_RECORDS = 1048576  # 16 MiB of samples per element
+DEFAULT_MAX_OPEN_HISTORY_FILES = 64  # memory maps (and so file descriptors) kept open at once
+INITIAL_HISTORY_CAPACITY = 4  # samples a ring buffer starts out with room for
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _sample_nbytes(value):
+    '''Roughly what keeping `value` in a list history costs'''
+    # two list slots, plus the value itself if it's one of a kind
+    return 16 + sys.getsizeof(value) if isinstance(value, str) else 16
+
+class ElementHistory:
+    __slots__ = ('element', 'max_history', 'times', 'values', 'nbytes', 'manager', '__weakref__')
+    def __init__(self, element, max_history=MAX_ELEMENT_HISTORY):
+        self.element = element
+        self.max_history = max_history
+        self.times, self.values = [], []
+        # approximate heap footprint, and the HistoryManager it's reported to
+        self.nbytes = 0
+        self.manager = None
+    def __len__(self):
+        return len(self.times)
+    def add(self, timestamp, value):
+        self.times.append(timestamp)
+        self.values.append(value)
+        self.nbytes += _sample_nbytes(value)
+        if len(self.times) > self.max_history:
+            self.times.pop(0)
+            self.nbytes -= _sample_nbytes(self.values.pop(0))
+            assert len(self.times) <= self.max_history
+        if self.manager is not None:
+            self.manager.resized(self)
+    def _evict(self):
+        '''Drops every sample, without telling the manager'''
+        self.times, self.values = [], []
+        self.nbytes = 0
+    def times_as_datetimes(self):
+        return list(map(timestamp_to_datetime, self.times))
+    def to_dict(self):
+        return {'times': self.times, 'values': self.values}
+    def to_jsonable(self):
+        the_dict = self.to_dict()
+        the_dict['times'] = list(map(format_timestamp_as_iso, the_dict['times']))
+        the_dict['values'] = list(map(self.element._make_value_jsonable, the_dict['values']))
+        return the_dict
+
+class DisabledHistory(ElementHistory):
+    '''Stands in for the history of an element whose policy is to keep none'''
+    __slots__ = ()
+    def __init__(self):
+        super().__init__(None, max_history=0)
+    def add(self, timestamp, value):
+        pass
+    def to_jsonable(self):
+        return {'times': [], 'values': []}
+
+DISABLED_HISTORY = DisabledHistory()
+
+class NumberElementHistory(ElementHistory):
+    '''
+    Preallocated circular buffer of samples for a numeric element
+
+    Every sample is written twice, ``max_history`` slots apart, so the
+    most recent samples always form one contiguous slice of the buffer
+    and `times_array` / `values_array` can hand it out without copying.
+    Times are kept as epoch seconds and missing values as NaN. Pass
+    ``use_numpy=True`` to back the buffer with NumPy arrays instead of
+    ``array('d')``.
+
+    The buffer starts out with room for a few samples and doubles as
+    they arrive, up to ``max_history``, so the many elements that
+    rarely change don't each hold a full-size buffer.
+    '''
+    __slots__ = ('use_numpy', '_datetime_times', '_times', '_values', '_max_history', '_capacity', '_next', '_count')
+    def __init__(self, element, max_history=MAX_ELEMENT_HISTORY, use_numpy=False):
+        if use_numpy and numpy is None:
+            raise ImportError("NumPy is required for use_numpy=True")
+        if max_history < 0:
+            raise ValueError(f"max_history must be non-negative, got {max_history}")
+        self.element = element
+        self.use_numpy = use_numpy
+        self.manager = None
+        # whether to hand back datetimes from the `times` list shim
+        self._datetime_times = False
+        self._max_history = max_history
+        self._allocate(min(max_history, INITIAL_HISTORY_CAPACITY))
+    @property
+    def nbytes(self):
+        return 2 * len(self._times) * self._times.itemsize
+    def _evict(self):
+        '''Drops every sample, without telling the manager'''
+        self._allocate(min(self._max_history, INITIAL_HISTORY_CAPACITY))
+    def _allocate(self, capacity):
+        if self.use_numpy:
+            self._times = numpy.full(2 * capacity, math.nan)
+            self._values = numpy.full(2 * capacity, math.nan)
+        else:
+            self._times = array.array('d', [math.nan]) * (2 * capacity)
+            self._values = array.array('d', [math.nan]) * (2 * capacity)
+        self._capacity = capacity
+        self._next = 0
+        self._count = 0
+    def _resize(self, capacity):
+        '''Reallocate the buffer, keeping as many of the newest samples as fit'''
+        times, values = self.times_array(), self.values_array()
+        keep = min(len(times), capacity)
+        times, values = times[len(times) - keep:].tolist(), values[len(values) - keep:].tolist()
+        datetime_times = self._datetime_times
+        self._allocate(capacity)
+        for timestamp, value in zip(times, values):
+            self._append(timestamp, value)
+        self._datetime_times = datetime_times
+    @property
+    def max_history(self):
+        return self._max_history
+    @max_history.setter
+    def max_history(self, max_history):
+        '''Resize the buffer, keeping as many of the newest samples as fit'''
+        if max_history < 0:
+            raise ValueError(f"max_history must be non-negative, got {max_history}")
+        self._max_history = max_history
+        self._resize(min(max_history, max(self._count, INITIAL_HISTORY_CAPACITY)))
+        if self.manager is not None:
+            self.manager.resized(self)
+    def __len__(self):
+        return self._count
+    def _append(self, timestamp, value):
+        size = self._capacity
+        if self._count == size:
+            if size < self._max_history:
+                self._resize(min(2 * size, self._max_history))
+                size = self._capacity
+            elif size == 0:
+                return
+        idx = self._next
+        self._times[idx] = self._times[idx + size] = timestamp
+        self._values[idx] = self._values[idx + size] = value
+        idx += 1
+        self._next = 0 if idx == size else idx
+        if self._count < size:
+            self._count += 1
+    def add(self, timestamp, value):
+        if timestamp is None:
+            timestamp = math.nan
+        elif isinstance(timestamp, datetime.datetime):
+            timestamp = timestamp.timestamp()
+            self._datetime_times = True
+        capacity = self._capacity
+        self._append(timestamp, math.nan if value is None else value)
+        if self._capacity != capacity and self.manager is not None:
+            self.manager.resized(self)
+    def _window(self):
+        stop = self._next + self._capacity
+        return stop - self._count, stop
+    def times_array(self):
+        '''
+        Sample times (epoch seconds), oldest first, as a view onto the
+        buffer: it aliases storage that later samples will overwrite,
+        so copy it if you need to keep it around
+        '''
+        start, stop = self._window()
+        if self.use_numpy:
+            return self._times[start:stop]
+        return memoryview(self._times)[start:stop]
+    def values_array(self):
+        '''Sample values, oldest first, as a view like `times_array`'''
+        start, stop = self._window()
+        if self.use_numpy:
+            return self._values[start:stop]
+        return memoryview(self._values)[start:stop]
+    @property
+    def times(self):
+        times = [None if math.isnan(t) else t for t in self.times_array().tolist()]
+        if self._datetime_times:
+            times = list(map(timestamp_to_datetime, times))
+        return times
+    @property
+    def values(self):
+        return self.values_array().tolist()
+
+class MmapPool:
+    '''
+    The memory maps `MmapElementHistory` instances read and write
+    through, at most `max_open` at a time
+
+    Each map holds a file descriptor, so rather than every history
+    keeping its file mapped, the least recently used maps are closed
+    as others are opened. Hold `lock` while using a map from `mapping`,
+    as it may be closed under you otherwise.
+    '''
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_HISTORY_FILES):
+        self.max_open = max_open
+        self.lock = threading.RLock()
+        # path -> open mmap of it, least recently used first
+        self._maps = collections.OrderedDict()
+    def mapping(self, path, size):
+        '''Returns a map of the first `size` bytes of `path`, opening it if need be'''
+        the_map = self._maps.get(path)
+        if the_map is not None and len(the_map) == size:
+            self._maps.move_to_end(path)
+            return the_map
+        self.release(path)
+        while len(self._maps) >= self.max_open:
+            _, lru_map = self._maps.popitem(last=False)
+            lru_map.close()
+        with open(path, 'r+b') as f:
+            the_map = self._maps[path] = mmap.mmap(f.fileno(), size)
+        return the_map
+    def flush(self, path):
+        with self.lock:
+            the_map = self._maps.get(path)
+            if the_map is not None:
+                the_map.flush()
+    def release(self, path):
+        '''Closes the map of `path`, if it's open'''
+        with self.lock:
+            the_map = self._maps.pop(path, None)
+            if the_map is not None:
+                the_map.close()
+    def __len__(self):
+        return len(self._maps)
+
+MMAP_POOL = MmapPool()
+
+class MmapElementHistory(ElementHistory):
+    '''
+    Long-horizon history for a numeric element, kept in a
+    memory-mapped file rather than on the heap
+
+    The file holds a small header followed by fixed-size (time, value)
+    records of two little-endian doubles, written circularly so the
+    file never grows past ``max_records`` records. Times are epoch
+    seconds; samples without a timestamp are not recorded, as they
+    can't be placed in time. Assuming timestamps never go backwards,
+    `query` finds a time range by bisection. Reopening an existing file
+    with the same ``max_records`` picks up where it left off.
+
+    The file is only created once there's a sample to put in it, and
+    is mapped through `pool` (shared by default) only while in use, so
+    thousands of histories don't need thousands of file descriptors.
+    '''
+    MAGIC = b'PPINDIH1'
+    HEADER = struct.Struct('<8sQQQQ')  # magic, max records, next, count, flags
+    RECORD = struct.Struct('<dd')
+    FLAG_DATETIME_TIMES = 1
+    def __init__(self, element, path, max_records=DEFAULT_MMAP_HISTORY_RECORDS, pool=None):
+        if max_records < 1:
+            raise ValueError(f"max_records must be positive, got {max_records}")
+        self.element = element
+        self.manager = None  # it's not on the heap, so there's no budget to count it against
+        self.path = path
+        self.pool = MMAP_POOL if pool is None else pool
+        self._max_records = max_records
+        self._file_size = self.HEADER.size + max_records * self.RECORD.size
+        self._next = self._count = self._flags = 0
+        # whether the file on disk is ours to map, as opposed to
+        # missing or incompatible (and so to be created on first `add`)
+        self._created = False
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(self.HEADER.size)
+        except FileNotFoundError:
+            return
+        if len(header) == self.HEADER.size:
+            magic, existing_max_records, next_record, count, flags = self.HEADER.unpack(header)
+            if magic == self.MAGIC and existing_max_records == max_records:
+                self._next, self._count, self._flags = next_record, count, flags
+                self._created = True
+                return
+        warn(f"Discarding incompatible history file {path}")
+    @property
+    def max_history(self):
+        return self._max_records
+    def _create(self):
+        with open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as f:
+            f.truncate(0)
+            f.truncate(self._file_size)
+        self._created = True
+    def _mapping(self):
+        '''Our file's map, for use with the pool's lock held'''
+        return self.pool.mapping(self.path, self._file_size)
+    def _write_header(self, the_map):
+        self.HEADER.pack_into(the_map, 0, self.MAGIC, self._max_records, self._next, self._count, self._flags)
+    def __len__(self):
+        return self._count
+    def add(self, timestamp, value):
+        if timestamp is None:
+            return
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = timestamp.timestamp()
+            self._flags |= self.FLAG_DATETIME_TIMES
+        with self.pool.lock:
+            if not self._created:
+                self.pool.release(self.path)
+                self._create()
+            the_map = self._mapping()
+            self.RECORD.pack_into(
+                the_map, self.HEADER.size + self._next * self.RECORD.size,
+                timestamp, math.nan if value is None else value
+            )
+            self._next = (self._next + 1) % self._max_records
+            if self._count < self._max_records:
+                self._count += 1
+            self._write_header(the_map)
+    def _offset(self, idx):
+        '''Byte offset of the record `idx` samples after the oldest one'''
+        physical = (self._next - self._count + idx) % self._max_records
+        return self.HEADER.size + physical * self.RECORD.size
+    def _bisect(self, the_map, target, inclusive):
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            t = self.RECORD.unpack_from(the_map, self._offset(mid))[0]
+            if t < target or (inclusive and t == target):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+    def _records(self, the_map, first, last):
+        times, values = array.array('d'), array.array('d')
+        for idx in range(first, last):
+            t, v = self.RECORD.unpack_from(the_map, self._offset(idx))
+            times.append(t)
+            values.append(v)
+        return times, values
+    def query(self, start_time=None, end_time=None):
+        '''
+        Returns ``(times, values)`` as ``array('d')`` for the samples
+        with ``start_time <= time <= end_time`` (either bound optional),
+        reading only those records from the file
+        '''
+        if not self._count:
+            return array.array('d'), array.array('d')
+        with self.pool.lock:
+            the_map = self._mapping()
+            first = 0 if start_time is None else self._bisect(the_map, start_time, inclusive=False)
+            last = self._count if end_time is None else self._bisect(the_map, end_time, inclusive=True)
+            return self._records(the_map, first, last)
+    def recent(self, n_samples):
+        '''Returns ``(times, values)`` like `query` for the newest `n_samples`'''
+        if not self._count:
+            return array.array('d'), array.array('d')
+        with self.pool.lock:
+            return self._records(self._mapping(), max(self._count - n_samples, 0), self._count)
+    def _as_lists(self, times, values):
+        times = times.tolist()
+        if self._flags & self.FLAG_DATETIME_TIMES:
+            times = list(map(timestamp_to_datetime, times))
+        return times, values.tolist()
+    @property
+    def times(self):
+        return self._as_lists(*self.query())[0]
+    @property
+    def values(self):
+        return self.query()[1].tolist()
+    def to_dict(self):
+        # Full histories are only available through `query`, so
+        # serializing the device tree doesn't drag them onto the heap
+        times, values = self._as_lists(*self.recent(MAX_ELEMENT_HISTORY))
+        return {'times': times, 'values': values}
+    def flush(self):
+        self.pool.flush(self.path)
+    def close(self):
+        '''Unmaps the file, which is mapped again if the history is used after all'''
+        self.pool.release(self.path)
+
+class DisabledNumberHistory(NumberElementHistory):
+    '''
+    Stands in for the history of a number element whose policy is to
+    keep none, answering both like `NumberElementHistory` and like
+    `MmapElementHistory`
+    '''
+    __slots__ = ()
+    def __init__(self):
+        super().__init__(None, max_history=0)
+    def add(self, timestamp, value):
+        pass
+    def to_jsonable(self):
+        return {'times': [], 'values': []}
+    def query(self, start_time=None, end_time=None):
+        return array.array('d'), array.array('d')
+    def recent(self, n_samples):
+        return array.array('d'), array.array('d')
+    def flush(self):
+        pass
+    def close(self):
+        pass
+
+DISABLED_NUMBER_HISTORY = DisabledNumberHistory()
+
+class HistoryManager:
+    '''
+    Decides how many samples each element's history keeps and, given
+    `max_bytes`, holds the in-memory histories it adopts to that budget
+    in total
+
+    `policies` maps glob patterns on element identifiers
+    (``device.property.element``) to a maximum history length, with the
+    first one that matches deciding and 0 meaning no history at all.
+    Elements matching none get `default_max_history`. For example,
+    ``{'*.fps*.*': 10000, '*': 0}`` keeps long histories of the ``fps``
+    properties and nothing else.
+
+    When the histories outgrow `max_bytes`, the least recently read
+    ones (through `Element.history`) are cleared until they fit again,
+    starting with those never read at all. The history being added to
+    is never the one cleared. Sizes are estimates of the samples kept,
+    not counting the objects shared with the rest of the client.
+    '''
+    def __init__(self, policies=None, max_bytes=None, default_max_history=MAX_ELEMENT_HISTORY):
+        self.policies = [
+            (re.compile(fnmatch.translate(pattern)).match, max_history)
+            for pattern, max_history in (policies or {}).items()
+        ]
+        self.max_bytes = max_bytes
+        self.default_max_history = default_max_history
+        self.total_bytes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # id(history) -> (weakref to it, bytes counted for it), least
+        # recently read first, in two tiers
+        self._unread = collections.OrderedDict()
+        self._read = collections.OrderedDict()
+        # ids of histories that have been garbage collected, to be
+        # forgotten next time we hold the lock
+        self._dead = []
+    def max_history_for(self, identifier, default=None):
+        '''
+        How many samples the element `identifier` keeps, which is
+        `default` (or `default_max_history`) when no policy matches
+        '''
+        for matches, max_history in self.policies:
+            if matches(identifier):
+                return max_history
+        return self.default_max_history if default is None else default
+    def adopt(self, history):
+        '''Starts counting `history` against the budget, if there is one, and returns it'''
+        if self.max_bytes is not None:
+            history.manager = self
+            self.resized(history)
+        return history
+    def _forget_dead(self):
+        while self._dead:
+            key = self._dead.pop()
+            _, nbytes = self._unread.pop(key, None) or self._read.pop(key, (None, 0))
+            self.total_bytes -= nbytes
+    def _entry(self, history, nbytes):
+        key = id(history)
+        return weakref.ref(history, lambda ref: self._dead.append(key)), nbytes
+    def resized(self, history):
+        '''Called by an adopted history whenever its `nbytes` changes'''
+        nbytes = history.nbytes
+        with self._lock:
+            self._forget_dead()
+            key = id(history)
+            table = self._read if key in self._read else self._unread
+            if key in table:
+                ref, old_nbytes = table[key]
+                table[key] = ref, nbytes
+            else:
+                old_nbytes = 0
+                table[key] = self._entry(history, nbytes)
+            self.total_bytes += nbytes - old_nbytes
+            victims = self._choose_victims(key) if self.total_bytes > self.max_bytes else []
+        for victim in victims:
+            victim._evict()
+            if victim.element is not None:
+                # so serialized copies of the element stop showing the samples
+                victim.element.property._invalidate_json()
+    def touch(self, history):
+        '''Marks an adopted history as just read'''
+        with self._lock:
+            self._forget_dead()
+            key = id(history)
+            if key in self._read:
+                self._read.move_to_end(key)
+            elif key in self._unread:
+                self._read[key] = self._unread.pop(key)
+            else:
+                # cleared since, but it's wanted again
+                self._read[key] = self._entry(history, history.nbytes)
+                self.total_bytes += history.nbytes
+    def _choose_victims(self, keep):
+        '''Stops counting histories (other than the one with id `keep`) until we're in budget, returning them'''
+        victims = []
+        for table in (self._unread, self._read):
+            kept = None
+            while self.total_bytes > self.max_bytes and table:
+                key, entry = table.popitem(last=False)
+                if key == keep:
+                    kept = entry
+                    continue
+                ref, nbytes = entry
+                self.total_bytes -= nbytes
+                history = ref()
+                if history is not None:
+                    victims.append(history)
+            if kept is not None:
+                table[keep] = kept
+                table.move_to_end(keep, last=False)
+        self.evictions += len(victims)
+        return victims
+    def stats(self):
+        with self._lock:
+            self._forget_dead()
+            return {
+                'histories': len(self._unread) + len(self._read),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
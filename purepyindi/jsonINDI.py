@@ -1,12 +1,157 @@
 from pprint import pprint
+import fnmatch
+import math
 import sys
+import threading
 import time
-from .client import INDIClient
+from .client import INDIClient, GLOB_CHARACTERS
 from .constants import *
+from .generator import format_timestamp_as_iso
+from .stats import report_periodically
 import json
 
 c = None
 
+class DeltaStream:
+    '''
+    Writes a client's device tree to `out` as newline-delimited JSON:
+    one ``{"snapshot": ...}`` line, then a compact line per property
+    update with just the elements that changed (or ``"deleted": true``
+    when properties go away)
+
+    `device_patterns` and `property_patterns` are globs matched against
+    device names and ``device.property`` identifiers. With `max_rate`,
+    a property is written at most that many times a second, changes in
+    between being merged into its next line, which `flush_due` writes
+    once it's time.
+    '''
+    def __init__(self, client, out, device_patterns=None, property_patterns=None, max_rate=None):
+        self.client = client
+        self.out = out
+        self.device_patterns = device_patterns
+        self.property_patterns = property_patterns
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.lock = threading.Lock()
+        self.started = False
+        # (device name, property name) -> monotonic time of last line
+        self.last_written = {}
+        # (device name, property name) -> names of elements changed since
+        self.pending = {}
+    def wants_device(self, device_name):
+        '''Whether any of `device_name`'s properties could pass the filters'''
+        if self.device_patterns and not any(fnmatch.fnmatchcase(device_name, pat) for pat in self.device_patterns):
+            return False
+        if self.property_patterns and not any(
+            fnmatch.fnmatchcase(device_name, pat.split('.', 1)[0]) for pat in self.property_patterns
+        ):
+            return False
+        return True
+    def wants(self, device_name, property_name):
+        if self.device_patterns and not any(fnmatch.fnmatchcase(device_name, pat) for pat in self.device_patterns):
+            return False
+        identifier = f'{device_name}.{property_name}'
+        if self.property_patterns and not any(fnmatch.fnmatchcase(identifier, pat) for pat in self.property_patterns):
+            return False
+        return True
+    def _write_line(self, line):
+        self.out.write(line + '\n')
+        self.out.flush()
+    def _write(self, obj):
+        self._write_line(json.dumps(obj, separators=(',', ':')))
+    def start(self):
+        '''Starts watching the client, and writes the snapshot'''
+        self.client.add_watcher(self.watcher)
+        with self.lock:
+            self._write_snapshot()
+            self.started = True
+    def _write_snapshot(self):
+        if not self.device_patterns and not self.property_patterns:
+            self._write_line(f'{{"snapshot": {self.client.to_json()}}}')
+            return
+        snapshot = {}
+        for device_name, device in list(self.client.devices.items()):
+            properties = {
+                name: prop.to_jsonable()
+                for name, prop in list(device.properties.items())
+                if self.wants(device_name, name)
+            }
+            if properties:
+                snapshot[device_name] = {'name': device_name, 'properties': properties}
+        self._write({'snapshot': snapshot})
+    def watcher(self, update, did_anything_change):
+        '''Client watcher, receiving every update'''
+        with self.lock:
+            # anything before the snapshot is in it
+            if self.started:
+                self._handle_update(update, did_anything_change)
+    def _handle_update(self, update, did_anything_change):
+        device_name = update['device']
+        if update['action'] is INDIActions.PROPERTY_DEL:
+            property_name = update.get('name')
+            if not did_anything_change:
+                return  # a device we never knew about
+            if property_name is None:
+                if not self.wants_device(device_name):
+                    return
+            elif not self.wants(device_name, property_name):
+                return
+            for key in list(self.pending):
+                if key[0] == device_name and property_name in (None, key[1]):
+                    del self.pending[key]
+            self._write({'device': device_name, 'property': property_name, 'deleted': True})
+            return
+        property_name = update['property']['name']
+        if not did_anything_change or not self.wants(device_name, property_name):
+            return
+        device = self.client.devices.get(device_name)
+        prop = device.properties.get(property_name) if device is not None else None
+        if prop is None:
+            return
+        key = (device_name, property_name)
+        self.pending.setdefault(key, set()).update(prop.changed_elements)
+        if time.monotonic() - self.last_written.get(key, -math.inf) >= self.min_interval:
+            self._write_pending(key, prop)
+    def _write_pending(self, key, prop):
+        element_names = self.pending.pop(key)
+        self.last_written[key] = time.monotonic()
+        self._write({
+            'device': key[0],
+            'property': key[1],
+            'state': prop.state.value,
+            'timestamp': format_timestamp_as_iso(prop.timestamp),
+            'elements': {
+                name: prop.elements[name]._make_value_jsonable(prop.elements[name].value)
+                for name in sorted(element_names) if name in prop.elements
+            },
+        })
+    def flush_due(self):
+        '''Writes the throttled lines whose time has come'''
+        now = time.monotonic()
+        with self.lock:
+            for key in list(self.pending):
+                if now - self.last_written.get(key, -math.inf) < self.min_interval:
+                    continue
+                device = self.client.devices.get(key[0])
+                prop = device.properties.get(key[1]) if device is not None else None
+                if prop is None:
+                    del self.pending[key]
+                else:
+                    self._write_pending(key, prop)
+
+def subscriptions_for(device_patterns, property_patterns):
+    '''
+    Client subscriptions covering the filters, when they're plain names
+    the server can be asked for directly, otherwise None
+    '''
+    patterns = (device_patterns or []) + (property_patterns or [])
+    if not patterns or any(not GLOB_CHARACTERS.isdisjoint(pat) for pat in patterns):
+        return None
+    if not property_patterns:
+        return device_patterns
+    if not device_patterns:
+        return property_patterns
+    return [pat for pat in property_patterns if pat.split('.', 1)[0] in device_patterns]
+
 def watcher(*_):
     global c
     print(json.dumps(c.to_jsonable(), indent=2, sort_keys=True))
@@ -38,13 +183,44 @@ def main():
         type=int,
         default=DEFAULT_PORT,
     )
+    parser.add_argument(
+        "--stream",
+        help="Output one snapshot, then one line of NDJSON per property update with only the changed elements",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--devices",
+        help="Only output these devices (names or globs, with --stream)",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--properties",
+        help="Only output these deviceName.propertyName properties (names or globs, with --stream)",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--max-rate",
+        help="Output each property at most this many times per second (with --stream)",
+        type=float,
+    )
+    parser.add_argument(
+        "--stats",
+        help="Collect client statistics and print them (as JSON, to stderr) every STATS seconds",
+        type=float,
+        metavar="STATS",
+    )
     args = parser.parse_args()
     if args.help:
         parser.print_help()
         sys.exit(1)
 
-    c = INDIClient(args.host, args.port)
+    if args.stream:
+        stream(args)
+        return
+    c = INDIClient(args.host, args.port, collect_stats=args.stats is not None)
     c.start()
+    if args.stats is not None:
+        report_periodically(c, args.stats)
     while len(c.devices) == 0:
         time.sleep(1)
     watcher()
@@ -52,3 +228,26 @@ def main():
         c.add_watcher(watcher)
         while True:
             time.sleep(1)
+
+def stream(args):
+    global c
+    c = INDIClient(
+        args.host, args.port,
+        subscriptions=subscriptions_for(args.devices, args.properties),
+        collect_stats=args.stats is not None,
+    )
+    c.start()
+    if args.stats is not None:
+        report_periodically(c, args.stats)
+    while len(c.devices) == 0:
+        time.sleep(1)
+    streamer = DeltaStream(
+        c, sys.stdout,
+        device_patterns=args.devices,
+        property_patterns=args.properties,
+        max_rate=args.max_rate,
+    )
+    streamer.start()
+    while True:
+        time.sleep(streamer.min_interval or 1)
+        streamer.flush_due()
@@ -2,9 +2,16 @@ import logging
 logger = logging.getLogger('purepyindi')
 debug = logger.debug
 info = logger.info
-warn = logger.warn
+warn = logger.warning
 error = logger.error
 critical = logger.critical
 
 def set_log_level(level):
     logger.setLevel(level)
+
+def debug_enabled():
+    '''
+    Whether debug messages would go anywhere. Check it before building
+    an expensive message on a hot path, e.g. ``if debug_enabled(): debug(...)``
+    '''
+    return logger.isEnabledFor(logging.DEBUG)
@@ -0,0 +1,241 @@
+'''
+Drives connections to several INDI servers from one thread, merging
+their devices into a single client
+'''
+import queue
+import selectors
+import socket
+import threading
+from .client import INDIClient, AdaptiveReadSize
+from .constants import ConnectionStatus, INDIActions
+from .log import debug, info, warn, error
+from .parser import INDIStreamParser
+
+class _WakingQueue(queue.Queue):
+    '''Queue that calls `wake` after every put, to interrupt a `select()`'''
+    def __init__(self, wake):
+        super().__init__()
+        self._wake = wake
+    def _put(self, item):
+        super()._put(item)
+        self._wake()
+
+class ServerConnection:
+    '''
+    One server a `MultiplexedINDIClient` talks to, with its own socket,
+    parser, and buffer of bytes waiting to be sent
+    '''
+    def __init__(self, host, port, parser_kwargs):
+        self.host, self.port = host, port
+        self.socket = None
+        self.status = ConnectionStatus.STARTING
+        self.inbound = queue.SimpleQueue()
+        self.parser = INDIStreamParser(self.inbound, **parser_kwargs)
+        self.read_size = AdaptiveReadSize()
+        self.buffer = bytearray(self.read_size.size)
+        self.outbox = bytearray()
+    def __repr__(self):
+        return f"<ServerConnection {self.host}:{self.port} {self.status.name}>"
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.socket = sock
+        self.status = ConnectionStatus.CONNECTED
+    def close(self, status=ConnectionStatus.STOPPED):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.outbox.clear()
+        self.status = status
+    def receive(self, client):
+        '''
+        Reads what's available and returns the updates `client` parsed
+        from it, or None if the server closed the connection
+        '''
+        if len(self.buffer) < self.read_size.size:
+            self.buffer = bytearray(self.read_size.size)
+        try:
+            n_bytes = self.socket.recv_into(self.buffer, self.read_size.size)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if n_bytes == 0:
+            return None
+        self.read_size.observe(n_bytes)
+        client._parse(self.parser, memoryview(self.buffer)[:n_bytes])
+        updates = []
+        while not self.inbound.empty():
+            updates.append(self.inbound.get_nowait())
+        return updates
+    def send_pending(self):
+        '''Writes as much of the outbox as the socket will take'''
+        try:
+            n_bytes = self.socket.send(self.outbox)
+        except (BlockingIOError, InterruptedError):
+            return
+        del self.outbox[:n_bytes]
+
+class MultiplexedINDIClient(INDIClient):
+    '''
+    Client for several INDI servers at once, given as an iterable of
+    ``(host, port)`` pairs, with all their devices in one `devices` dict
+
+    All the connections are served by a single thread running a
+    `selectors` loop, rather than a sender and receiver thread per
+    server. Each connection has its own parser. Mutations go to the
+    server that defined the device they're for, and ``getProperties``
+    requests for devices no server has defined yet go to all of them.
+    Other keyword arguments are as for `INDIClient`, except that
+    `flush_interval` is ignored: whatever is queued when the loop wakes
+    up is sent together.
+    '''
+    def __init__(self, servers, **kwargs):
+        super().__init__(None, None, **kwargs)
+        # opened by `start` and closed by `stop`
+        self._selector = None
+        self._wake_receiver = self._wake_sender = None
+        self._outbound_queue = _WakingQueue(self._wake)
+        parser_kwargs = {'epoch_timestamps': self.epoch_timestamps, 'subscriptions': self.subscriptions}
+        self.connections = [ServerConnection(host, port, parser_kwargs) for host, port in servers]
+        # device name -> the ServerConnection that defined it
+        self._device_connections = {}
+        self._loop_thread = None
+    def _wake(self):
+        wake_sender = self._wake_sender
+        if wake_sender is None:
+            return  # not started, so nobody to wake
+        try:
+            wake_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already a wakeup pending, or we're shutting down
+    def _open_selector(self):
+        self._selector = selectors.DefaultSelector()
+        self._wake_receiver, self._wake_sender = socket.socketpair()
+        self._wake_receiver.setblocking(False)
+        self._wake_sender.setblocking(False)
+        self._selector.register(self._wake_receiver, selectors.EVENT_READ, None)
+    def _close_selector(self):
+        self._selector.close()
+        self._wake_receiver.close()
+        self._wake_sender.close()
+        self._selector = None
+        self._wake_receiver = self._wake_sender = None
+    def connection_for(self, device_name):
+        '''The `ServerConnection` that `device_name` came from, or None'''
+        return self._device_connections.get(device_name)
+    def start(self):
+        if self.status is ConnectionStatus.CONNECTED:
+            return
+        if self._selector is None:
+            self._open_selector()
+        for conn in self.connections:
+            try:
+                conn.connect()
+            except OSError as e:
+                error(f"Connection to {conn.host}:{conn.port} failed: {e}")
+                for other in self.connections:
+                    if other.socket is not None:
+                        self._selector.unregister(other.socket)
+                    other.close(ConnectionStatus.ERROR)
+                self.status = ConnectionStatus.ERROR
+                raise
+            self._selector.register(conn.socket, selectors.EVENT_READ, conn)
+            debug(f"Connected to {conn.host}:{conn.port}")
+        self.status = ConnectionStatus.CONNECTED
+        self.get_properties()
+        self._loop_thread = threading.Thread(
+            target=self._run_loop,
+            name='INDIClient-multiplexer',
+            daemon=True,
+        )
+        self._loop_thread.start()
+    def stop(self):
+        self.status = ConnectionStatus.STOPPED
+        self._wake()
+        if self._loop_thread is not None:
+            self._loop_thread.join()
+            self._loop_thread = None
+        if self._selector is not None:
+            for conn in self.connections:
+                if conn.socket is not None:
+                    self._selector.unregister(conn.socket)
+                conn.close()
+            self._close_selector()
+        self._close_histories()
+    def _run_loop(self):
+        while self.status is not ConnectionStatus.STOPPED:
+            for key, events in self._selector.select():
+                conn = key.data
+                if conn is None:
+                    self._drain_wakeups()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._receive(conn)
+                if events & selectors.EVENT_WRITE and conn.socket is not None:
+                    self._send(conn)
+            self._route_outbound()
+        debug("Multiplexer loop exiting")
+    def _drain_wakeups(self):
+        try:
+            while self._wake_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+    def _receive(self, conn):
+        try:
+            updates = conn.receive(self)
+        except OSError as e:
+            warn(f"Error reading from {conn.host}:{conn.port}: {e}")
+            updates = None
+        if updates is None:
+            self._drop(conn)
+            return
+        for update in updates:
+            device_name = update['device']
+            if update['action'] is INDIActions.PROPERTY_DEL and 'name' not in update:
+                self._device_connections.pop(device_name, None)
+            else:
+                self._device_connections[device_name] = conn
+            self._apply_inbound(update)
+    def _send(self, conn):
+        try:
+            conn.send_pending()
+        except OSError as e:
+            warn(f"Error writing to {conn.host}:{conn.port}: {e}")
+            self._drop(conn)
+            return
+        if not conn.outbox:
+            self._selector.modify(conn.socket, selectors.EVENT_READ, conn)
+    def _drop(self, conn):
+        '''Closes one connection, leaving the others be'''
+        info(f"Lost connection to {conn.host}:{conn.port}")
+        self._selector.unregister(conn.socket)
+        conn.close(ConnectionStatus.ERROR)
+    def stats(self):
+        result = super().stats()
+        result['inbound_queue_depth'] = sum(conn.inbound.qsize() for conn in self.connections)
+        return result
+    def _connections_for(self, message):
+        conn = self._device_connections.get(message.get('device'))
+        if conn is not None:
+            return [conn]
+        return [conn for conn in self.connections if conn.status is ConnectionStatus.CONNECTED]
+    def _route_outbound(self):
+        routed = {}
+        while True:
+            try:
+                item = self._outbound_queue.get_nowait()
+            except queue.Empty:
+                break
+            for message in (item if isinstance(item, list) else [item]):
+                for conn in self._connections_for(message):
+                    routed.setdefault(conn, []).append(message)
+        for conn, messages in routed.items():
+            if conn.socket is None:
+                warn(f"Dropping {len(messages)} messages for disconnected {conn.host}:{conn.port}")
+                continue
+            outdata, n_messages = self._encode_outbound(messages)
+            debug("Sending %d messages (%d bytes) to %s:%s", n_messages, len(outdata), conn.host, conn.port)
+            conn.outbox += outdata
+            self._record_flush(n_messages, len(outdata))
+            self._selector.modify(conn.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
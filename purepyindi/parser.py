@@ -1,6 +1,7 @@
 from enum import Enum
 from functools import wraps
 from xml.parsers import expat
+import calendar
 import datetime
 from .constants import (
     ISO_TIMESTAMP_FORMAT,
@@ -10,15 +11,97 @@ from .constants import (
     PropertyState,
     SwitchRule,
     SwitchState,
+    enum_lookup_table,
     parse_string_into_enum,
 )
 from pprint import pformat
-from .log import debug, info, warn, error, critical
+from .log import debug, info, warn, error, critical, debug_enabled
 
-def parse_iso_to_datetime(timestamp):
+# Timestamps in a stream almost always share a date, so the
+# (prefix, date, epoch seconds at midnight) of the last one is kept
+_iso_date_cache = (None, None, None)
+
+def _decode_iso_date(prefix):
+    global _iso_date_cache
+    cached_prefix, date, midnight = _iso_date_cache
+    if prefix != cached_prefix:
+        if prefix[4] != '-' or prefix[7] != '-':
+            raise ValueError(f"Unparseable date {repr(prefix)}")
+        date = datetime.date(int(prefix[:4]), int(prefix[5:7]), int(prefix[8:10]))
+        midnight = calendar.timegm(date.timetuple())
+        _iso_date_cache = (prefix, date, midnight)
+    return date, midnight
+
+def _decode_iso_time(timestamp):
+    '''
+    Hand-rolled decoder for the fixed ``ISO_TIMESTAMP_FORMAT``, returns
+    (date, epoch seconds at midnight, hour, minute, second, microsecond)
+    or None if `timestamp` isn't laid out the way we expect
+    '''
+    if (len(timestamp) < 22 or timestamp[10] != 'T' or timestamp[13] != ':'
+            or timestamp[16] != ':' or timestamp[19] != '.' or timestamp[-1] != 'Z'):
+        return None
+    fraction = timestamp[20:-1]
+    if len(fraction) > 6 or not fraction.isdigit():
+        return None
+    try:
+        date, midnight = _decode_iso_date(timestamp[:10])
+        hour, minute, second = int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])
+        microsecond = int(fraction) * 10 ** (6 - len(fraction))
+    except ValueError:
+        return None
+    if not (0 <= hour <= 23 and 0 <= minute <= 59 and 0 <= second <= 59):
+        return None
+    return date, midnight, hour, minute, second, microsecond
+
+def _strptime_iso(timestamp):
     dt = datetime.datetime.strptime(timestamp, ISO_TIMESTAMP_FORMAT)
-    dt = dt.replace(tzinfo=datetime.timezone.utc)
-    return dt
+    return dt.replace(tzinfo=datetime.timezone.utc)
+
+def parse_iso_to_datetime(timestamp):
+    decoded = _decode_iso_time(timestamp)
+    if decoded is None:
+        # anything irregular gets strptime's validation and error messages
+        return _strptime_iso(timestamp)
+    date, _, hour, minute, second, microsecond = decoded
+    return datetime.datetime(
+        date.year, date.month, date.day,
+        hour, minute, second, microsecond,
+        tzinfo=datetime.timezone.utc
+    )
+
+def parse_iso_to_epoch(timestamp):
+    decoded = _decode_iso_time(timestamp)
+    if decoded is None:
+        return _strptime_iso(timestamp).timestamp()
+    _, midnight, hour, minute, second, microsecond = decoded
+    return midnight + hour * 3600 + minute * 60 + second + microsecond / 1e6
+
+def timestamp_to_datetime(timestamp):
+    '''
+    Converts a timestamp as stored by the client (epoch seconds or
+    `datetime`, depending on ``epoch_timestamps``) to a UTC `datetime`
+    '''
+    if timestamp is None or isinstance(timestamp, datetime.datetime):
+        return timestamp
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+def parse_subscriptions(specs):
+    '''
+    Turns an iterable of ``device`` / ``device.property`` strings into
+    a dict mapping device names to a set of property names, or to None
+    when the whole device is wanted
+    '''
+    subscriptions = {}
+    for spec in specs:
+        device_name, _, property_name = spec.partition('.')
+        if not property_name:
+            subscriptions[device_name] = None
+        elif device_name not in subscriptions:
+            subscriptions[device_name] = {property_name}
+        elif subscriptions[device_name] is not None:
+            subscriptions[device_name].add(property_name)
+    return subscriptions
 
 class INDIStreamParser:
     PROPERTY_DEF_TAGS = {
@@ -59,50 +142,204 @@ class INDIStreamParser:
         'oneLight',
     }
     PROPERTY_DEL_TAG = 'delProperty'
+    SUBSCRIBABLE_TAGS = frozenset(PROPERTY_DEF_TAGS) | frozenset(PROPERTY_SET_TAGS) | {PROPERTY_DEL_TAG}
     OPTIONAL_PROPERTY_DEL_ATTRS = {
         'name',
         'timestamp',
         'message',
     }
 
-    def __init__(self, update_queue):
+    # Reverse lookup tables for the set*Vector fast path, so values
+    # can be decoded with one dict lookup instead of an enum scan
+    PROPERTY_STATES = enum_lookup_table(PropertyState)
+    SWITCH_STATES = enum_lookup_table(SwitchState)
+
+    def __init__(self, update_queue, fast_path=True, epoch_timestamps=False, subscriptions=None):
+        '''
+        Parsed updates are put on `update_queue`. If `subscriptions` is
+        given (in the form returned by `parse_subscriptions`), messages
+        for other devices and properties are skipped without decoding.
+        '''
         self.update_queue = update_queue
+        self.subscriptions = subscriptions
+        self._skip_depth = 0
+        self.fast_path = fast_path
+        self.epoch_timestamps = epoch_timestamps
+        self._parse_timestamp = parse_iso_to_epoch if epoch_timestamps else parse_iso_to_datetime
         # self.open_elements = []
         self.current_indi_element = None
         self.pending_update = None
         self.accumulated_chardata = ''
         self.accumulated_elements = []
+        self._set_vector_tag = None
+        self._set_vector_decoder = None
         self.parser = self._new_parser()
 
     def _new_parser(self):
         parser = expat.ParserCreate()
-        parser.StartElementHandler = self.start_element_handler
-        parser.EndElementHandler = self.end_element_handler
+        parser.buffer_text = True
+        self._use_generic_handlers(parser)
         parser.CharacterDataHandler = self.character_data_handler
         parser.Parse('<indi>')
         return parser
 
+    def _use_generic_handlers(self, parser=None):
+        parser = self.parser if parser is None else parser
+        parser.StartElementHandler = self.start_element_handler
+        parser.EndElementHandler = self.end_element_handler
+        self._set_vector_tag = None
+
+    def _start_skipping(self):
+        self._skip_depth = 1
+        self.parser.StartElementHandler = self._skip_start_element_handler
+        self.parser.EndElementHandler = self._skip_end_element_handler
+        self.parser.CharacterDataHandler = None
+
+    def _skip_start_element_handler(self, tag_name, tag_attributes):
+        self._skip_depth += 1
+
+    def _skip_end_element_handler(self, tag_name):
+        self._skip_depth -= 1
+        if self._skip_depth == 0:
+            self._use_generic_handlers()
+            self.parser.CharacterDataHandler = self.character_data_handler
+            self.accumulated_chardata = ''
+
+    def _is_subscribed(self, tag_name, tag_attributes):
+        if tag_name not in self.SUBSCRIBABLE_TAGS:
+            return True
+        device_name = tag_attributes.get('device')
+        if device_name not in self.subscriptions:
+            return False
+        property_names = self.subscriptions[device_name]
+        if property_names is None:
+            return True
+        property_name = tag_attributes.get('name')
+        # deleting the whole device concerns any subscriber to it
+        return property_name in property_names or (property_name is None and tag_name == self.PROPERTY_DEL_TAG)
+
+    def _use_set_vector_handlers(self, tag_name):
+        self.parser.StartElementHandler = self._set_vector_start_element_handler
+        self.parser.EndElementHandler = self._set_vector_end_element_handler
+        self._set_vector_tag = tag_name
+
     def parse(self, data):
         try:
             self.parser.Parse(data)
         except expat.ExpatError as e:
             self.parser = self._new_parser()
+            self._skip_depth = 0
             self.accumulated_chardata = ''
             self.pending_update = None
             self.current_indi_element = None
             warn(f"reset parser state after encountering bad input: {e}")
 
+    # Fast path for set*Vector messages, which make up nearly all of
+    # the traffic once the initial property definitions are through.
+    # The expat handlers are swapped out for the duration of the
+    # vector, and anything unexpected is handed back to the generic
+    # handlers so both paths produce identical updates.
+    def _start_set_vector(self, tag_name, tag_attributes):
+        if self.pending_update is not None:
+            debug('property setting happening while we thought '
+                  'something else was happening. '
+                  'Discarded pending update was: %s', self.pending_update)
+        kind = self.PROPERTY_SET_TAGS[tag_name]
+        prop = {
+            'name': tag_attributes['name'],
+            'kind': kind,
+            'elements': {},
+        }
+        if 'state' in tag_attributes:
+            state = self.PROPERTY_STATES.get(tag_attributes['state'])
+            if state is None:
+                state = parse_string_into_enum(tag_attributes['state'], PropertyState)
+            prop['state'] = state
+        if 'timeout' in tag_attributes:
+            prop['timeout'] = tag_attributes['timeout']
+        if 'timestamp' in tag_attributes:
+            prop['timestamp'] = self._parse_timestamp(tag_attributes['timestamp'])
+        if 'message' in tag_attributes:
+            prop['message'] = tag_attributes['message']
+        self.pending_update = {
+            'action': INDIActions.PROPERTY_SET,
+            'device': tag_attributes['device'],
+            'property': prop,
+        }
+        self._set_vector_decoder = self.SET_VECTOR_DECODERS[kind]
+        self._use_set_vector_handlers(tag_name)
+
+    def _set_vector_start_element_handler(self, tag_name, tag_attributes):
+        if tag_name not in self.ELEMENT_SET_TAGS:
+            self._use_generic_handlers()
+            return self.start_element_handler(tag_name, tag_attributes)
+        if self.accumulated_chardata.strip():
+            debug('character data %r cannot be sibling of element, discarding', self.accumulated_chardata)
+        element = {'name': tag_attributes['name']}
+        if 'label' in tag_attributes:
+            element['label'] = tag_attributes['label']
+        self.current_indi_element = element
+
+    def _set_vector_end_element_handler(self, tag_name):
+        if tag_name == self._set_vector_tag:
+            self.accumulated_chardata = ''
+            self._use_generic_handlers()
+            self.update_queue.put_nowait(self.pending_update)
+            self.pending_update = None
+            return
+        element = self.current_indi_element
+        if tag_name not in self.ELEMENT_SET_TAGS or element is None:
+            self._use_generic_handlers()
+            return self.end_element_handler(tag_name)
+        contents = self.accumulated_chardata.strip()
+        self.accumulated_chardata = ''
+        element['value'] = self._set_vector_decoder(self, contents, element) if contents else None
+        self.pending_update['property']['elements'][element['name']] = element
+        self.current_indi_element = None
+
+    def _decode_number(self, contents, element):
+        try:
+            return float(contents)
+        except ValueError:
+            warn(f"Coudn't parse {contents} as a number for {self.pending_update['device']}.{self.pending_update['property']['name']}.{element['name']}")
+            return None
+
+    def _decode_switch(self, contents, element):
+        value = self.SWITCH_STATES.get(contents)
+        if value is None:
+            value = parse_string_into_enum(contents, SwitchState)
+        return value
+
+    def _decode_light(self, contents, element):
+        value = self.PROPERTY_STATES.get(contents)
+        if value is None:
+            value = parse_string_into_enum(contents, PropertyState)
+        return value
+
+    def _decode_text(self, contents, element):
+        return contents
+
+    SET_VECTOR_DECODERS = {
+        INDIPropertyKind.NUMBER: _decode_number,
+        INDIPropertyKind.SWITCH: _decode_switch,
+        INDIPropertyKind.LIGHT: _decode_light,
+        INDIPropertyKind.TEXT: _decode_text,
+    }
+
     # @_reset_on_bad_input
     def start_element_handler(self, tag_name, tag_attributes):
+        if self.subscriptions is not None and not self._is_subscribed(tag_name, tag_attributes):
+            return self._start_skipping()
+        if self.fast_path and tag_name in self.PROPERTY_SET_TAGS:
+            return self._start_set_vector(tag_name, tag_attributes)
         if self.accumulated_chardata.strip():
-            debug(f'character data {repr(self.accumulated_chardata)} cannot be sibling of element, discarding')
+            debug('character data %r cannot be sibling of element, discarding', self.accumulated_chardata)
 
         if tag_name in self.PROPERTY_DEF_TAGS:
             if self.pending_update is not None:
-                debug(f'property definition happening while we '
-                      f'thought something else was happening. '
-                      f'Discarded pending update was: '
-                      f'{self.pending_update}')
+                debug('property definition happening while we '
+                      'thought something else was happening. '
+                      'Discarded pending update was: %s', self.pending_update)
             self.pending_update = {
                 'action': INDIActions.PROPERTY_DEF,
                 'device': tag_attributes['device'],
@@ -119,15 +356,14 @@ class INDIStreamParser:
             for optional_attr in self.OPTIONAL_PROPERTY_DEF_ATTRS:
                 if optional_attr in tag_attributes:
                     if optional_attr == 'timestamp':
-                        self.pending_update['property'][optional_attr] = parse_iso_to_datetime(tag_attributes[optional_attr])
+                        self.pending_update['property'][optional_attr] = self._parse_timestamp(tag_attributes[optional_attr])
                     else:
                         self.pending_update['property'][optional_attr] = tag_attributes[optional_attr]
         elif tag_name in self.PROPERTY_SET_TAGS:
             if self.pending_update is not None:
-                debug(f'property setting happening while we thought '
-                      f'something else was happening. '
-                      f'Discarded pending update was: '
-                      f'{self.pending_update}')
+                debug('property setting happening while we thought '
+                      'something else was happening. '
+                      'Discarded pending update was: %s', self.pending_update)
             self.pending_update = {
                 'action': INDIActions.PROPERTY_SET,
                 'device': tag_attributes['device'],
@@ -143,7 +379,7 @@ class INDIStreamParser:
                     if optional_attr == 'state':
                         self.pending_update['property'][optional_attr] = parse_string_into_enum(tag_attributes[optional_attr], PropertyState)
                     elif optional_attr == 'timestamp':
-                        self.pending_update['property'][optional_attr] = parse_iso_to_datetime(tag_attributes[optional_attr])
+                        self.pending_update['property'][optional_attr] = self._parse_timestamp(tag_attributes[optional_attr])
                     else:
                         self.pending_update['property'][optional_attr] = tag_attributes[optional_attr]
         elif tag_name in self.ELEMENT_DEF_TAGS or tag_name in self.ELEMENT_SET_TAGS:
@@ -171,11 +407,11 @@ class INDIStreamParser:
             for optional_attr in self.OPTIONAL_PROPERTY_DEL_ATTRS:
                 if optional_attr in tag_attributes:
                     if optional_attr == 'timestamp':
-                        self.pending_update[optional_attr] = parse_iso_to_datetime(tag_attributes[optional_attr])
+                        self.pending_update[optional_attr] = self._parse_timestamp(tag_attributes[optional_attr])
                     else:
                         self.pending_update[optional_attr] = tag_attributes[optional_attr]
         else:
-            debug(f"Unhandled tag <{tag_name}> opened")
+            debug("Unhandled tag <%s> opened", tag_name)
 
     # @_reset_on_bad_input
     def end_element_handler(self, tag_name):
@@ -206,12 +442,12 @@ class INDIStreamParser:
             self.pending_update['property']['elements'][element['name']] = element
             self.current_indi_element = None
         elif tag_name in self.PROPERTY_DEF_TAGS or tag_name in self.PROPERTY_SET_TAGS or tag_name == self.PROPERTY_DEL_TAG:
-            debug("Placing update in queue:")
-            debug(pformat(self.pending_update))
+            if debug_enabled():
+                debug("Placing update in queue:\n%s", pformat(self.pending_update))
             self.update_queue.put_nowait(self.pending_update)
             self.pending_update = None
         else:
-            debug(f"Unhandled tag <{tag_name}> closed")
+            debug("Unhandled tag <%s> closed", tag_name)
 
     def character_data_handler(self, data):
         self.accumulated_chardata += data
@@ -0,0 +1,111 @@
+'''
+Optional instrumentation of the client's hot paths, enabled with
+``INDIClient(..., collect_stats=True)`` and read with `INDIClient.stats`
+'''
+import json
+import sys
+import threading
+from .constants import INDIActions, INDIPropertyKind
+
+HISTOGRAM_BUCKETS = 32
+
+KIND_TAG_NAMES = {
+    INDIPropertyKind.NUMBER: 'Number',
+    INDIPropertyKind.TEXT: 'Text',
+    INDIPropertyKind.SWITCH: 'Switch',
+    INDIPropertyKind.LIGHT: 'Light',
+}
+
+def update_tag(update):
+    '''The XML tag an update dict from the parser came from'''
+    action = update['action']
+    if action is INDIActions.PROPERTY_DEL:
+        return 'delProperty'
+    if action is INDIActions.MESSAGE:
+        return 'message'
+    return f"{action.value}{KIND_TAG_NAMES[update['property']['kind']]}Vector"
+
+class LatencyHistogram:
+    '''
+    Counts durations in power-of-two buckets of microseconds, so
+    recording one is a few integer operations
+    '''
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def observe(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.counts[bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS - 1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    def percentile(self, fraction):
+        '''Upper bound (in seconds) of the bucket holding the `fraction` quantile'''
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= threshold:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+class ClientStats:
+    '''Counters and latency histograms for one client'''
+    def __init__(self):
+        self.bytes_received = 0
+        self.messages_parsed = {}
+        self.updates_applied = 0
+        self.watcher_invocations = 0
+        self.messages_sent = 0
+        self.parse_time = LatencyHistogram()
+        self.apply_update_time = LatencyHistogram()
+        self.watcher_time = LatencyHistogram()
+    def parsed(self, n_bytes, seconds):
+        self.bytes_received += n_bytes
+        self.parse_time.observe(seconds)
+    def applied(self, update, seconds):
+        tag = update_tag(update)
+        self.messages_parsed[tag] = self.messages_parsed.get(tag, 0) + 1
+        self.updates_applied += 1
+        self.apply_update_time.observe(seconds)
+    def watched(self, n_watchers, seconds):
+        self.watcher_invocations += n_watchers
+        self.watcher_time.observe(seconds)
+    def sent(self, n_messages):
+        self.messages_sent += n_messages
+    def to_dict(self):
+        return {
+            'bytes_received': self.bytes_received,
+            'messages_parsed': dict(self.messages_parsed),
+            'updates_applied': self.updates_applied,
+            'watcher_invocations': self.watcher_invocations,
+            'messages_sent': self.messages_sent,
+            'parse_time': self.parse_time.summary(),
+            'apply_update_time': self.apply_update_time.summary(),
+            'watcher_time': self.watcher_time.summary(),
+        }
+
+def report_periodically(client, interval, out=None):
+    '''Starts a daemon thread writing ``client.stats()`` as JSON to `out` (stderr) every `interval` seconds'''
+    out = sys.stderr if out is None else out
+    stopped = threading.Event()
+    def report():
+        while not stopped.wait(interval):
+            out.write(json.dumps({'stats': client.stats()}, sort_keys=True) + '\n')
+            out.flush()
+    threading.Thread(target=report, name='INDIClient-stats', daemon=True).start()
+    return stopped
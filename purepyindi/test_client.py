@@ -1,14 +1,28 @@
 import pytest
 import asyncio
+import copy
+import datetime
+import json
+import re
+import socket
+import threading
+import time
 from unittest import mock
+from . import client as client_module
 from .constants import *
 from pprint import pprint
-from .client import INDIClient
+from .client import INDIClient, AdaptiveReadSize
+from .eventful import AsyncINDIClient
+from .generator import PropertyMutation, mutations_to_xml_message
 
 from .test_fixtures import (
+    DEF_NUMBER_PROP,
     DEF_NUMBER_UPDATE,
+    SET_NUMBER_PROP,
     SET_NUMBER_UPDATE,
     DEL_PROPERTY_UPDATE,
+    NEW_NUMBER_TIMESTAMP,
+    make_def_corpus,
 )
 from pprint import pprint
 
@@ -44,7 +58,7 @@ def test_did_anything_change():
     did_anything_change = client.apply_update(DEF_NUMBER_UPDATE)
     assert did_anything_change == True
     did_anything_change = client.apply_update(DEF_NUMBER_UPDATE)
-    assert did_anything_change == True  # n.b. recreating a property counts as changing!
+    assert did_anything_change == False  # redefined in place, identically
     did_anything_change = client.apply_update(SET_NUMBER_UPDATE)
     assert did_anything_change == True
     did_anything_change = client.apply_update(SET_NUMBER_UPDATE)
@@ -54,14 +68,542 @@ def test_did_anything_change():
     did_anything_change = client.apply_update(DEL_PROPERTY_UPDATE)
     assert did_anything_change == False
 
+def test_redefinition_in_place():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'stage', 'position', ['x', 'y'])
+    prop = client.devices['stage'].properties['position']
+    x = prop.elements['x']
+    x_changes, prop_changes = [], []
+    x.add_watcher(lambda el, did_anything_change: x_changes.append(did_anything_change))
+    prop.add_watcher(lambda p, did_anything_change: prop_changes.append(did_anything_change))
+    x.history.add(1.0, 2.0)
+    n_samples = len(x.history)
+    # a driver restart: new timestamp, y replaced by z, x's limits changed
+    update = copy.deepcopy(DEF_NUMBER_UPDATE)
+    update['device'], update['property']['name'] = 'stage', 'position'
+    template = update['property']['elements'].pop('value')
+    update['property']['elements'] = {
+        'x': dict(template, name='x', max=10.0),
+        'z': dict(template, name='z'),
+    }
+    update['property']['timestamp'] += datetime.timedelta(seconds=10)
+    assert client.apply_update(update)
+    assert client.devices['stage'].properties['position'] is prop
+    assert prop.elements['x'] is x and len(x.history) == n_samples
+    assert prop.changed_attributes == {'timestamp'}
+    assert prop.changed_elements == {'x', 'z'}
+    assert prop.removed_elements == {'y'}
+    assert 'stage.position.z' in client and 'stage.position.y' not in client
+    assert x_changes == [True] and prop_changes == [True]
+    # same again, just later
+    update['property']['timestamp'] += datetime.timedelta(seconds=10)
+    assert not client.apply_update(update)
+    assert x_changes == [True, False] and prop_changes == [True, False]
+
 def test_start_stop_start_stop():
     with mock.patch('socket.socket') as mock_socket:
         mock_socket().connect.return_value = True
         mock_socket().sendall.return_value = None
-        mock_socket().recv.return_value = b''
+        mock_socket().recv_into.return_value = 0
         client = INDIClient('localhost', 7624)
         client.start()
         client.stop()
         client.start()
         client.stop()
 
+
+def test_epoch_timestamps():
+    client = INDIClient(None, None, epoch_timestamps=True)
+    client._parser.parse(DEF_NUMBER_PROP + SET_NUMBER_PROP)
+    while not client._inbound_queue.empty():
+        client.apply_update(client._inbound_queue.get_nowait())
+    prop = client.devices['test'].properties['prop']
+    assert isinstance(prop.timestamp, float)
+    assert prop.timestamp_datetime == SET_NUMBER_UPDATE['property']['timestamp']
+    history = prop.elements['value'].history
+    assert history.times_as_datetimes()[-1] == SET_NUMBER_UPDATE['property']['timestamp']
+    assert prop.to_jsonable()['timestamp'] == '2019-08-12T20:49:50.420459Z'
+
+def _define_numbers(client, device_name, property_name, element_names):
+    update = copy.deepcopy(DEF_NUMBER_UPDATE)
+    update['device'] = device_name
+    update['property']['name'] = property_name
+    template = update['property']['elements'].pop('value')
+    for element_name in element_names:
+        update['property']['elements'][element_name] = dict(template, name=element_name)
+    client.apply_update(update)
+
+def test_identifier_index():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'test', 'prop', ['a', 'b'])
+    assert 'test.prop.a' in client
+    assert client.lookup_property('test.prop') is client.devices['test'].properties['prop']
+    _define_numbers(client, 'test', 'prop', ['b', 'c'])
+    assert 'test.prop.a' not in client
+    assert client.lookup_element('test.prop.c') is client.devices['test'].properties['prop'].elements['c']
+    client.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': 'test', 'name': 'prop'})
+    assert 'test.prop.b' not in client
+    with pytest.raises(KeyError):
+        client.lookup_property('test.prop')
+    with pytest.raises(KeyError):
+        client.lookup_property('test')
+    _define_numbers(client, 'test', 'prop', ['a'])
+    client.apply_update(DEL_PROPERTY_UPDATE)
+    assert 'test.prop.a' not in client
+    assert client._element_index == {} and client._property_index == {}
+
+def test_select():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'camwfs', 'fps', ['current', 'target'])
+    _define_numbers(client, 'camwfs-dark', 'fps', ['current'])
+    _define_numbers(client, 'camwfs', 'temp', ['current'])
+    _define_numbers(client, 'camsci1', 'fps', ['current'])
+    def identifiers(pattern):
+        return sorted(element.identifier for element in client.select(pattern))
+    assert identifiers('camwfs*.fps*.current') == ['camwfs-dark.fps.current', 'camwfs.fps.current']
+    assert identifiers('camwfs.*.current') == ['camwfs.fps.current', 'camwfs.temp.current']
+    assert identifiers('cam???1.fps.*') == ['camsci1.fps.current']
+    assert identifiers('nope.fps.current') == []
+    assert identifiers(re.compile(r'cam\w+\.fps\.target')) == ['camwfs.fps.target']
+    # elements that first arrive in a set message
+    update = copy.deepcopy(SET_NUMBER_UPDATE)
+    update['device'] = 'camwfs'
+    update['property']['name'] = 'fps'
+    update['property']['elements'] = {'extra': {'name': 'extra', 'value': 1.0}}
+    client.apply_update(update)
+    assert identifiers(re.compile(r'camwfs\.fps\.e.*')) == ['camwfs.fps.extra']
+    with pytest.raises(ValueError):
+        client.select('camwfs.fps')
+
+def test_batch():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'stage', 'position', ['x', 'y', 'z'])
+    _define_numbers(client, 'stage', 'speed', ['x'])
+    with client.batch():
+        client['stage.position.x'] = 1
+        with client.batch():
+            client['stage.position.y'] = 2
+        client['stage.speed.x'] = 3
+        assert client._outbound_queue.empty()
+    mutations = client._outbound_queue.get_nowait()
+    assert client._outbound_queue.empty()
+    assert [m['property']['name'] for m in mutations] == ['position', 'speed']
+    assert {name: e['value'] for name, e in mutations[0]['property']['elements'].items()} == {'x': 1, 'y': 2}
+    assert client['stage.position.y'] == 2
+    message = mutations_to_xml_message(mutations, timestamp=NEW_NUMBER_TIMESTAMP)
+    assert message.count(b'\n') == 2
+    assert b'<oneNumber name="x">1</oneNumber><oneNumber name="y">2</oneNumber>' in message
+
+def test_batch_discarded_on_error():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'stage', 'position', ['x'])
+    with pytest.raises(RuntimeError):
+        with client.batch():
+            client['stage.position.x'] = 1
+            raise RuntimeError("oops")
+    assert client._outbound_queue.empty()
+    assert client['stage.position.x'] == 0
+
+def test_number_values_checked_before_sending():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'test', 'prop', ['value'])
+    client['test.prop.value'] = '2.5'
+    assert client['test.prop.value'] == 2.5
+    mutation = client._outbound_queue.get_nowait()
+    assert mutation['property']['elements']['value']['value'] == 2.5
+    prop = client.devices['test'].properties['prop']
+    prop._state = PropertyState.OK
+    with pytest.raises(ValueError):
+        client['test.prop.value'] = 'nope'
+    # nothing changed locally, and nothing was sent
+    assert client['test.prop.value'] == 2.5 and prop.state is PropertyState.OK
+    assert client._outbound_queue.empty()
+
+def test_set_many():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'stage', 'position', ['x', 'y'])
+    client.devices['stage'].properties['position'].set_many({'x': 5, 'y': 6})
+    mutation, = client._outbound_queue.get_nowait()
+    assert sorted(mutation['property']['elements']) == ['x', 'y']
+    with pytest.raises(KeyError):
+        client.devices['stage'].properties['position'].set_many({'nope': 5})
+
+def test_lean_mutation():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    prop = client.devices['test'].properties['prop']
+    for idx in range(10):
+        client.apply_update(SET_NUMBER_UPDATE if idx % 2 else DEF_NUMBER_UPDATE)
+    changes = []
+    prop.add_watcher(lambda p, did_anything_change: changes.append(did_anything_change))
+    prop.elements['value'].value = 2.0
+    mutation = client._outbound_queue.get_nowait()
+    assert isinstance(mutation, PropertyMutation)
+    assert mutation.values == {'value': 2.0}
+    assert (mutation.device, mutation.name, mutation.kind) == ('test', 'prop', INDIPropertyKind.NUMBER)
+    # applied locally like the equivalent new message, history and all
+    assert changes == [True]
+    assert prop.changed_elements == {'value'} and prop.state is PropertyState.BUSY
+    assert prop.elements['value'].history.to_dict()['values'][-1] == 2.0
+    assert json.loads(client.to_json())['test']['properties']['prop']['elements']['value']['value'] == 2.0
+    # still readable like an update dict
+    assert mutation['property']['elements'] == {'value': {'name': 'value', 'value': 2.0}}
+    assert 'name' not in mutation and mutation.get('device') == 'test'
+
+def test_compact_object_model():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    device = client.devices['test']
+    prop = device.properties['prop']
+    element = prop.elements['value']
+    for obj in (device, prop, element, element.history):
+        assert not hasattr(obj, '__dict__')
+    assert element.watchers is client_module.NO_WATCHERS
+    # watchers may remove themselves while being notified
+    calls = []
+    def once(*args):
+        calls.append(args)
+        element.remove_watcher(once)
+    element.add_watcher(once)
+    client.apply_update(SET_NUMBER_UPDATE)
+    assert len(calls) == 1 and element.watchers == set()
+    with pytest.raises(KeyError):
+        element.remove_watcher(once)
+
+def test_outbound_coalescing():
+    client = INDIClient(None, None)
+    _define_numbers(client, 'stage', 'position', ['x', 'y'])
+    client['stage.position.x'] = 1
+    client.devices['stage'].properties['position'].set_many({'x': 2, 'y': 3})
+    client['stage.position.y'] = 4
+    sender_socket, receiver_socket = socket.socketpair()
+    client.status = ConnectionStatus.CONNECTED
+    sender = threading.Thread(target=client._handle_outbound, args=(sender_socket,))
+    sender.start()
+    received = b''
+    while received.count(b'\n') < 4:
+        received += receiver_socket.recv(4096)
+    client.status = ConnectionStatus.STOPPED
+    sender.join()
+    sender_socket.close()
+    receiver_socket.close()
+    assert received.startswith(b'<newNumberVector')
+    assert received.endswith(b'<getProperties version="1.7" />\n')
+    stats = client.flush_stats()
+    assert stats['flushes'] == 1
+    assert stats['messages'] == stats['messages_per_flush'] == 4
+    assert stats['bytes'] == len(received)
+
+def test_adaptive_read_size():
+    read_size = AdaptiveReadSize(minimum=1024, maximum=8192)
+    for expected in (2048, 4096, 8192, 8192):
+        read_size.observe(read_size.size)
+        assert read_size.size == expected
+    for _ in range(AdaptiveReadSize.SHRINK_AFTER_READS):
+        read_size.observe(10)
+    assert read_size.size == 4096
+    read_size.observe(3000)
+    for _ in range(AdaptiveReadSize.SHRINK_AFTER_READS * 10):
+        read_size.observe(10)
+    assert read_size.size == 1024
+
+def test_inbound_def_flood():
+    corpus = make_def_corpus(5, 20, 10)
+    client = INDIClient(None, None)
+    server_socket, client_socket = socket.socketpair()
+    client_socket.settimeout(0.1)
+    client.status = ConnectionStatus.CONNECTED
+    receiver = threading.Thread(target=client._handle_inbound, args=(client_socket,))
+    receiver.start()
+    server_socket.sendall(corpus)
+    deadline = time.monotonic() + 5
+    while len(client._element_index) < 5 * 20 * 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.status = ConnectionStatus.STOPPED
+    receiver.join()
+    server_socket.close()
+    client_socket.close()
+    assert len(client._element_index) == 5 * 20 * 10
+    assert client['dev4.prop18.elem9'] == 9
+
+def test_subscriptions():
+    client = INDIClient(None, None, subscriptions=['test.prop', 'camwfs'])
+    client.get_properties()
+    requests = []
+    while not client._outbound_queue.empty():
+        requests.append(client._outbound_queue.get_nowait())
+    assert requests == [
+        {'action': INDIActions.GET_PROPERTIES, 'device': 'test', 'name': 'prop'},
+        {'action': INDIActions.GET_PROPERTIES, 'device': 'camwfs'},
+    ]
+    client._parser.parse(DEF_NUMBER_PROP + DEF_NUMBER_PROP.replace(b'"prop"', b'"other"'))
+    assert client._inbound_queue.qsize() == 1
+
+def test_wait_for_properties_wakes_on_definition():
+    client = INDIClient(None, None)
+    timer = threading.Timer(0.05, client.apply_update, args=(DEF_NUMBER_UPDATE,))
+    timer.start()
+    elapsed = client.wait_for_properties(['test.prop'], timeout=5)
+    timer.join()
+    assert 0.04 < elapsed < 0.5
+    assert client._property_waiters == {}
+    with pytest.raises(TimeoutError):
+        client.wait_for_properties(['test.prop', 'test.other'], timeout=0.01)
+    assert client._property_waiters == {}
+
+def test_async_wait_for_properties():
+    async def scenario():
+        client = AsyncINDIClient(None, None)
+        asyncio.get_running_loop().call_later(0.05, client.apply_update, DEF_NUMBER_UPDATE)
+        elapsed = await client.wait_for_properties(['test.prop'], timeout=5)
+        assert 0.04 < elapsed < 0.5
+        with pytest.raises(TimeoutError):
+            await client.wait_for_properties(['test.other'], timeout=0.01)
+        assert client._property_waiters == {}
+    asyncio.run(scenario())
+
+def test_wait_for_state():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    timer = threading.Timer(0.05, client.apply_update, args=(SET_NUMBER_UPDATE,))
+    timer.start()
+    elapsed = client.wait_for_state({'test.prop.value': 1.0}, timeout=5)
+    timer.join()
+    assert 0.04 < elapsed < 0.5
+    mutation, = client._outbound_queue.get_nowait()
+    assert mutation['property']['elements']['value']['value'] == 1.0
+    assert client.devices['test'].properties['prop'].watchers == set()
+    # already there, so nothing is sent
+    client.wait_for_state({'test.prop.value': {'value': 0.5, 'test': lambda cur, tgt: cur > tgt}}, timeout=0)
+    assert client._outbound_queue.empty()
+    with pytest.raises(TimeoutError):
+        client.wait_for_state({'test.prop.value': 2.0}, timeout=0.01)
+    assert client.devices['test'].properties['prop'].watchers == set()
+
+def test_async_wait_for_state():
+    async def scenario():
+        client = AsyncINDIClient(None, None)
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.02, client.apply_update, DEF_NUMBER_UPDATE)
+        loop.call_later(0.05, client.apply_update, SET_NUMBER_UPDATE)
+        elapsed = await client.wait_for_state({'test.prop.value': 1.0}, wait_for_properties=True, timeout=5)
+        assert 0.04 < elapsed < 0.5
+        with pytest.raises(TimeoutError):
+            await client.wait_for_state({'test.prop.value': 2.0}, timeout=0.01)
+        assert client.devices['test'].properties['prop'].watchers == set()
+    asyncio.run(scenario())
+
+def _set_update(state, value=1.0):
+    update = copy.deepcopy(SET_NUMBER_UPDATE)
+    update['property']['state'] = state
+    update['property']['elements']['value']['value'] = value
+    return update
+
+def test_command_futures():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    prop = client.devices['test'].properties['prop']
+    future = prop.elements['value'].set(1.0)
+    assert not future.done()
+    client.apply_update(_set_update(PropertyState.BUSY))
+    assert not future.done()
+    client.apply_update(_set_update(PropertyState.OK))
+    assert future.result(timeout=0) is prop
+    # several commands in flight settle on the same reply
+    futures = [prop.set_many({'value': 2.0}), prop.elements['value'].set(3.0)]
+    client.apply_update(_set_update(PropertyState.ALERT))
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=0)
+    future = prop.elements['value'].set(4.0, timeout=0.01)
+    with pytest.raises(TimeoutError):
+        future.result(timeout=5)
+    assert prop._pending_commands == []
+    future = prop.elements['value'].set(5.0)
+    client.apply_update(DEL_PROPERTY_UPDATE)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=0)
+
+def test_command_timeout_from_definition():
+    for timeout, times_out in (('0.05', True), ('0', False)):
+        client = INDIClient(None, None)
+        client._parser.parse(
+            f'<defNumberVector device="test" name="prop" state="Idle" perm="rw" timeout="{timeout}">'
+            '<defNumber name="value" format="%g" min="0" max="10" step="1">0</defNumber>'
+            '</defNumberVector>'.encode('utf8')
+        )
+        client.apply_update(client._inbound_queue.get_nowait())
+        prop = client.devices['test'].properties['prop']
+        future = prop.elements['value'].set(2.0)
+        if times_out:
+            assert 'No acknowledgement' in str(future.exception(timeout=5))
+            assert prop._pending_commands == []
+        else:
+            time.sleep(0.1)
+            assert not future.done() and len(prop._pending_commands) == 1
+
+def test_command_timeouts_share_a_thread():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    prop = client.devices['test'].properties['prop']
+    threads_before = threading.active_count()
+    futures = [prop.elements['value'].set(float(idx), timeout=0.05 + idx * 0.001) for idx in range(50)]
+    assert threading.active_count() <= threads_before + 1
+    for future in futures:
+        assert 'No acknowledgement' in str(future.exception(timeout=5))
+    # ...which goes away once there's nothing left to time out
+    deadline = time.monotonic() + 5
+    while client._timers._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client._timers._thread is None
+
+def test_async_command_futures():
+    async def scenario():
+        client = AsyncINDIClient(None, None)
+        client.apply_update(DEF_NUMBER_UPDATE)
+        loop = asyncio.get_running_loop()
+        prop = client.devices['test'].properties['prop']
+        futures = [prop.elements['value'].set(1.0, timeout=5), prop.set_many({'value': 1.0}, timeout=5)]
+        loop.call_later(0.02, client.apply_update, _set_update(PropertyState.IDLE))
+        assert await asyncio.gather(*futures) == [prop, prop]
+        with pytest.raises(TimeoutError):
+            await prop.elements['value'].set(2.0, timeout=0.01)
+    asyncio.run(scenario())
+
+def test_reconnect_and_resync(monkeypatch):
+    monkeypatch.setattr(client_module, 'RECONNECT_INITIAL_DELAY', 0.01)
+    monkeypatch.setattr(client_module, 'RESYNC_QUIET_PERIOD', 0.5)
+    monkeypatch.setattr(client_module, 'SYNCHRONIZATION_TIMEOUT', 0.05)
+    server = socket.create_server(('127.0.0.1', 0))
+    server.settimeout(5)
+    client = INDIClient(*server.getsockname())
+    client.start(reconnect_automatically=True)
+    try:
+        other_def = DEF_NUMBER_PROP.replace(b'name="prop"', b'name="other"')
+        conn, _ = server.accept()
+        conn.sendall(DEF_NUMBER_PROP + other_def + make_def_corpus(1, 2, 1))
+        deadline = time.monotonic() + 5
+        while 'dev0.prop1.elem0' not in client and time.monotonic() < deadline:
+            time.sleep(0.01)
+        prop = client.devices['test'].properties['prop']
+        other = client.devices['test'].properties['other']
+        changes, element_changes, other_changes, other_element_changes = [], [], [], []
+        prop.add_watcher(lambda p, did_anything_change: changes.append(did_anything_change))
+        prop.elements['value'].add_watcher(lambda e, did_anything_change: element_changes.append(did_anything_change))
+        other.add_watcher(lambda p, did_anything_change: other_changes.append(did_anything_change))
+        other.elements['value'].add_watcher(lambda e, did_anything_change: other_element_changes.append(did_anything_change))
+        conn.close()
+        conn, _ = server.accept()
+        deadline = time.monotonic() + 5
+        while not prop.stale and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert prop.stale
+        # same definition again, a new value for other, and dev0 is gone
+        conn.sendall(DEF_NUMBER_PROP + other_def.replace(b'\n0\n', b'\n7\n'))
+        deadline = time.monotonic() + 5
+        while 'dev0' in client.devices and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert 'dev0' not in client.devices
+        assert 'dev0.prop0.elem0' not in client
+        assert client.devices['test'].properties['prop'] is prop
+        assert not prop.stale
+        # only what changed is reported
+        assert changes == element_changes == []
+        assert other_changes == other_element_changes == [True]
+        assert client['test.other.value'] == 7
+        assert client.status is ConnectionStatus.CONNECTED
+    finally:
+        client.stop()
+        conn.close()
+        server.close()
+
+def test_initial_sync(monkeypatch):
+    monkeypatch.setattr(client_module, 'SYNC_QUIET_PERIOD', 0.1)
+    server = socket.create_server(('127.0.0.1', 0))
+    server.settimeout(5)
+    client = INDIClient(*server.getsockname())
+    updates = []
+    client.add_watcher(lambda update, did_anything_change: updates.append(update['action']))
+    client.start(initial_sync=True)
+    try:
+        conn, _ = server.accept()
+        conn.sendall(DEF_NUMBER_PROP + make_def_corpus(2, 3, 4))
+        summary = client.synced.result(timeout=5)
+        assert summary['devices'] == 3 and summary['properties'] == 7 and summary['elements'] == 25
+        assert summary['definitions'] == 7 and summary['elapsed'] < 1
+        # no watchers during the sync, business as usual afterwards
+        assert updates == []
+        conn.sendall(SET_NUMBER_PROP)
+        deadline = time.monotonic() + 5
+        while not updates and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert updates == [INDIActions.PROPERTY_SET]
+    finally:
+        client.stop()
+        conn.close()
+        server.close()
+
+def test_wait_for_state_during_initial_sync(monkeypatch):
+    monkeypatch.setattr(client_module, 'SYNC_QUIET_PERIOD', 5)
+    server = socket.create_server(('127.0.0.1', 0))
+    server.settimeout(5)
+    client = INDIClient(*server.getsockname())
+    client.start(initial_sync=True)
+    try:
+        conn, _ = server.accept()
+        conn.sendall(DEF_NUMBER_PROP)
+        timer = threading.Timer(0.1, conn.sendall, args=(SET_NUMBER_PROP,))
+        timer.start()
+        # only definitions are kept from watchers, so the set message still counts
+        client.wait_for_state({'test.prop.value': 1.0}, wait_for_properties=True, timeout=2)
+        timer.join()
+        assert not client.synced.done()
+    finally:
+        client.stop()
+        conn.close()
+        server.close()
+
+def test_async_initial_sync(monkeypatch):
+    monkeypatch.setattr(client_module, 'SYNC_QUIET_PERIOD', 0.1)
+    async def scenario():
+        async def serve(reader, writer):
+            writer.write(DEF_NUMBER_PROP)
+            await writer.drain()
+            await reader.read()
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        client = AsyncINDIClient(*server.sockets[0].getsockname()[:2])
+        updates = []
+        async def watcher(update, did_anything_change):
+            updates.append(update)
+        client.add_async_watcher(watcher)
+        runner = asyncio.ensure_future(client.run(initial_sync=True))
+        while client.synced is None:
+            await asyncio.sleep(0.01)
+        summary = await asyncio.wait_for(client.synced, 5)
+        assert summary['properties'] == 1 and updates == []
+        await client.stop()
+        await asyncio.gather(runner, return_exceptions=True)
+        server.close()
+    asyncio.run(scenario())
+
+def test_cached_serialization():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    _define_numbers(client, 'stage', 'position', ['x', 'y'])
+    prop = client.devices['test'].properties['prop']
+    other = client.devices['stage'].properties['position']
+    tree, serialized = client.to_jsonable(), client.to_json()
+    assert serialized == json.dumps(tree, sort_keys=True)
+    assert client.to_jsonable() is tree and client.to_json() is serialized
+    other_jsonable = other.to_jsonable()
+    client.apply_update(SET_NUMBER_UPDATE)
+    assert prop.to_jsonable()['elements']['value']['value'] == 1.0
+    assert other.to_jsonable() is other_jsonable
+    assert client.to_json() == json.dumps(client._build_jsonable(), sort_keys=True)
+    assert json.loads(client.to_json())['test']['properties']['prop']['elements']['value']['value'] == 1.0
+    # no change, nothing rebuilt
+    tree = client.to_jsonable()
+    client.apply_update(SET_NUMBER_UPDATE)
+    assert client.to_jsonable() is tree
+    client.apply_update(DEL_PROPERTY_UPDATE)
+    assert set(json.loads(client.to_json())) == {'stage'}
@@ -0,0 +1,89 @@
+import threading
+import time
+from .client import INDIClient
+from .constants import OverflowPolicy
+from .dispatch import WatcherDispatcher
+from .test_fixtures import (
+    DEF_NUMBER_UPDATE,
+    SET_NUMBER_UPDATE,
+)
+
+def _blocked_watcher(dispatcher, **kwargs):
+    release = threading.Event()
+    seen = []
+    def callback(value):
+        release.wait()
+        seen.append(value)
+    return dispatcher.wrap(callback, **kwargs), release, seen
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_drop_oldest():
+    dispatcher = WatcherDispatcher(workers=1)
+    watcher, release, seen = _blocked_watcher(dispatcher, max_pending=3, overflow=OverflowPolicy.DROP_OLDEST)
+    watcher(0)
+    _wait_for(lambda: watcher.pending == 0)  # 0 is now running, blocked on `release`
+    for idx in range(1, 6):
+        watcher(idx)
+    assert watcher.pending == 3
+    assert watcher.dropped == 2
+    assert watcher.lag > 0
+    release.set()
+    _wait_for(lambda: watcher.delivered == 4)
+    assert seen == [0, 3, 4, 5]
+    dispatcher.shutdown()
+
+def test_conflate_latest():
+    dispatcher = WatcherDispatcher(workers=1)
+    watcher, release, seen = _blocked_watcher(dispatcher, overflow=OverflowPolicy.CONFLATE_LATEST)
+    watcher(0)
+    _wait_for(lambda: watcher.pending == 0)
+    for idx in range(1, 6):
+        watcher(idx)
+    release.set()
+    _wait_for(lambda: watcher.delivered == 2)
+    assert seen == [0, 5]
+    assert watcher.dropped == 4
+    dispatcher.shutdown()
+
+def test_block():
+    dispatcher = WatcherDispatcher(workers=1)
+    watcher, release, seen = _blocked_watcher(dispatcher, max_pending=1, overflow=OverflowPolicy.BLOCK)
+    watcher(0)
+    _wait_for(lambda: watcher.pending == 0)
+    watcher(1)
+    producer = threading.Thread(target=watcher, args=(2,))
+    producer.start()
+    producer.join(0.05)
+    assert producer.is_alive()
+    release.set()
+    producer.join(5)
+    _wait_for(lambda: watcher.delivered == 3)
+    assert seen == [0, 1, 2]
+    assert watcher.dropped == 0
+    dispatcher.shutdown()
+
+def test_dispatched_element_watcher():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    element = client.devices['test'].properties['prop'].elements['value']
+    release = threading.Event()
+    seen = []
+    def slow_watcher(elem, did_anything_change):
+        release.wait()
+        seen.append(elem.value)
+    element.add_watcher(slow_watcher, dispatch=True)
+    started = time.monotonic()
+    client.apply_update(SET_NUMBER_UPDATE)
+    assert time.monotonic() - started < 1
+    release.set()
+    _wait_for(lambda: seen == [1.0])
+    stats, = client.dispatcher.stats()
+    assert stats['callback'] is slow_watcher
+    assert stats['delivered'] == 1
+    element.remove_watcher(slow_watcher)
+    assert len(element.watchers) == 0
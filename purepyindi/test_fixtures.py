@@ -87,3 +87,84 @@ DEL_PROPERTY_UPDATE = {
     'device': 'test',
     'timestamp': datetime.datetime(2019, 9, 3, 21, 45, 4, 31508, tzinfo=datetime.timezone.utc),
 }
+
+def make_message_corpus(n_messages, seed=0):
+    '''
+    Generate a reproducible stream of `n_messages` INDI messages,
+    mostly ``set*Vector`` telemetry with the occasional definition,
+    deletion, and malformed value mixed in
+    '''
+    import random
+    rng = random.Random(seed)
+    kinds = [
+        ('Number', lambda: repr(rng.uniform(-1e3, 1e3))),
+        ('Switch', lambda: rng.choice(['On', 'Off'])),
+        ('Text', lambda: rng.choice(['hello', 'a &amp; b', ''])),
+        ('Light', lambda: rng.choice(['Idle', 'Ok', 'Busy', 'Alert'])),
+    ]
+    messages = []
+    for idx in range(n_messages):
+        device = f"dev{rng.randrange(4)}"
+        kind, make_value = kinds[0] if rng.random() < 0.6 else rng.choice(kinds)
+        roll = rng.random()
+        if roll < 0.05:
+            messages.append(
+                f'<defNumberVector device="{device}" name="prop{idx % 7}" state="Ok" perm="rw" '
+                f'label="A label" group="grp" timestamp="2019-08-12T20:49:50.{idx % 1000000:06d}Z">\n'
+                f'\t<defNumber name="elem0" format="%g" min="0" max="10" step="1">\n{idx}\n\t</defNumber>\n'
+                f'</defNumberVector>\n'
+            )
+            continue
+        if roll < 0.07:
+            messages.append(f'<delProperty device="{device}" name="prop{idx % 7}" timestamp="2019-09-03T21:45:04.031508Z"/>\n')
+            continue
+        attrs = f'device="{device}" name="prop{idx % 7}"'
+        if rng.random() < 0.9:
+            attrs += f' state="{rng.choice(["Idle", "Ok", "Busy", "Alert"])}"'
+        if rng.random() < 0.9:
+            attrs += f' timestamp="2019-08-{rng.randrange(10, 29)}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{rng.randrange(1000000):06d}Z"'
+        if rng.random() < 0.1:
+            attrs += ' timeout="60" message="hi"'
+        parts = [f'<set{kind}Vector {attrs}>\n']
+        for elem_idx in range(rng.randrange(1, 5)):
+            if kind == 'Number' and rng.random() < 0.02:
+                value = 'not-a-number'
+            elif rng.random() < 0.05:
+                value = ' '
+            else:
+                value = make_value()
+            label = ' label="Elem"' if rng.random() < 0.05 else ''
+            parts.append(f'\t<one{kind} name="elem{elem_idx}"{label}>\n{value}\n\t</one{kind}>\n')
+        parts.append(f'</set{kind}Vector>\n')
+        messages.append(''.join(parts))
+    return ''.join(messages).encode('utf8')
+
+def make_def_corpus(n_devices, n_properties, n_elements):
+    '''
+    Generate ``def*Vector`` messages for `n_devices` devices with
+    `n_properties` properties of `n_elements` elements each, like the
+    flood of definitions a large ``indiserver`` sends on connection
+    '''
+    messages = []
+    for device_idx in range(n_devices):
+        for prop_idx in range(n_properties):
+            if prop_idx % 4 == 3:
+                messages.append(
+                    f'<defSwitchVector device="dev{device_idx}" name="prop{prop_idx}" state="Idle" perm="rw" '
+                    f'rule="OneOfMany" timestamp="2019-08-12T20:49:50.420459Z">\n'
+                )
+                for elem_idx in range(n_elements):
+                    messages.append(f'\t<defSwitch name="elem{elem_idx}">\n{"On" if elem_idx == 0 else "Off"}\n\t</defSwitch>\n')
+                messages.append('</defSwitchVector>\n')
+            else:
+                messages.append(
+                    f'<defNumberVector device="dev{device_idx}" name="prop{prop_idx}" state="Idle" perm="rw" '
+                    f'timestamp="2019-08-12T20:49:50.420459Z">\n'
+                )
+                for elem_idx in range(n_elements):
+                    messages.append(
+                        f'\t<defNumber name="elem{elem_idx}" format="%g" min="0" max="100" step="1">\n'
+                        f'{elem_idx}\n\t</defNumber>\n'
+                    )
+                messages.append('</defNumberVector>\n')
+    return ''.join(messages).encode('utf8')
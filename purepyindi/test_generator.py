@@ -1,13 +1,69 @@
 import asyncio
+import datetime
+import random
+import xml.etree.ElementTree as ET
 from .test_fixtures import (
     NEW_NUMBER_MUTATION,
     NEW_NUMBER_MESSAGE,
     NEW_NUMBER_TIMESTAMP,
 )
-from .generator import mutation_to_xml_message
+from .constants import INDIActions, INDIPropertyKind, SwitchState
+from .generator import (
+    PropertyMutation,
+    mutation_to_xml_message,
+    construct_property_new,
+    encode_property_new,
+    format_datetime_as_iso,
+    format_epoch_as_iso,
+    format_timestamp_as_iso,
+)
 from pprint import pprint
 from io import BytesIO
 
 def test_generator():
     message = mutation_to_xml_message(NEW_NUMBER_MUTATION, timestamp=NEW_NUMBER_TIMESTAMP)
     assert message == NEW_NUMBER_MESSAGE
+
+def test_property_mutation():
+    mutation = PropertyMutation('test', 'prop', INDIPropertyKind.NUMBER, {'value': 0.0}, NEW_NUMBER_TIMESTAMP.timestamp())
+    assert mutation_to_xml_message(mutation) == NEW_NUMBER_MESSAGE
+    assert mutation_to_xml_message(mutation, timestamp=NEW_NUMBER_TIMESTAMP) == NEW_NUMBER_MESSAGE
+    assert encode_property_new(mutation, format_epoch_as_iso(mutation.timestamp)) == NEW_NUMBER_MESSAGE
+
+def test_format_epoch_as_iso():
+    import random
+    rng = random.Random(0)
+    for _ in range(1000):
+        dt = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+            microseconds=rng.randrange(10**14)
+        )
+        assert format_epoch_as_iso(dt.timestamp()) == format_datetime_as_iso(dt)
+    assert format_timestamp_as_iso(None) is None
+    assert format_timestamp_as_iso(NEW_NUMBER_TIMESTAMP) == '2019-08-13T22:45:17.867692Z'
+
+def test_template_encoder_matches_elementtree():
+    rng = random.Random(0)
+    alphabet = 'ab &<>"\'\r\n\t\u00e9\u2603'
+    def random_string(min_length=0):
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(min_length, 6)))
+    values = {
+        INDIPropertyKind.NUMBER: lambda: rng.choice([None, 0, -1.5, 1e300, float('nan'), rng.random()]),
+        INDIPropertyKind.TEXT: lambda: rng.choice([None, '', random_string()]),
+        INDIPropertyKind.SWITCH: lambda: rng.choice([SwitchState.ON, SwitchState.OFF]),
+    }
+    for _ in range(2000):
+        kind = rng.choice(list(values))
+        element_names = {random_string(1) for _ in range(rng.randint(1, 4))}
+        mutation = {
+            'action': INDIActions.PROPERTY_NEW,
+            'device': random_string(1),
+            'property': {
+                'name': random_string(1),
+                'kind': kind,
+                'elements': {name: {'name': name, 'value': values[kind]()} for name in element_names},
+            },
+        }
+        timestamp = format_epoch_as_iso(rng.random() * 2e9)
+        expected = ET.tostring(construct_property_new(mutation, timestamp), encoding='unicode').encode('utf8') + b'\n'
+        assert encode_property_new(mutation, timestamp) == expected
+        assert mutation_to_xml_message(mutation, timestamp=timestamp) == expected
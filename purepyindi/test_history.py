@@ -0,0 +1,287 @@
+import copy
+import datetime
+import gc
+import json
+import math
+import os
+from collections import deque
+import pytest
+from .client import INDIClient
+from .constants import INDIActions
+from .history import (
+    ElementHistory,
+    NumberElementHistory,
+    MmapElementHistory,
+    MMAP_POOL,
+    DEFAULT_MAX_OPEN_HISTORY_FILES,
+    HistoryManager,
+    DISABLED_NUMBER_HISTORY,
+    INITIAL_HISTORY_CAPACITY,
+    numpy,
+)
+from .test_fixtures import (
+    DEF_NUMBER_UPDATE,
+    SET_NUMBER_UPDATE,
+)
+
+def test_ring_buffer_wraparound():
+    history = NumberElementHistory(None, max_history=5)
+    reference = deque(maxlen=5)
+    for idx in range(13):
+        history.add(float(idx), idx * 10.0)
+        reference.append(idx)
+        assert len(history) == len(reference)
+        assert history.times == [float(t) for t in reference]
+        assert history.values == [t * 10.0 for t in reference]
+
+def test_buffer_grows_on_demand():
+    history = NumberElementHistory(None, max_history=50)
+    assert len(history._times) == 2 * INITIAL_HISTORY_CAPACITY
+    reference = deque(maxlen=50)
+    for idx in range(130):
+        history.add(float(idx), idx * 10.0)
+        reference.append(idx)
+        assert history.values == [t * 10.0 for t in reference]
+    assert len(history._times) == 100
+
+def test_histories_created_on_first_change():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    update = copy.deepcopy(DEF_NUMBER_UPDATE)
+    update['property']['name'] = 'other'
+    client.apply_update(update)
+    elements = [prop.elements['value'] for prop in client.devices['test'].properties.values()]
+    assert [element._history for element in elements] == [None, None]
+    # the defining value is kept, and goes in the history once there is one
+    client.apply_update(SET_NUMBER_UPDATE)
+    assert elements[0]._history is not None and elements[1]._history is None
+    assert elements[0].history.values == [0.0, 1.0]
+    assert elements[0].history.times == [
+        DEF_NUMBER_UPDATE['property']['timestamp'], SET_NUMBER_UPDATE['property']['timestamp']
+    ]
+    assert elements[1].history.values == [0.0]
+
+def test_array_views_are_zero_copy():
+    history = NumberElementHistory(None, max_history=4)
+    for idx in range(6):
+        history.add(float(idx), None)
+    times = history.times_array()
+    assert times.obj is history._times
+    assert times.tolist() == [2.0, 3.0, 4.0, 5.0]
+    assert all(math.isnan(v) for v in history.values_array())
+
+def test_resize_keeps_newest():
+    history = NumberElementHistory(None, max_history=10)
+    for idx in range(8):
+        history.add(float(idx), float(idx))
+    history.max_history = 3
+    assert history.values == [5.0, 6.0, 7.0]
+    history.max_history = 0
+    history.add(8.0, 8.0)
+    assert history.values == []
+
+def test_datetime_times_shim():
+    history = NumberElementHistory(None)
+    timestamp = SET_NUMBER_UPDATE['property']['timestamp']
+    history.add(timestamp, 1.0)
+    history.add(None, 2.0)
+    assert history.times == [timestamp, None]
+
+@pytest.mark.skipif(numpy is None, reason="NumPy not installed")
+def test_numpy_backing():
+    history = NumberElementHistory(None, max_history=3, use_numpy=True)
+    for idx in range(5):
+        history.add(float(idx), float(idx))
+    assert history.values_array().base is history._values
+    assert history.values == [2.0, 3.0, 4.0]
+
+def test_number_elements_use_ring_buffer():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    client.apply_update(SET_NUMBER_UPDATE)
+    element = client.devices['test'].properties['prop'].elements['value']
+    assert isinstance(element.history, NumberElementHistory)
+    assert element.history.values == [0.0, 1.0]
+    assert element.to_jsonable()['history']['times'][-1] == '2019-08-12T20:49:50.420459Z'
+
+def test_mmap_history_wraparound_and_query(tmp_path):
+    path = str(tmp_path / 'elem.history')
+    history = MmapElementHistory(None, path, max_records=100)
+    for idx in range(250):
+        history.add(float(idx), idx * 2.0)
+    assert len(history) == 100
+    assert os.path.getsize(path) == MmapElementHistory.HEADER.size + 100 * MmapElementHistory.RECORD.size
+    times, values = history.query(200.0, 209.5)
+    assert times.tolist() == [float(t) for t in range(200, 210)]
+    assert values.tolist() == [t * 2.0 for t in range(200, 210)]
+    assert history.query(end_time=150.5)[0].tolist() == [150.0]
+    assert len(history.query(start_time=1000.0)[0]) == 0
+    assert history.values == [t * 2.0 for t in range(150, 250)]
+    assert history.to_dict()['times'][-1] == 249.0
+    history.close()
+    # reopening resumes, a different size starts over
+    history = MmapElementHistory(None, path, max_records=100)
+    assert history.times[0] == 150.0
+    history.close()
+    history = MmapElementHistory(None, path, max_records=10)
+    assert len(history) == 0
+    history.close()
+
+def test_client_history_dir(tmp_path):
+    client = INDIClient(None, None, history_dir=str(tmp_path))
+    client.apply_update(DEF_NUMBER_UPDATE)
+    client.apply_update(SET_NUMBER_UPDATE)
+    element = client.devices['test'].properties['prop'].elements['value']
+    assert isinstance(element.history, MmapElementHistory)
+    assert os.path.exists(tmp_path / 'test.prop.value.history')
+    assert element.history.values == [0.0, 1.0]
+    assert element.history.times[-1] == SET_NUMBER_UPDATE['property']['timestamp']
+
+def _is_mapped(history):
+    return history.path in history.pool._maps
+
+def test_mmap_histories_within_fd_limit(tmp_path):
+    resource = pytest.importorskip('resource')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    n_open = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else 64
+    limit = n_open + DEFAULT_MAX_OPEN_HISTORY_FILES + 16
+    n_elements = 2 * limit
+    client = INDIClient(None, None, history_dir=str(tmp_path), history_max_records=16)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        update = copy.deepcopy(DEF_NUMBER_UPDATE)
+        template = update['property']['elements'].pop('value')
+        for idx in range(n_elements):
+            update['property']['elements'][f'e{idx}'] = dict(template, name=f'e{idx}', value=float(idx))
+        client.apply_update(update)
+        update = copy.deepcopy(update)
+        update['action'] = INDIActions.PROPERTY_SET
+        for element_update in update['property']['elements'].values():
+            element_update['value'] += 0.5
+        client.apply_update(update)
+        elements = client.devices['test'].properties['prop'].elements
+        assert all(elements[f'e{idx}'].history.values[-1] == idx + 0.5 for idx in range(n_elements))
+        assert len(MMAP_POOL) <= DEFAULT_MAX_OPEN_HISTORY_FILES
+    finally:
+        client.stop()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_mmap_history_file_created_on_first_sample(tmp_path):
+    path = str(tmp_path / 'elem.history')
+    history = MmapElementHistory(None, path, max_records=10)
+    assert not os.path.exists(path) and history.query()[0].tolist() == []
+    history.add(1.0, 2.0)
+    assert os.path.exists(path) and history.values == [2.0]
+    history.close()
+
+def test_mmap_histories_closed_with_elements(tmp_path):
+    client = INDIClient(None, None, history_dir=str(tmp_path))
+    def define(elements=('value',), device='test'):
+        update = copy.deepcopy(DEF_NUMBER_UPDATE)
+        update['device'] = device
+        template = update['property']['elements'].pop('value')
+        for name in elements:
+            update['property']['elements'][name] = dict(template, name=name)
+        client.apply_update(update)
+        prop = client.devices[device].properties['prop']
+        return [prop.elements[name].history for name in elements]
+    # a redefinition dropping an element, then a property delete
+    kept, dropped = define(['value', 'other'])
+    define(['value'])
+    assert not _is_mapped(dropped) and _is_mapped(kept)
+    client.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': 'test', 'name': 'prop'})
+    assert not _is_mapped(kept)
+    # a device delete
+    history, = define()
+    client.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': 'test'})
+    assert not _is_mapped(history)
+    # stopping the client, after which histories are reopened on demand
+    history, = define()
+    client.stop()
+    assert not _is_mapped(history)
+    element = client.devices['test'].properties['prop'].elements['value']
+    assert element.history is not history
+    # the file carries on across all three definitions of the element
+    assert element.history.values == [0.0] * 3
+
+def test_history_policies():
+    for policies, expected in (
+        ({'other.*': 10, 'test.prop.*': 2, '*': 0}, [2.0, 3.0]),
+        ({'*': 0}, []),
+        (None, [0.0, 1.0, 2.0, 3.0]),
+    ):
+        client = INDIClient(None, None, history_policies=policies)
+        client.apply_update(DEF_NUMBER_UPDATE)
+        update = copy.deepcopy(SET_NUMBER_UPDATE)
+        for value in (1.0, 2.0, 3.0):
+            update['property']['elements']['value']['value'] = value
+            client.apply_update(update)
+        history = client.devices['test'].properties['prop'].elements['value'].history
+        assert history.values == expected
+        assert (history is DISABLED_NUMBER_HISTORY) == (expected == [])
+        assert list(history.values_array()) == expected
+
+def test_disabled_history_interface(tmp_path):
+    client = INDIClient(None, None, history_dir=str(tmp_path), history_policies={'*.prop.*': 0})
+    client.apply_update(DEF_NUMBER_UPDATE)
+    client.apply_update(SET_NUMBER_UPDATE)
+    history = client.devices['test'].properties['prop'].elements['value'].history
+    assert len(history.times_array()) == len(history.query()[0]) == len(history.recent(10)[1]) == 0
+    assert history.to_jsonable() == history.to_dict() == {'times': [], 'values': []}
+    assert not os.listdir(tmp_path)
+
+def test_history_policies_size_mmap_files(tmp_path):
+    client = INDIClient(None, None, history_dir=str(tmp_path), history_policies={'test.prop.*': 5})
+    client.apply_update(DEF_NUMBER_UPDATE)
+    history = client.devices['test'].properties['prop'].elements['value'].history
+    assert isinstance(history, MmapElementHistory)
+    assert history.max_history == 5
+    client = INDIClient(None, None, history_dir=str(tmp_path / 'other'), history_policies={'x.*': 5})
+    os.mkdir(tmp_path / 'other')
+    client.apply_update(DEF_NUMBER_UPDATE)
+    history = client.devices['test'].properties['prop'].elements['value'].history
+    assert history.max_history == client.history_max_records
+
+def test_history_byte_budget():
+    manager = HistoryManager(max_bytes=2000)
+    first, second, third = histories = [manager.adopt(ElementHistory(None)) for _ in range(3)]
+    for history in (first, second):
+        for idx in range(10):
+            history.add(float(idx), 'x' * 10)
+    assert manager.total_bytes == first.nbytes + second.nbytes
+    # the one that's been read outlives the one that hasn't
+    manager.touch(first)
+    for idx in range(10):
+        third.add(float(idx), 'x' * 10)
+    assert (len(first), len(second), len(third)) == (10, 0, 10)
+    assert manager.total_bytes == first.nbytes + third.nbytes <= 2000
+    stats = manager.stats()
+    assert stats['evictions'] == 1 and stats['histories'] == 2
+    # cleared histories count again once they grow back
+    second.add(10.0, 'x')
+    assert manager.stats()['histories'] == 3
+    del first, second, third, history, histories
+    gc.collect()
+    assert manager.stats()['histories'] == manager.total_bytes == 0
+
+def test_evicted_histories_reserialized():
+    client = INDIClient(None, None, history_max_bytes=2000)
+    for name in ('first', 'second'):
+        update = copy.deepcopy(DEF_NUMBER_UPDATE)
+        update['property']['name'] = name
+        client.apply_update(update)
+    def set_value(name, value):
+        update = copy.deepcopy(SET_NUMBER_UPDATE)
+        update['property']['name'] = name
+        update['property']['elements']['value']['value'] = value
+        client.apply_update(update)
+    def serialized_history(name):
+        return json.loads(client.to_json())['test']['properties'][name]['elements']['value']['history']['values']
+    for idx in range(1, 20):
+        set_value('first', float(idx))
+    assert len(serialized_history('first')) == 20
+    # the first history is cleared to make room for the second
+    for idx in range(1, 200):
+        set_value('second', float(idx))
+    assert client.history_manager.stats()['evictions'] >= 1
+    assert serialized_history('first') == []
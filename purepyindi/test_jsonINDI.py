@@ -0,0 +1,64 @@
+import copy
+import io
+import json
+import time
+from .client import INDIClient
+from .constants import INDIActions
+from .jsonINDI import DeltaStream, subscriptions_for
+from .test_fixtures import DEF_NUMBER_UPDATE, SET_NUMBER_UPDATE, DEL_PROPERTY_UPDATE
+
+def _lines(out):
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_delta_stream():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    out = io.StringIO()
+    streamer = DeltaStream(client, out)
+    streamer.start()
+    client.apply_update(SET_NUMBER_UPDATE)
+    client.apply_update(SET_NUMBER_UPDATE)  # no change, no line
+    client.apply_update(DEL_PROPERTY_UPDATE)
+    snapshot, delta, deleted = _lines(out)
+    assert snapshot['snapshot']['test']['properties']['prop']['elements']['value']['value'] == 0.0
+    assert delta == {
+        'device': 'test',
+        'property': 'prop',
+        'state': 'Idle',
+        'timestamp': '2019-08-12T20:49:50.420459Z',
+        'elements': {'value': 1.0},
+    }
+    assert deleted == {'device': 'test', 'property': None, 'deleted': True}
+
+def test_delta_stream_filters_and_rate():
+    client = INDIClient(None, None)
+    client.apply_update(DEF_NUMBER_UPDATE)
+    other = copy.deepcopy(DEF_NUMBER_UPDATE)
+    other['device'] = 'other'
+    client.apply_update(other)
+    out = io.StringIO()
+    streamer = DeltaStream(client, out, device_patterns=['te*'], max_rate=10)
+    streamer.start()
+    for value in (1.0, 2.0, 3.0):
+        update = copy.deepcopy(SET_NUMBER_UPDATE)
+        update['property']['elements']['value']['value'] = value
+        client.apply_update(update)
+        update['device'] = 'other'
+        client.apply_update(update)
+    snapshot, first = _lines(out)
+    assert set(snapshot['snapshot']) == {'test'}
+    assert first['elements'] == {'value': 1.0}
+    time.sleep(0.1)
+    streamer.flush_due()
+    assert _lines(out)[2]['elements'] == {'value': 3.0}
+    assert len(_lines(out)) == 3
+    # device deletes go through the filters too, and unknown devices are ignored
+    for device_name in ('other', 'nope', 'test'):
+        client.apply_update({'action': INDIActions.PROPERTY_DEL, 'device': device_name})
+    assert _lines(out)[3:] == [{'device': 'test', 'property': None, 'deleted': True}]
+
+def test_subscriptions_for():
+    assert subscriptions_for(None, None) is None
+    assert subscriptions_for(['camwfs*'], None) is None
+    assert subscriptions_for(['camwfs'], None) == ['camwfs']
+    assert subscriptions_for(['camwfs', 'tweeter'], ['camwfs.fps', 'other.x']) == ['camwfs.fps']
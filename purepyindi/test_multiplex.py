@@ -0,0 +1,95 @@
+import pytest
+import socket
+import threading
+import time
+from .constants import ConnectionStatus
+from .multiplex import MultiplexedINDIClient
+from .test_fixtures import DEF_NUMBER_PROP, make_def_corpus
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def _recv_until(conn, needle, timeout=5):
+    conn.settimeout(timeout)
+    received = b''
+    while needle not in received:
+        chunk = conn.recv(65536)
+        assert chunk, "connection closed"
+        received += chunk
+    return received
+
+def test_multiplexed_client():
+    servers = [socket.create_server(('127.0.0.1', 0)) for _ in range(2)]
+    client = MultiplexedINDIClient([server.getsockname() for server in servers])
+    threads_before = threading.active_count()
+    client.start()
+    try:
+        assert threading.active_count() == threads_before + 1
+        conns = [server.accept()[0] for server in servers]
+        for conn in conns:
+            assert b'getProperties' in _recv_until(conn, b'getProperties')
+        conns[0].sendall(DEF_NUMBER_PROP)
+        conns[1].sendall(make_def_corpus(2, 3, 4))
+        _wait_until(lambda: 'test.prop.value' in client and 'dev1.prop2.elem3' in client)
+        assert set(client.devices) == {'test', 'dev0', 'dev1'}
+        assert client.connection_for('dev1') is client.connections[1]
+        client['dev1.prop0.elem0'] = 5
+        assert b'name="elem0"' in _recv_until(conns[1], b'</newNumberVector>')
+        client['test.prop.value'] = 6
+        assert b'device="test"' in _recv_until(conns[0], b'</newNumberVector>')
+        # ...and nothing for test went to the other server
+        conns[1].settimeout(0.05)
+        with pytest.raises(socket.timeout):
+            conns[1].recv(65536)
+    finally:
+        client.stop()
+        for conn in conns:
+            conn.close()
+        for server in servers:
+            server.close()
+
+def test_failed_start_unregisters_sockets():
+    server = socket.create_server(('127.0.0.1', 0))
+    unused = socket.create_server(('127.0.0.1', 0))
+    unused_address = unused.getsockname()
+    unused.close()
+    client = MultiplexedINDIClient([server.getsockname(), unused_address])
+    try:
+        with pytest.raises(OSError):
+            client.start()
+        # only the wakeup socket is left registered
+        assert len(client._selector.get_map()) == 1
+        assert all(conn.socket is None for conn in client.connections)
+    finally:
+        server.close()
+
+def test_failed_send_drops_only_that_connection():
+    servers = [socket.create_server(('127.0.0.1', 0)) for _ in range(2)]
+    client = MultiplexedINDIClient([server.getsockname() for server in servers])
+    client.start()
+    try:
+        conns = [server.accept()[0] for server in servers]
+        for conn in conns:
+            _recv_until(conn, b'getProperties')
+        conns[0].sendall(DEF_NUMBER_PROP)
+        conns[1].sendall(make_def_corpus(1, 1, 1))
+        _wait_until(lambda: 'test.prop.value' in client and 'dev0.prop0.elem0' in client)
+        # the pipe to the second server breaks, with nothing to read
+        # from it, so only sending finds out
+        client.connections[1].socket.shutdown(socket.SHUT_WR)
+        client['dev0.prop0.elem0'] = 5
+        _wait_until(lambda: client.connections[1].status is ConnectionStatus.ERROR)
+        # ...which leaves the first one working
+        assert client._loop_thread.is_alive()
+        client['test.prop.value'] = 6
+        assert b'device="test"' in _recv_until(conns[0], b'</newNumberVector>')
+    finally:
+        client.stop()
+        for conn in conns:
+            conn.close()
+        for server in servers:
+            server.close()
+    assert client._selector is None and client._wake_sender is None
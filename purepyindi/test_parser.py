@@ -1,5 +1,6 @@
 import asyncio
-from .parser import INDIStreamParser
+import pytest
+from .parser import INDIStreamParser, parse_subscriptions
 from .constants import *
 from .test_fixtures import (
     DEF_NUMBER_PROP,
@@ -8,6 +9,7 @@ from .test_fixtures import (
     SET_NUMBER_UPDATE,
     DEL_PROPERTY_MESSAGE,
     DEL_PROPERTY_UPDATE,
+    make_message_corpus,
 )
 from pprint import pprint
 from io import BytesIO
@@ -36,3 +38,77 @@ def test_delete_device():
     parser.parse(data)
     del_property_parsed = q.get_nowait()
     assert del_property_parsed == DEL_PROPERTY_UPDATE
+
+def _parse_all(data, fast_path, chunk_size):
+    q = asyncio.Queue()
+    parser = INDIStreamParser(q, fast_path=fast_path)
+    for idx in range(0, len(data), chunk_size):
+        parser.parse(data[idx:idx + chunk_size])
+    updates = []
+    while not q.empty():
+        updates.append(q.get_nowait())
+    return updates
+
+def test_set_vector_fast_path_matches_generic_parser():
+    corpus = make_message_corpus(2000, seed=1234)
+    expected = _parse_all(corpus, fast_path=False, chunk_size=len(corpus))
+    assert len(expected) == 2000
+    for chunk_size in (7, 1024, len(corpus)):
+        assert _parse_all(corpus, fast_path=True, chunk_size=chunk_size) == expected
+
+def test_set_vector_fast_path_rejects_bad_enum():
+    q = asyncio.Queue()
+    parser = INDIStreamParser(q)
+    with pytest.raises(ValueError):
+        parser.parse(b'<setSwitchVector device="d" name="p"><oneSwitch name="e">Maybe</oneSwitch></setSwitchVector>')
+
+def test_iso_timestamp_decoding():
+    import datetime
+    import random
+    from .parser import parse_iso_to_datetime, parse_iso_to_epoch
+    rng = random.Random(0)
+    for _ in range(1000):
+        dt = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+            seconds=rng.uniform(0, 1e8)
+        )
+        timestamp = dt.strftime(ISO_TIMESTAMP_FORMAT)
+        expected = datetime.datetime.strptime(timestamp, ISO_TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc)
+        assert parse_iso_to_datetime(timestamp) == expected
+        assert abs(parse_iso_to_epoch(timestamp) - expected.timestamp()) < 1e-6
+    assert parse_iso_to_datetime('2019-08-12T20:49:50.4Z').microsecond == 400000
+    with pytest.raises(ValueError):
+        parse_iso_to_epoch('2019-08-12T25:49:50.420459Z')
+    with pytest.raises(ValueError):
+        parse_iso_to_datetime('2019-08-12 20:49:50')
+
+def test_epoch_timestamps():
+    q = asyncio.Queue()
+    parser = INDIStreamParser(q, epoch_timestamps=True)
+    parser.parse(SET_NUMBER_PROP)
+    update = q.get_nowait()
+    assert update['property']['timestamp'] == SET_NUMBER_UPDATE['property']['timestamp'].timestamp()
+
+def test_subscriptions_skip_other_properties():
+    corpus = make_message_corpus(2000, seed=42)
+    subscriptions = parse_subscriptions(['dev0', 'dev1.prop2', 'dev1.prop3'])
+    assert subscriptions == {'dev0': None, 'dev1': {'prop2', 'prop3'}}
+    def wanted(update):
+        if update['device'] == 'dev0':
+            return True
+        if update['device'] != 'dev1':
+            return False
+        name = update['name'] if update['action'] is INDIActions.PROPERTY_DEL else update['property']['name']
+        return name in ('prop2', 'prop3')
+    expected = [update for update in _parse_all(corpus, fast_path=True, chunk_size=len(corpus)) if wanted(update)]
+    assert len(expected) > 100
+    q = asyncio.Queue()
+    parser = INDIStreamParser(q, subscriptions=subscriptions)
+    for idx in range(0, len(corpus), 100):
+        parser.parse(corpus[idx:idx + 100])
+    filtered = []
+    while not q.empty():
+        filtered.append(q.get_nowait())
+    assert filtered == expected
+    parser.parse(b'<delProperty device="dev1"/><delProperty device="dev2"/>')
+    assert q.get_nowait() == {'action': INDIActions.PROPERTY_DEL, 'device': 'dev1'}
+    assert q.empty()
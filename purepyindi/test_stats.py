@@ -0,0 +1,49 @@
+import pytest
+import socket
+import threading
+import time
+from .client import INDIClient
+from .constants import ConnectionStatus
+from .stats import LatencyHistogram
+from .test_fixtures import DEF_NUMBER_PROP, SET_NUMBER_PROP
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for microseconds in (1, 3, 3, 3, 100, 5000):
+        histogram.observe(microseconds / 1e6)
+    summary = histogram.summary()
+    assert summary['count'] == 6
+    assert summary['max'] == 0.005
+    assert summary['p50'] == 4e-6  # upper bound of the 2-4 us bucket
+    assert summary['p99'] == 0.005
+
+def test_client_stats():
+    with pytest.raises(RuntimeError):
+        INDIClient(None, None).stats()
+    client = INDIClient(None, None, collect_stats=True)
+    server_socket, client_socket = socket.socketpair()
+    client_socket.settimeout(0.1)
+    client.status = ConnectionStatus.CONNECTED
+    receiver = threading.Thread(target=client._handle_inbound, args=(client_socket,))
+    receiver.start()
+    server_socket.sendall(DEF_NUMBER_PROP)
+    deadline = time.monotonic() + 5
+    while 'test.prop.value' not in client and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.devices['test'].properties['prop'].add_watcher(lambda *args: None)
+    server_socket.sendall(SET_NUMBER_PROP)
+    while client['test.prop.value'] != 1.0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.status = ConnectionStatus.STOPPED
+    receiver.join()
+    server_socket.close()
+    client_socket.close()
+    client['test.prop.value'] = 2.0
+    stats = client.stats()
+    assert stats['bytes_received'] == len(DEF_NUMBER_PROP) + len(SET_NUMBER_PROP)
+    assert stats['messages_parsed'] == {'defNumberVector': 1, 'setNumberVector': 1}
+    assert stats['updates_applied'] == stats['apply_update_time']['count'] == 2
+    assert stats['watcher_invocations'] == 2  # the set, and applying our own change
+    assert stats['outbound_queue_depth'] == 1
+    assert stats['inbound_queue_depth'] == 0
+    assert stats['parse_time']['count'] >= 2
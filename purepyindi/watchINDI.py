@@ -4,6 +4,7 @@ import sys
 from .client import INDIClient
 from .constants import *
 from . import log
+from .stats import report_periodically
 from pprint import pprint
 
 def watch_for_updates(prop, did_anything_change):
@@ -34,14 +35,22 @@ def main():
         "INDI_PROPERTY",
         help="Dotted INDI identifier deviceName.propertyName"
     )
+    parser.add_argument(
+        "--stats",
+        help="Collect client statistics and print them (as JSON, to stderr) every STATS seconds",
+        type=float,
+        metavar="STATS",
+    )
     args = parser.parse_args()
     if args.help:
         parser.print_help()
         sys.exit(1)
     print(args)
     log.set_log_level('INFO')
-    c = INDIClient(args.host, args.port)
+    c = INDIClient(args.host, args.port, collect_stats=args.stats is not None)
     c.start()
+    if args.stats is not None:
+        report_periodically(c, args.stats)
     c.wait_for_properties([args.INDI_PROPERTY])
     device_name, prop_name = args.INDI_PROPERTY.split('.')
     watched_entity = c.devices[device_name].properties[prop_name]